@@ -0,0 +1,237 @@
+"""
+Admission control in front of the model: requests wait in priority lanes with their own concurrency limits,
+are charged against a per-session rate limit by cost (megapixel-steps), and are dropped instead of run once
+their deadline passed or a newer request from the same session superseded them:
+
+    scheduler = AdmissionScheduler(DEFAULT_LANES)
+    with scheduler.admit("realtime", session, estimate_cost(width, height, steps)):
+        ...  # run the model
+"""
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+from metrics import MetricsRegistry
+
+POLL_INTERVAL = 0.05  # Seconds between checks of a waiting request's cancel token
+
+# Reasons a request is not admitted
+RATE_LIMITED = "rate_limited"
+QUEUE_FULL = "queue_full"
+DEADLINE = "deadline"
+SUPERSEDED = "superseded"
+
+
+class Lane(NamedTuple):
+    """A class of requests; lower `priority` values are dispatched first when slots free up."""
+    name: str
+    priority: int
+    max_concurrency: int
+    max_cost: Optional[float] = None  # Cost in flight at once (a lone request always fits)
+    max_queue: int = 64
+    deadline: Optional[float] = None  # Seconds a request may wait before it is dropped
+    supersede: bool = False  # A new request of a session drops its queued ones
+    rate_limited: bool = True  # Charged against the session's rate; superseding lanes already bound a session's backlog
+
+
+DEFAULT_LANES = [
+    Lane("realtime", priority=0, max_concurrency=2, max_cost=16.0, max_queue=16, deadline=1.5, supersede=True, rate_limited=False),
+    Lane("generate", priority=1, max_concurrency=2, max_queue=32, deadline=30.0),
+    Lane("enhance", priority=2, max_concurrency=1, max_queue=16, deadline=30.0),
+]
+
+
+def estimate_cost(width, height, num_inference_steps=1) -> float:
+    """Relative cost of a request in megapixel-steps (the transformer dominates and scales with both)."""
+    return int(width) * int(height) / 1e6 * max(int(num_inference_steps), 1)
+
+
+class AdmissionRejected(Exception):
+    """Raised by `admit` when a request is not run; `reason` is one of the module's reason constants."""
+    def __init__(self, lane: str, reason: str):
+        super().__init__(f"{lane} request rejected: {reason}")
+        self.lane = lane
+        self.reason = reason
+
+
+class _Waiter:
+    def __init__(self, lane: Lane, session: Optional[str], cost: float, deadline: Optional[float], cancel_token, seq: int):
+        self.lane = lane
+        self.session = session
+        self.cost = cost
+        self.deadline = deadline
+        self.cancel_token = cancel_token
+        self.seq = seq
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.dropped: Optional[str] = None
+
+
+class _TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, cost: float) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # A request costlier than the burst is admitted from a full bucket, leaving it in debt
+        if self.tokens < min(cost, self.burst):
+            return False
+        self.tokens -= cost
+        return True
+
+
+class AdmissionScheduler:
+    """
+    Thread-safe admission control over named `lanes` sharing `max_concurrency` slots in total. Each session
+    may spend `session_rate` cost units per second with bursts up to `session_burst` (None disables it).
+    """
+    def __init__(
+        self,
+        lanes: Iterable[Lane] = DEFAULT_LANES,
+        max_concurrency: Optional[int] = None,
+        session_rate: Optional[float] = 8.0,
+        session_burst: float = 32.0,
+        registry: Optional[MetricsRegistry] = None,
+    ):
+        self.lanes: Dict[str, Lane] = {lane.name: lane for lane in lanes}
+        self.max_concurrency = max_concurrency or sum(lane.max_concurrency for lane in self.lanes.values())
+        self.session_rate = session_rate
+        self.session_burst = session_burst
+        self.registry = registry
+        self._condition = threading.Condition()
+        self._seq = itertools.count()
+        self._waiting: List[_Waiter] = []
+        self._running: Dict[str, int] = {name: 0 for name in self.lanes}
+        self._running_cost: Dict[str, float] = {name: 0.0 for name in self.lanes}
+        self._buckets: Dict[str, _TokenBucket] = {}
+        self.admitted: Dict[str, int] = {name: 0 for name in self.lanes}
+        self.rejected: Dict[str, int] = {}
+
+    @contextmanager
+    def admit(
+        self,
+        lane: str,
+        session: Optional[str] = None,
+        cost: float = 1.0,
+        deadline: Optional[float] = None,
+        cancel_token: Any = None,
+    ) -> Iterator[float]:
+        """
+        Waits for a slot in `lane` and holds it for the enclosed block; yields the seconds spent waiting.
+        `deadline` overrides the lane's (seconds from now). Raises `AdmissionRejected` when the session is
+        over its rate, the lane queue is full, the deadline passes, the request is superseded or
+        `cancel_token` is cancelled while waiting.
+        """
+        waiter = self._enqueue(self.lanes[lane], session, cost, deadline, cancel_token)
+        wait_seconds = self._wait(waiter)
+        try:
+            yield wait_seconds
+        finally:
+            with self._condition:
+                self._running[lane] -= 1
+                self._running_cost[lane] -= waiter.cost
+                self._dispatch()
+
+    def _enqueue(self, lane: Lane, session, cost, deadline, cancel_token) -> _Waiter:
+        if deadline is None:
+            deadline = lane.deadline
+        with self._condition:
+            if session is not None and self.session_rate is not None and lane.rate_limited:
+                bucket = self._buckets.get(session)
+                if bucket is None:
+                    if len(self._buckets) > 4096:
+                        self._prune_buckets()
+                    bucket = self._buckets[session] = _TokenBucket(self.session_rate, self.session_burst)
+                if not bucket.take(cost):
+                    self._reject(lane.name, RATE_LIMITED)
+            queued = [w for w in self._waiting if w.lane.name == lane.name]
+            if lane.supersede and session is not None:
+                for other in queued:
+                    if other.session == session:
+                        other.dropped = SUPERSEDED
+                        self._waiting.remove(other)
+                queued = [w for w in queued if w.dropped is None]
+            if len(queued) >= lane.max_queue:
+                self._reject(lane.name, QUEUE_FULL)
+            waiter = _Waiter(
+                lane, session, cost, time.monotonic() + deadline if deadline is not None else None, cancel_token, next(self._seq)
+            )
+            self._waiting.append(waiter)
+            self._waiting.sort(key=lambda w: (w.lane.priority, w.seq))
+            self._dispatch()
+            return waiter
+
+    def _wait(self, waiter: _Waiter) -> float:
+        with self._condition:
+            while not waiter.granted and waiter.dropped is None:
+                now = time.monotonic()
+                if waiter.deadline is not None and now >= waiter.deadline:
+                    waiter.dropped = DEADLINE
+                elif waiter.cancel_token is not None and waiter.cancel_token.cancelled:
+                    waiter.dropped = SUPERSEDED
+                else:
+                    timeouts = [POLL_INTERVAL] if waiter.cancel_token is not None else []
+                    if waiter.deadline is not None:
+                        timeouts.append(waiter.deadline - now)
+                    self._condition.wait(min(timeouts) if timeouts else None)
+                    continue
+                self._waiting.remove(waiter)
+            wait_seconds = time.monotonic() - waiter.enqueued
+            if waiter.dropped is not None:
+                self._reject(waiter.lane.name, waiter.dropped, wait_seconds)
+            self.admitted[waiter.lane.name] += 1
+        if self.registry is not None:
+            self.registry.observe("queue_wait", wait_seconds, lane=waiter.lane.name)
+        return wait_seconds
+
+    def _dispatch(self):
+        """Grants free slots to waiting requests in priority order (caller holds the condition)."""
+        running = sum(self._running.values())
+        for waiter in list(self._waiting):
+            if running >= self.max_concurrency:
+                break
+            name = waiter.lane.name
+            if self._running[name] >= waiter.lane.max_concurrency:
+                continue
+            max_cost = waiter.lane.max_cost
+            if max_cost is not None and self._running[name] and self._running_cost[name] + waiter.cost > max_cost:
+                continue
+            waiter.granted = True
+            self._waiting.remove(waiter)
+            self._running[name] += 1
+            self._running_cost[name] += waiter.cost
+            running += 1
+        self._condition.notify_all()
+
+    def _reject(self, lane: str, reason: str, wait_seconds: Optional[float] = None):
+        key = f"{lane}_{reason}"
+        self.rejected[key] = self.rejected.get(key, 0) + 1
+        if self.registry is not None and wait_seconds is not None:
+            self.registry.observe("queue_dropped_wait", wait_seconds, lane=lane, reason=reason)
+        raise AdmissionRejected(lane, reason)
+
+    def _prune_buckets(self):
+        # Full buckets carry no state worth keeping
+        now = time.monotonic()
+        for session, bucket in list(self._buckets.items()):
+            if bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.burst:
+                del self._buckets[session]
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns queue depth, running requests and cost per lane, plus admitted/rejected counters."""
+        with self._condition:
+            result: Dict[str, Any] = {}
+            for name in self.lanes:
+                result[f"{name}_queue_depth"] = sum(1 for w in self._waiting if w.lane.name == name)
+                result[f"{name}_running"] = self._running[name]
+                result[f"{name}_running_cost"] = self._running_cost[name]
+                result[f"{name}_admitted"] = self.admitted[name]
+            result.update({f"{key}_rejected": count for key, count in self.rejected.items()})
+            return result
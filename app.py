@@ -1,8 +1,16 @@
 import gradio as gr
 import random
-from gradio_client import Client
+import time
 import os
+from concurrent.futures import ThreadPoolExecutor
 from themes import IndonesiaTheme  # Impor tema custom dari themes.py
+from result_cache import ResultCache, normalize_prompt
+from backend_client import RequestCancelled
+from dispatcher import Dispatcher
+from metrics import REGISTRY, format_resolution, parse_latency, start_http_server
+from warmup import BackgroundLoader
+from admission import SUPERSEDED, AdmissionRejected, AdmissionScheduler, Lane, estimate_cost
+from profiling import RequestProfiler
 
 # Constants
 MAX_SEED = 999999
@@ -10,36 +18,266 @@ MAX_IMAGE_SIZE = 2048
 DEFAULT_WIDTH = 1024
 DEFAULT_HEIGHT = 1024
 DEFAULT_INFERENCE_STEPS = 1
+BACKEND_POOL_SIZE = 2  # Jumlah koneksi Client per backend
+BACKEND_TIMEOUT = 60.0  # Detik per panggilan
+BACKEND_RETRIES = 2
+BACKEND_HEDGE_AFTER = None  # Detik sebelum panggilan diduplikasi ke koneksi lain (None = nonaktif)
+BACKEND_MAX_FAILURES = 3  # Kegagalan beruntun sebelum backend dikeluarkan sementara
+BACKEND_EJECT_SECONDS = 30.0  # Lama backend dikeluarkan sebelum dicek ulang
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))  # Endpoint metrik: http://host:METRICS_PORT/metrics (0 = nonaktif)
+DEFAULT_VARIATIONS = 4  # Jumlah seed untuk tombol Variasi
+MAX_VARIATIONS = 8  # Batas seed per permintaan variasi (dipanggil paralel ke Space)
+SESSION_COST_RATE = 8.0  # Megapixel-step per detik per sesi (rata-rata)
+SESSION_COST_BURST = 32.0  # Megapixel-step maksimum sekaligus per sesi
+TRACE_DIR = "traces"  # Folder trace permintaan (ring berisi TRACE_MAX_FILES trace terbaru)
+TRACE_SAMPLE_RATE = 0.0  # Fraksi permintaan yang di-trace (0 = hanya permintaan lambat)
+TRACE_SLOW_SECONDS = None  # Permintaan selama ini (detik) atau lebih selalu disimpan trace-nya (None = nonaktif)
+TRACE_MAX_FILES = 64
 
-# Siapkan URL untuk permintaan API RT FLUX
-# url_api = os.environ['url_api']
+# Siapkan URL untuk permintaan API RT FLUX (default: Space publik); beberapa backend dipisah dengan koma
+API_SPACE = os.environ.get('url_api', "KingNish/Realtime-FLUX")
+API_SPACES = [src.strip() for src in API_SPACE.split(",") if src.strip()]
 
-client = Client("KingNish/Realtime-FLUX")
-# client = Client(url_api)
+# Permintaan dibagi ke backend sehat yang paling sedikit bebannya (prompt yang sama cenderung ke backend yang sama);
+# koneksi dibuat secara lazy, jadi startup tidak menunggu jaringan
+backend = Dispatcher(
+    API_SPACES,
+    pool_size=BACKEND_POOL_SIZE,
+    max_failures=BACKEND_MAX_FAILURES,
+    eject_seconds=BACKEND_EJECT_SECONDS,
+    timeout=BACKEND_TIMEOUT,
+    retries=BACKEND_RETRIES,
+    hedge_after=BACKEND_HEDGE_AFTER,
+)
+
+# Sambungkan satu koneksi di background; handler tetap bisa tersambung sendiri secara lazy
+connector = BackgroundLoader(lambda: backend.connect(1), name=API_SPACE)
+
+# Cache hasil untuk permintaan deterministik (seed tetap)
+result_cache = ResultCache()
+
+# File hasil dari Space diteruskan apa adanya (tanpa decode/encode ulang); salinan ke cache ditulis di background
+cache_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="result-cache")
+
+# Variasi dikirim ke Space sebagai panggilan paralel, satu per seed
+fan_out = ThreadPoolExecutor(max_workers=MAX_VARIATIONS, thread_name_prefix="variations")
+
+# Kontrol admisi: jalur generate/enhance/variasi dengan batas konkurensi, batas laju per sesi dan deadline
+scheduler = AdmissionScheduler(
+    [
+        Lane("generate", priority=0, max_concurrency=2 * BACKEND_POOL_SIZE * len(API_SPACES), max_queue=32, deadline=30.0, supersede=True),
+        Lane("enhance", priority=1, max_concurrency=BACKEND_POOL_SIZE * len(API_SPACES), max_queue=16, deadline=30.0),
+        Lane("variations", priority=2, max_concurrency=1, max_queue=8, deadline=30.0),
+    ],
+    session_rate=SESSION_COST_RATE,
+    session_burst=SESSION_COST_BURST,
+    registry=REGISTRY,
+)
+
+# Trace sampel: span connect/submit plus fase upload/antrean/komputasi/download dari status job di Space
+profiler = RequestProfiler(TRACE_DIR, sample_rate=TRACE_SAMPLE_RATE, slow_threshold=TRACE_SLOW_SECONDS, max_traces=TRACE_MAX_FILES)
+
+# Histogram latensi per tahap (jaringan vs komputasi di Space)
+REGISTRY.register_gauge("result_cache", result_cache.stats)
+REGISTRY.register_gauge("backend", backend.stats)
+REGISTRY.register_gauge("ready", lambda: int(connector.ready))
+REGISTRY.register_gauge("admission", scheduler.stats)
+REGISTRY.register_gauge("profiling", profiler.stats)
+
+def busy_message(rejected):
+    return f"Server sibuk ({rejected.reason}), silakan coba lagi"
+
+def record_latency(endpoint, start_time, remote_latency, hit, width, height, steps=None):
+    total = time.time() - start_time
+    labels = dict(endpoint=endpoint, resolution=format_resolution(width, height), steps=steps)
+    if hit:
+        REGISTRY.observe("cache_hit", total, **labels)
+        return f"Latency: {total:.3f} seconds (cache hit)"
+    REGISTRY.observe("total", total, **labels)
+    remote = parse_latency(remote_latency)
+    if remote is None:
+        return f"Latency: {total:.2f} seconds (cache miss)"
+    REGISTRY.observe("remote_compute", remote, **labels)
+    REGISTRY.observe("network", max(total - remote, 0.0), **labels)
+    return f"Latency: {total:.2f} seconds (cache miss · remote {remote:.2f} · network {max(total - remote, 0.0):.2f})"
 
 # Inference function using RealtimeFlux API
-def generate_image(prompt, seed=42, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, randomize_seed=False, num_inference_steps=1):
-    result = client.predict(
-        prompt=prompt,
-        seed=seed if not randomize_seed else random.randint(0, MAX_SEED),
-        width=width,
-        height=height,
-        randomize_seed=randomize_seed,
-        num_inference_steps=num_inference_steps,
-        api_name="/RealtimeFlux"
-    )
-    return result[0], result[1], result[2]  # Image, Seed, Latency
+def generate_image(prompt, seed=42, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, randomize_seed=False, num_inference_steps=1, request: gr.Request = None):
+    start_time = time.time()
+    key = None
+    if not randomize_seed:
+        key = ResultCache.make_key(API_SPACE, "/RealtimeFlux", prompt, seed=seed, width=width, height=height, num_inference_steps=num_inference_steps)
+        path = result_cache.get(key)
+        if path is not None:
+            yield path, seed, record_latency("/RealtimeFlux", start_time, None, True, width, height, num_inference_steps)
+            return
+
+    session = request.session_hash if request else None
+    params = dict(prompt=prompt, seed=seed, width=width, height=height, randomize_seed=randomize_seed, num_inference_steps=num_inference_steps)
+    with profiler.trace("/RealtimeFlux", **params) as trace:
+        try:
+            with scheduler.admit("generate", session, estimate_cost(width, height, num_inference_steps)) as wait_seconds:
+                trace.annotate(admission_wait=wait_seconds)
+                yield from stream_remote(prompt, seed, width, height, randomize_seed, num_inference_steps, session, start_time, key, trace)
+        except AdmissionRejected as rejected:
+            trace.annotate(rejected=rejected.reason)
+            if rejected.reason == SUPERSEDED:
+                # Klik yang lebih baru dari sesi ini menggantikannya: biarkan tampilan untuk permintaan baru
+                yield gr.update(), gr.update(), gr.update()
+                return
+            yield gr.update(), gr.update(), busy_message(rejected)
+
+# Contoh galeri di-cache secara lazy untuk semua pengguna: tanpa sesi (tidak kena batas laju per sesi dan tidak dibatalkan
+# klik lain), dan penolakan/pembatalan menjadi gr.Error supaya pesan sibuk atau hasil terpotong tidak ikut di-cache
+def example_image(prompt, seed=42, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, num_inference_steps=DEFAULT_INFERENCE_STEPS):
+    start_time = time.time()
+    key = ResultCache.make_key(API_SPACE, "/RealtimeFlux", prompt, seed=seed, width=width, height=height, num_inference_steps=num_inference_steps)
+    path = result_cache.get(key)
+    if path is not None:
+        return path, seed, record_latency("/RealtimeFlux", start_time, None, True, width, height, num_inference_steps)
+
+    cost = estimate_cost(width, height, num_inference_steps)
+    with profiler.trace("/RealtimeFlux", prompt=prompt, seed=seed, width=width, height=height, num_inference_steps=num_inference_steps, example=True) as trace:
+        try:
+            with scheduler.admit("generate", None, cost) as wait_seconds:
+                trace.annotate(admission_wait=wait_seconds)
+                result = backend.predict(
+                    prompt=prompt,
+                    seed=seed,
+                    width=width,
+                    height=height,
+                    randomize_seed=False,
+                    num_inference_steps=num_inference_steps,
+                    api_name="/RealtimeFlux",
+                    affinity=normalize_prompt(prompt),
+                    cost=cost,
+                    trace=trace,
+                )
+        except AdmissionRejected as rejected:
+            trace.annotate(rejected=rejected.reason)
+            raise gr.Error(busy_message(rejected))
+        except RequestCancelled:
+            raise gr.Error("Permintaan dibatalkan, silakan coba lagi")
+    latency = record_latency("/RealtimeFlux", start_time, result[2], False, width, height, num_inference_steps)
+    cache_writer.submit(result_cache.put, key, result[0])
+    return result[0], result[1], latency
+
+# Tampilkan preview selama Space masih memproses; permintaan baru dari sesi yang sama membatalkan yang lama
+def stream_remote(prompt, seed, width, height, randomize_seed, num_inference_steps, session, start_time, key, trace):
+    result = None
+    try:
+        for result in backend.stream(
+            prompt=prompt,
+            seed=seed if not randomize_seed else random.randint(0, MAX_SEED),
+            width=width,
+            height=height,
+            randomize_seed=randomize_seed,
+            num_inference_steps=num_inference_steps,
+            api_name="/RealtimeFlux",
+            session=session,
+            affinity=normalize_prompt(prompt),
+            cost=estimate_cost(width, height, num_inference_steps),
+            trace=trace,
+        ):
+            yield result[0], result[1], result[2]  # Image, Seed, Latency
+    except RequestCancelled:
+        return
+    if result is not None:
+        latency = record_latency("/RealtimeFlux", start_time, result[2], False, width, height, num_inference_steps)
+        if key is not None:
+            cache_writer.submit(result_cache.put, key, result[0])
+        yield result[0], result[1], latency
 
 # Enhance function using Enhance API
-def enhance_image(prompt, seed, width, height):
-    result = client.predict(
-        param_0=prompt,
-        param_1=seed,
-        param_2=width,
-        param_3=height,
-        api_name="/Enhance"
-    )
-    return result[0], result[1], result[2]  # Image, Seed, Latency
+def enhance_image(prompt, seed, width, height, request: gr.Request = None):
+    start_time = time.time()
+    key = ResultCache.make_key(API_SPACE, "/Enhance", prompt, seed=seed, width=width, height=height)
+    path = result_cache.get(key)
+    if path is not None:
+        return path, seed, record_latency("/Enhance", start_time, None, True, width, height)
+
+    session = request.session_hash if request else None
+    with profiler.trace("/Enhance", prompt=prompt, seed=seed, width=width, height=height) as trace:
+        try:
+            with scheduler.admit("enhance", session, estimate_cost(width, height, 2)) as wait_seconds:
+                trace.annotate(admission_wait=wait_seconds)
+                result = backend.predict(
+                    param_0=prompt,
+                    param_1=seed,
+                    param_2=width,
+                    param_3=height,
+                    api_name="/Enhance",
+                    session=session,
+                    affinity=normalize_prompt(prompt),
+                    cost=estimate_cost(width, height, 2),
+                    trace=trace,
+                )
+        except RequestCancelled:
+            return gr.update(), gr.update(), gr.update()
+        except AdmissionRejected as rejected:
+            trace.annotate(rejected=rejected.reason)
+            return gr.update(), gr.update(), busy_message(rejected)
+    latency = record_latency("/Enhance", start_time, result[2], False, width, height)
+    cache_writer.submit(result_cache.put, key, result[0])
+    return result[0], result[1], latency
+
+# Variasi: N seed dipanggil bersamaan, hasilnya ditampilkan di galeri beserta seed-nya
+def generate_variations(prompt, seed=42, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, randomize_seed=False, num_inference_steps=1, count=DEFAULT_VARIATIONS, request: gr.Request = None):
+    start_time = time.time()
+    count = min(int(count), MAX_VARIATIONS)
+    if randomize_seed:
+        seeds = [random.randint(0, MAX_SEED) for _ in range(count)]
+    else:
+        seeds = [(int(float(seed)) + i) % (MAX_SEED + 1) for i in range(count)]
+
+    keys = {s: ResultCache.make_key(API_SPACE, "/RealtimeFlux", prompt, seed=s, width=width, height=height, num_inference_steps=num_inference_steps) for s in seeds}
+
+    def one_seed(variation_seed):
+        # Tanpa session: panggilan paralel dari sesi yang sama tidak boleh saling membatalkan;
+        # tanpa afinitas: seed-seed disebar ke semua backend. Fase per panggilan tidak dicatat (paralel), hanya span per seed
+        with trace.span("seed", seed=variation_seed):
+            result = backend.predict(
+                prompt=prompt,
+                seed=variation_seed,
+                width=width,
+                height=height,
+                randomize_seed=False,
+                num_inference_steps=num_inference_steps,
+                api_name="/RealtimeFlux",
+                cost=estimate_cost(width, height, num_inference_steps),
+            )
+        cache_writer.submit(result_cache.put, keys[variation_seed], result[0])
+        return result[0]
+
+    session = request.session_hash if request else None
+    with profiler.trace("variations", prompt=prompt, seeds=seeds, width=width, height=height, num_inference_steps=num_inference_steps) as trace:
+        # Seed yang ada di cache langsung dipakai; hanya sisanya yang dihitung ke biaya admisi
+        paths = {s: result_cache.get(keys[s]) for s in seeds}
+        misses = [s for s in dict.fromkeys(seeds) if paths[s] is None]
+        errors = []
+        if misses:
+            try:
+                with scheduler.admit("variations", session, estimate_cost(width, height, num_inference_steps) * len(misses)) as wait_seconds:
+                    trace.annotate(admission_wait=wait_seconds)
+                    futures = {s: fan_out.submit(one_seed, s) for s in misses}
+                    # Tiap seed ditunggu sendiri: satu seed yang gagal atau timeout tidak membuang tile yang sudah jadi
+                    for s, future in futures.items():
+                        try:
+                            paths[s] = future.result()
+                        except Exception as e:
+                            errors.append(e)
+            except AdmissionRejected as rejected:
+                trace.annotate(rejected=rejected.reason)
+                return gr.update(), busy_message(rejected)
+        if errors:
+            trace.annotate(failed=len(errors), error=str(errors[0]))
+    tiles = [(paths[s], f"Seed {s}") for s in seeds if paths[s] is not None]
+    if errors and not tiles:
+        raise errors[0]
+    total = time.time() - start_time
+    REGISTRY.observe("variations", total, resolution=format_resolution(width, height), steps=num_inference_steps)
+    failed = f", {len(seeds) - len(tiles)} gagal" if errors else ""
+    return tiles, f"Latency: {total:.2f} seconds ({len(tiles)} variasi{failed})"
 
 # CSS untuk styling antarmuka
 css = """
@@ -112,6 +350,7 @@ with gr.Blocks(css=css, theme=IndonesiaTheme()) as RealtimeFluxAPP:
             )
             generateBtn = gr.Button("🖼️ Buat Gambar", elem_id="run-button")
             enhanceBtn = gr.Button("🚀 Tingkatkan Gambar", elem_id="run-button")
+            variationsBtn = gr.Button("🎲 Variasi", elem_id="run-button")
             
             # Advanced Options
             with gr.Accordion("Advanced Options"):
@@ -125,10 +364,13 @@ with gr.Blocks(css=css, theme=IndonesiaTheme()) as RealtimeFluxAPP:
                     width = gr.Slider(label="Width", minimum=256, maximum=MAX_IMAGE_SIZE, step=32, value=DEFAULT_WIDTH)
                     height = gr.Slider(label="Height", minimum=256, maximum=MAX_IMAGE_SIZE, step=32, value=DEFAULT_HEIGHT)
                     num_inference_steps = gr.Slider(label="Inference Steps", minimum=1, maximum=4, step=1, value=DEFAULT_INFERENCE_STEPS)
+                with gr.Row():
+                    variation_count = gr.Slider(label="Jumlah Variasi", minimum=2, maximum=MAX_VARIATIONS, step=1, value=DEFAULT_VARIATIONS)
         
         # Output di sebelah kanan
         with gr.Column(elem_id="col-right"):
             result = gr.Image(label="Hasil Gambar", show_label=False, interactive=False)
+            variations = gr.Gallery(label="Variasi", columns=4, interactive=False)
 
     # Example Gallery
     gr.Markdown("### 🌟 Inspirasi Gallery")
@@ -142,7 +384,7 @@ with gr.Blocks(css=css, theme=IndonesiaTheme()) as RealtimeFluxAPP:
             "An Indonesian traditional dancer performing in a colorful costume",
             "A futuristic cityscape of Jakarta with skyscrapers and advanced technology",
         ],
-        fn=generate_image,
+        fn=example_image,
         inputs=[prompt],
         outputs=[result, seed, latency],
         cache_examples="lazy"
@@ -163,6 +405,13 @@ with gr.Blocks(css=css, theme=IndonesiaTheme()) as RealtimeFluxAPP:
         show_progress=True
     )
 
+    variationsBtn.click(
+        fn=generate_variations,
+        inputs=[prompt, seed, width, height, randomize_seed, num_inference_steps, variation_count],
+        outputs=[variations, latency],
+        show_progress=True
+    )
+
     # Tambahkan footer di bagian bawah
     gr.HTML("""
     <footer id="footer">
@@ -172,4 +421,9 @@ with gr.Blocks(css=css, theme=IndonesiaTheme()) as RealtimeFluxAPP:
 
 # Menjalankan aplikasi
 if __name__ == "__main__":
-    RealtimeFluxAPP.queue(api_open=False).launch(show_api=False)
+    connector.start()
+    backend.start_health_checks()
+    if METRICS_PORT:
+        start_http_server(REGISTRY, port=METRICS_PORT, readiness=connector.status)
+    # Konkurensi dibatasi oleh jalur admisi, bukan oleh batas default antrean Gradio
+    RealtimeFluxAPP.queue(api_open=False, default_concurrency_limit=None).launch(show_api=False)
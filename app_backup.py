@@ -1,11 +1,19 @@
 import gradio as gr
 import numpy as np
+import os
 import random
 import spaces
 import torch
 import time
 from diffusers import DiffusionPipeline
 from custom_pipeline import FLUXPipelineWithIntermediateOutputs
+from batching import MicroBatcher
+from sessions import GenerationCancelled, SessionTokens
+from metrics import REGISTRY, format_breakdown, start_http_server
+from warmup import BackgroundLoader
+from encoding import ImageEncoder
+from admission import DEFAULT_LANES, AdmissionRejected, AdmissionScheduler, estimate_cost
+from prompt_reuse import FULL, REUSE, SKIP, PromptReuse
 
 # Constants
 MAX_SEED = np.iinfo(np.int32).max
@@ -13,45 +21,304 @@ MAX_IMAGE_SIZE = 2048
 DEFAULT_WIDTH = 1024
 DEFAULT_HEIGHT = 1024
 DEFAULT_INFERENCE_STEPS = 1
+STREAM_PREVIEWS = True  # Yield a cheap preview after every step for explicit generations
+MICRO_BATCH_SIZE = 4  # Concurrent same-shape requests denoised together
+MICRO_BATCH_WAIT = 0.02  # Seconds the first request waits for others to join its batch
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))  # Scrape endpoint at http://host:METRICS_PORT/metrics (0: off); one per worker
+SHOW_STAGE_BREAKDOWN = True  # Append per-stage seconds to the latency box
+ENHANCE_STEPS = 2  # Low-sigma refinement steps run by Enhance on the last image of the session
+ENHANCE_STRENGTH = 0.35  # Sigma the last image is re-noised to before refinement
+ENHANCE_UPSCALE = 1.0  # Resolution factor applied by Enhance (capped at MAX_IMAGE_SIZE)
+COMPILED_MODE = False  # torch.compile the transformer and VAE once per resolution bucket (first request per bucket is slow)
+COMPILE_BUCKET_POLICY = "pad"  # "pad": run at the covering bucket and crop; "snap": return the closest bucket size
+OUTPUT_FORMAT = "webp"  # Results are encoded off the request thread as webp or jpeg instead of PNG
+OUTPUT_QUALITY = 90  # Encoder quality of final images
+PREVIEW_QUALITY = 60  # Encoder quality of streamed previews
+DEFAULT_VARIATIONS = 4  # Seeds generated together by the Variations button
+MAX_VARIATIONS = 8  # Slider maximum; the pipeline may lower it further from its memory estimate
+SESSION_COST_RATE = 8.0  # Megapixel-steps per second a session may request on average
+SESSION_COST_BURST = 32.0  # Megapixel-steps a session may request at once
+CPU_DTYPE = torch.bfloat16  # Used on CPU-only nodes (bfloat16 or float32)
+CPU_QUANTIZE = True  # Dynamic int8 quantization of the transformer's linear layers on CPU (runs in float32)
+CPU_THREADS = None  # torch intra-op threads on CPU (None: torch's choice)
+DECODE_MEMORY_BUDGET = None  # Bytes a VAE decode may use before switching to sliced/tiled decode (None: half the free memory)
+ATTENTION_BACKEND = "auto"  # "sdpa", "efficient", "chunked", "xformers" or "auto" (picked from the image sequence length)
+TRACE_DIR = "traces"  # Request traces, a ring of the TRACE_MAX_FILES most recent
+TRACE_SAMPLE_RATE = 0.0  # Fraction of generations traced with the torch profiler
+TRACE_SLOW_SECONDS = None  # Generations taking at least this long always keep their span trace (None: off)
+TRACE_MAX_FILES = 64
+REALTIME_REUSE_STRENGTH = 0.6  # Sigma small realtime edits restart from on the last latents (None: always from noise)
+REALTIME_REUSE_MAX_EDIT = 12  # Changed characters up to which a realtime edit reuses the last latents
 
-# Device and model setup
-dtype = torch.float16
-pipe = FLUXPipelineWithIntermediateOutputs.from_pretrained(
-    "black-forest-labs/FLUX.1-schnell", torch_dtype=dtype
-).to("cuda")
-torch.cuda.empty_cache()
+# Example prompts
+examples = [
+    "a tiny astronaut hatching from an egg on the moon",
+    "a cute white cat holding a sign that says hello world",
+    "an anime illustration of a wiener schnitzel",
+    "Create mage of Modern house in minecraft style",
+    "Imagine steve jobs as Star Wars movie character",
+    "Lion",
+    "Photo of a young woman with long, wavy brown hair tied in a bun and glasses. She has a fair complexion and is wearing subtle makeup, emphasizing her eyes and lips. She is dressed in a black top. The background appears to be an urban setting with a building facade, and the sunlight casts a warm glow on her face.",
+]
+
+# A newer request from the same session aborts the older one between steps
+session_tokens = SessionTokens()
+REGISTRY.register_gauge("sessions", session_tokens.stats)
+
+# Realtime typing: unchanged prompts (after normalization) are skipped, small edits refine the last latents
+prompt_reuse = PromptReuse(max_edit_chars=REALTIME_REUSE_MAX_EDIT, min_strength=REALTIME_REUSE_STRENGTH)
+REGISTRY.register_gauge("prompt_reuse", prompt_reuse.stats)
+
+# Admission control: realtime, generate and enhance lanes with their own concurrency limits, per-session
+# rate limits in megapixel-steps and deadlines that drop stale realtime requests before they reach the model
+scheduler = AdmissionScheduler(DEFAULT_LANES, session_rate=SESSION_COST_RATE, session_burst=SESSION_COST_BURST, registry=REGISTRY)
+REGISTRY.register_gauge("admission", scheduler.stats)
+
+# Images come out of the pipeline as uint8 arrays and are encoded on a thread pool
+encoder = ImageEncoder(format=OUTPUT_FORMAT, quality=OUTPUT_QUALITY, preview_quality=PREVIEW_QUALITY)
+REGISTRY.register_gauge("encoder", encoder.stats)
+
+# Device and model setup; runs in the background so the UI can start right away.
+# On ZeroGPU the GPU only exists inside @spaces.GPU calls: the loader thread must not touch CUDA there
+ZERO_GPU = os.environ.get("SPACES_ZERO_GPU", "").lower() in ("1", "true")
+device = "cuda" if ZERO_GPU or torch.cuda.is_available() else "cpu"
+dtype = torch.float16 if device == "cuda" else CPU_DTYPE
+pipe = None
+batcher = None
+
+def load_pipeline():
+    global pipe, batcher
+    # safetensors weights are memory-mapped, then moved to the device in one go
+    loaded = FLUXPipelineWithIntermediateOutputs.from_pretrained(
+        "black-forest-labs/FLUX.1-schnell", torch_dtype=dtype
+    )
+    if device == "cuda":
+        loaded.to(device)  # Deferred by `spaces` until the first GPU call on ZeroGPU
+        if not ZERO_GPU:
+            torch.cuda.empty_cache()
+    else:
+        # CPU overflow nodes: bf16/fp32 or int8 transformer, channels-last VAE
+        loaded.enable_cpu_mode(dtype=CPU_DTYPE, quantize=CPU_QUANTIZE, num_threads=CPU_THREADS)
+
+    # Cache text-encoder outputs, keep each session's final latents so Enhance can refine them,
+    # and record per-stage latency histograms (p50/p95/p99 per resolution and step count)
+    loaded.enable_prompt_cache()
+    loaded.enable_latent_store()
+    loaded.enable_metrics(REGISTRY)
+    REGISTRY.register_gauge("latent_store", loaded.latent_store.stats)
+    # The default budget reads the free device memory, which needs the GPU at hand
+    if (device == "cuda" and not ZERO_GPU) or DECODE_MEMORY_BUDGET is not None:
+        loaded.enable_memory_policy(DECODE_MEMORY_BUDGET)
+    loaded.enable_attention_backend(ATTENTION_BACKEND)
+    if TRACE_SAMPLE_RATE or TRACE_SLOW_SECONDS is not None:
+        loaded.enable_profiling(TRACE_DIR, TRACE_SAMPLE_RATE, TRACE_SLOW_SECONDS, TRACE_MAX_FILES)
+    if COMPILED_MODE:
+        # Micro-batches run at 1..MICRO_BATCH_SIZE, variation batches at up to MAX_VARIATIONS seeds
+        loaded.enable_compiled_mode(policy=COMPILE_BUCKET_POLICY, batch_sizes=range(1, max(MICRO_BATCH_SIZE, MAX_VARIATIONS) + 1))
+
+    # Group concurrent non-streaming requests into batched denoising loops
+    batcher = MicroBatcher(loaded, max_batch_size=MICRO_BATCH_SIZE, max_wait=MICRO_BATCH_WAIT, output_type="uint8")
+    REGISTRY.register_gauge("micro_batches", batcher.stats)
+    pipe = loaded
+
+def warm_up_pipeline():
+    # Pre-encode the gallery prompts and run the default shape once for kernels and allocator growth.
+    # Skipped on ZeroGPU: every GPU call runs in a fresh worker, so there is nothing to keep warm
+    if ZERO_GPU:
+        return
+    pipe.warm_prompt_cache(examples)
+    for _ in pipe.generate_images(
+            prompt=examples[0],
+            guidance_scale=0,
+            num_inference_steps=DEFAULT_INFERENCE_STEPS,
+            width=DEFAULT_WIDTH,
+            height=DEFAULT_HEIGHT,
+            generator=torch.Generator().manual_seed(0)
+        ):
+        pass
+
+loader = BackgroundLoader(load_pipeline, warm_up_pipeline, name="FLUX.1-schnell").start()
+REGISTRY.register_gauge("ready", lambda: int(loader.ready))
+if METRICS_PORT:
+    start_http_server(REGISTRY, port=METRICS_PORT, readiness=loader.status)
+
+def format_latency(seconds, timings):
+    latency = f"Latency: {seconds:.2f} seconds"
+    if SHOW_STAGE_BREAKDOWN and timings:
+        latency += f" ({format_breakdown(timings)})"
+    return latency
 
 # Inference function
 @spaces.GPU(duration=25)
-def generate_image(prompt, seed=42, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, randomize_seed=False, num_inference_steps=2, progress=gr.Progress(track_tqdm=True)):
+def generate_image(prompt, seed=42, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, randomize_seed=False, num_inference_steps=2, progress=gr.Progress(track_tqdm=True), stream_previews=False, session=None):
+    if not loader.ready:
+        yield gr.update(), seed, loader.message()
+        return
     if randomize_seed:
         seed = random.randint(0, MAX_SEED)
-    generator = torch.Generator().manual_seed(int(float(seed)))
+    token = session_tokens.begin(session, num_inference_steps)
+    completed = False
+    timings = {}
+
+    try:
+        if not stream_previews:
+            img, elapsed = batcher.submit(prompt, seed, width, height, num_inference_steps, cancel_token=token, timings=timings, store_key=session)
+            completed = True
+            yield encoder.save(img), seed, format_latency(elapsed, timings)
+            return
+
+        generator = torch.Generator().manual_seed(int(float(seed)))
+        start_time = time.time()
 
+        # Only the last image is a full VAE decode; earlier ones are previews when streaming.
+        # A preview is encoded on the pool while the next step runs and shown once that step is done
+        frames = 0
+        pending = None
+        for img in pipe.generate_images(
+                prompt=prompt,
+                guidance_scale=0, # as Flux schnell is guidance free
+                num_inference_steps=num_inference_steps,
+                width=width,
+                height=height,
+                generator=generator,
+                stream_previews=stream_previews,
+                output_type="uint8",
+                cancel_token=token,
+                timings=timings,
+                store_key=session
+            ):
+            # One preview per step but the last, then the final decode
+            frames += 1
+            completed = frames == token.steps_total
+            latency = format_latency(time.time()-start_time, timings)
+            if completed:
+                # The final image replaces a preview still in flight
+                yield encoder.save(img), seed, latency
+            else:
+                if pending is not None:
+                    yield pending[0].result(), seed, pending[1]
+                pending = (encoder.submit(img, preview=True), latency)
+        if not completed:
+            # Superseded before the final decode: keep whatever is on screen
+            yield gr.update(), gr.update(), gr.update()
+    except GenerationCancelled:
+        yield gr.update(), gr.update(), gr.update()
+    finally:
+        session_tokens.finish(session, token, completed)
+
+# Enhance: refine the session's last image from its latents instead of regenerating from noise
+@spaces.GPU(duration=25)
+def refine_image(prompt, seed, width, height, session):
+    if not loader.ready:
+        return None
+    stored = pipe.get_stored_latents(session) if session is not None else None
+    if stored is None or stored.prompt != prompt:
+        return None
+    width = min(int(width * ENHANCE_UPSCALE), MAX_IMAGE_SIZE)
+    height = min(int(height * ENHANCE_UPSCALE), MAX_IMAGE_SIZE)
+    timings = {}
     start_time = time.time()
+    *_, img = pipe.refine_images(
+        session,
+        num_inference_steps=ENHANCE_STEPS,
+        strength=ENHANCE_STRENGTH,
+        width=width,
+        height=height,
+        generator=torch.Generator().manual_seed(int(float(seed))),
+        guidance_scale=0,
+        output_type="uint8",
+        timings=timings,
+    )
+    return encoder.save(img), seed, format_latency(time.time()-start_time, timings)
 
-    # Only generate the last image in the sequence
-    for img in pipe.generate_images(  
+# Realtime small edit: start from the session's last latents re-noised to `strength` instead of pure noise
+@spaces.GPU(duration=25)
+def reuse_image(prompt, seed, width, height, num_inference_steps, strength, session):
+    if not loader.ready or pipe.get_stored_latents(session) is None:
+        return None
+    token = session_tokens.begin(session, num_inference_steps)
+    completed = False
+    timings = {}
+    start_time = time.time()
+    try:
+        images = list(pipe.refine_images(
+            session,
             prompt=prompt,
-            guidance_scale=0, # as Flux schnell is guidance free
             num_inference_steps=num_inference_steps,
+            strength=strength,
             width=width,
             height=height,
-            generator=generator
-        ): 
-        latency = f"Latency: {(time.time()-start_time):.2f} seconds"    
-        yield img, seed, latency
+            generator=torch.Generator().manual_seed(int(float(seed))),
+            guidance_scale=0,
+            output_type="uint8",
+            cancel_token=token,
+            timings=timings,
+        ))
+        if not images:
+            # Superseded by the next keystroke
+            return gr.update(), gr.update(), gr.update()
+        completed = True
+        return encoder.save(images[-1]), seed, format_latency(time.time()-start_time, timings) + " (reused)"
+    finally:
+        session_tokens.finish(session, token, completed)
 
-# Example prompts
-examples = [
-    "a tiny astronaut hatching from an egg on the moon",
-    "a cute white cat holding a sign that says hello world",
-    "an anime illustration of a wiener schnitzel",
-    "Create mage of Modern house in minecraft style",
-    "Imagine steve jobs as Star Wars movie character",
-    "Lion",
-    "Photo of a young woman with long, wavy brown hair tied in a bun and glasses. She has a fair complexion and is wearing subtle makeup, emphasizing her eyes and lips. She is dressed in a black top. The background appears to be an urban setting with a building facade, and the sunlight casts a warm glow on her face.",
-]
+# Variations: one prompt encoding and one batched denoising loop for N seeds
+@spaces.GPU(duration=25)
+def generate_variations(prompt, seed=42, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, randomize_seed=False, num_inference_steps=2, count=DEFAULT_VARIATIONS):
+    if not loader.ready:
+        return gr.update(), loader.message()
+    count = int(count)
+    if randomize_seed:
+        seeds = [random.randint(0, MAX_SEED) for _ in range(count)]
+    else:
+        seeds = [(int(float(seed)) + i) % (MAX_SEED + 1) for i in range(count)]
+    timings = {}
+    start_time = time.time()
+    *_, images = pipe.generate_variations(
+        prompt,
+        seeds,
+        width=width,
+        height=height,
+        num_inference_steps=num_inference_steps,
+        guidance_scale=0,
+        output_type="uint8",
+        timings=timings,
+    )
+    paths = encoder.save_many(list(images))
+    latency = format_latency(time.time()-start_time, timings)
+    if len(paths) < count:
+        latency += f" ({len(paths)} of {count} variations fit in memory)"
+    return [(path, f"Seed {s}") for path, s in zip(paths, seeds)], latency
+
+def busy_message(rejected):
+    return f"Server busy ({rejected.reason.replace('_', ' ')}), please try again"
+
+def stream_image(prompt, seed=42, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, randomize_seed=False, num_inference_steps=2, request: gr.Request = None):
+    session = request.session_hash if request else None
+    try:
+        with scheduler.admit("generate", session, estimate_cost(width, height, num_inference_steps)):
+            yield from generate_image(prompt, seed, width, height, randomize_seed, num_inference_steps, stream_previews=STREAM_PREVIEWS, session=session)
+    except AdmissionRejected as rejected:
+        yield gr.update(), gr.update(), busy_message(rejected)
+
+def request_variations(prompt, seed=42, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, randomize_seed=False, num_inference_steps=2, count=DEFAULT_VARIATIONS, request: gr.Request = None):
+    session = request.session_hash if request else None
+    try:
+        with scheduler.admit("generate", session, estimate_cost(width, height, num_inference_steps) * int(count)):
+            return generate_variations(prompt, seed, width, height, randomize_seed, num_inference_steps, count)
+    except AdmissionRejected as rejected:
+        return gr.update(), busy_message(rejected)
+
+def example_image(prompt):
+    # Examples are cached lazily: wait for the model instead of caching a "loading" placeholder for good
+    if not loader.wait():
+        raise gr.Error(loader.message())
+    try:
+        with scheduler.admit("generate", None, estimate_cost(DEFAULT_WIDTH, DEFAULT_HEIGHT, 2)):
+            *_, output = generate_image(prompt)
+    except AdmissionRejected as rejected:
+        raise gr.Error(busy_message(rejected))
+    return output
 
 # --- Gradio UI ---
 with gr.Blocks() as demo:
@@ -63,6 +330,7 @@ with gr.Blocks() as demo:
         with gr.Row():
             with gr.Column(scale=2.5):
                 result = gr.Image(label="Generated Image", show_label=False, interactive=False)
+                variations = gr.Gallery(label="Variations", columns=4, interactive=False)
             with gr.Column(scale=1):
                 prompt = gr.Text(
                     label="Prompt",
@@ -73,6 +341,7 @@ with gr.Blocks() as demo:
                 )
                 generateBtn = gr.Button("🖼️ Generate Image")
                 enhanceBtn = gr.Button("🚀 Enhance Image")
+                variationsBtn = gr.Button("🎲 Variations")
 
                 with gr.Column("Advanced Options"):
                     with gr.Row():
@@ -85,21 +354,32 @@ with gr.Blocks() as demo:
                         width = gr.Slider(label="Width", minimum=256, maximum=MAX_IMAGE_SIZE, step=32, value=DEFAULT_WIDTH)
                         height = gr.Slider(label="Height", minimum=256, maximum=MAX_IMAGE_SIZE, step=32, value=DEFAULT_HEIGHT)
                         num_inference_steps = gr.Slider(label="Inference Steps", minimum=1, maximum=4, step=1, value=DEFAULT_INFERENCE_STEPS)
+                    with gr.Row():
+                        variation_count = gr.Slider(label="Variations", minimum=2, maximum=MAX_VARIATIONS, step=1, value=DEFAULT_VARIATIONS)
 
         with gr.Row():
             gr.Markdown("### 🌟 Inspiration Gallery")
         with gr.Row():
             gr.Examples(
                 examples=examples,
-                fn=generate_image,
+                fn=example_image,
                 inputs=[prompt],
                 outputs=[result, seed, latency],
                 cache_examples="lazy" 
             )
 
-    def enhance_image(*args):
-        gr.Info("Enhancing Image") # currently just runs optimized pipeline for 2 steps. Further implementations later.
-        return next(generate_image(*args))
+    def enhance_image(prompt, seed, width, height, request: gr.Request = None):
+        gr.Info("Enhancing Image")
+        session = request.session_hash if request else None
+        try:
+            with scheduler.admit("enhance", session, estimate_cost(width * ENHANCE_UPSCALE, height * ENHANCE_UPSCALE, ENHANCE_STEPS)):
+                refined = refine_image(prompt, seed, width, height, session)
+                if refined is not None:
+                    return refined
+                # Nothing to refine (new session, changed prompt or expired latents): generate with 2 steps
+                return next(generate_image(prompt, seed, width, height, session=session))
+        except AdmissionRejected as rejected:
+            return gr.update(), gr.update(), busy_message(rejected)
 
     enhanceBtn.click(
         fn=enhance_image,
@@ -112,7 +392,7 @@ with gr.Blocks() as demo:
     )
 
     generateBtn.click(
-        fn=generate_image,
+        fn=stream_image,
         inputs=[prompt, seed, width, height, randomize_seed, num_inference_steps],
         outputs=[result, seed, latency],
         show_progress="full",
@@ -121,6 +401,16 @@ with gr.Blocks() as demo:
         concurrency_limit=None
     )
 
+    variationsBtn.click(
+        fn=request_variations,
+        inputs=[prompt, seed, width, height, randomize_seed, num_inference_steps, variation_count],
+        outputs=[variations, latency],
+        show_progress="full",
+        api_name="Variations",
+        queue=False,
+        concurrency_limit=None
+    )
+
     def update_ui(realtime_enabled):
         return {
             prompt: gr.update(interactive=True),
@@ -135,12 +425,35 @@ with gr.Blocks() as demo:
         concurrency_limit=None
     )
 
-    def realtime_generation(*args):
-        if args[0]:  # If realtime is enabled
-            return next(generate_image(*args[1:]))
+    def realtime_generation(realtime_enabled, prompt, seed, width, height, randomize_seed, num_inference_steps, request: gr.Request = None):
+        if realtime_enabled:
+            session = request.session_hash if request else None
+            decision = prompt_reuse.decide(session, prompt, seed, width, height, num_inference_steps, randomize_seed)
+            if decision.action == SKIP:
+                # Only whitespace or trailing punctuation changed: the image on screen is already right
+                return gr.update(), gr.update(), gr.update()
+            try:
+                with scheduler.admit("realtime", session, estimate_cost(width, height, num_inference_steps)):
+                    output = None
+                    if decision.action == REUSE:
+                        if randomize_seed:
+                            seed = random.randint(0, MAX_SEED)
+                        output = reuse_image(prompt, seed, width, height, num_inference_steps, decision.strength, session)
+                        if output is None:
+                            # Latents expired: generate from noise
+                            prompt_reuse.forget(session)
+                            decision = decision._replace(action=FULL)
+                    if output is None:
+                        output = next(generate_image(prompt, seed, width, height, randomize_seed, num_inference_steps, session=session))
+            except AdmissionRejected:
+                # Stale or superseded keystroke: keep the current image
+                return gr.update(), gr.update(), gr.update()
+            if isinstance(output[0], str):  # A saved image, not a gr.update() of a superseded request
+                prompt_reuse.completed(session, decision)
+            return output
 
     prompt.submit(
-        fn=generate_image,
+        fn=stream_image,
         inputs=[prompt, seed, width, height, randomize_seed, num_inference_steps],
         outputs=[result, seed, latency],
         show_progress="full",
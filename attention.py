@@ -0,0 +1,168 @@
+"""
+Attention processor for the FLUX transformer whose attention kernel can be switched per request:
+
+    sdpa       torch's scaled_dot_product_attention with its default kernel choice
+    efficient  scaled_dot_product_attention restricted to the memory-efficient / flash kernels
+    chunked    exact attention computed for `chunk_size` queries at a time (bounded score matrix)
+    xformers   xformers' memory_efficient_attention, falling back to sdpa when xformers is missing
+    auto       one of the above from the image sequence length and the device (see `select_backend`)
+"""
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+import torch
+import torch.nn.functional as F
+from diffusers.models.embeddings import apply_rotary_emb
+
+try:
+    import xformers.ops as xops
+except ImportError:
+    xops = None
+
+SDPA = "sdpa"
+EFFICIENT = "efficient"
+CHUNKED = "chunked"
+XFORMERS = "xformers"
+AUTO = "auto"
+BACKENDS = (SDPA, EFFICIENT, CHUNKED, XFORMERS)
+
+AUTO_SDPA_MAX_SEQ_LEN = 4096  # Image tokens (1024x1024) up to which plain sdpa is chosen automatically
+DEFAULT_CHUNK_SIZE = 1024  # Queries per chunk for the chunked backend
+
+
+def xformers_available() -> bool:
+    return xops is not None
+
+
+def select_backend(image_seq_len: int, device_type: str, max_sdpa_seq_len: int = AUTO_SDPA_MAX_SEQ_LEN) -> str:
+    """Plain sdpa for short sequences; for long ones xformers or the efficient kernels on CUDA, chunking on CPU."""
+    if image_seq_len <= max_sdpa_seq_len:
+        return SDPA
+    if device_type == "cuda":
+        return XFORMERS if xformers_available() else EFFICIENT
+    return CHUNKED
+
+
+def _efficient_attention(query, key, value, attention_mask):
+    try:
+        from torch.nn.attention import SDPBackend, sdpa_kernel
+    except ImportError:  # torch < 2.3 has no kernel selection API
+        return F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask)
+    with sdpa_kernel([SDPBackend.EFFICIENT_ATTENTION, SDPBackend.FLASH_ATTENTION]):
+        return F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask)
+
+
+def _chunked_attention(query, key, value, attention_mask, chunk_size):
+    scale = query.shape[-1] ** -0.5
+    output = torch.empty_like(query)
+    key_t = key.transpose(-1, -2)
+    for start in range(0, query.shape[2], chunk_size):
+        end = start + chunk_size
+        scores = torch.matmul(query[:, :, start:end], key_t) * scale
+        if attention_mask is not None:
+            scores = scores + attention_mask[..., start:end, :]
+        output[:, :, start:end] = torch.matmul(scores.softmax(dim=-1), value)
+    return output
+
+
+def attention(query, key, value, backend: str = SDPA, attention_mask=None, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """Exact attention over (batch, heads, seq, head_dim) tensors with the given backend."""
+    if backend == XFORMERS and xops is not None and attention_mask is None:
+        output = xops.memory_efficient_attention(query.transpose(1, 2), key.transpose(1, 2), value.transpose(1, 2))
+        return output.transpose(1, 2)
+    if backend == EFFICIENT:
+        return _efficient_attention(query, key, value, attention_mask)
+    if backend == CHUNKED:
+        return _chunked_attention(query, key, value, attention_mask, chunk_size)
+    return F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False)
+
+
+class SelectableFluxAttnProcessor:
+    """
+    Drop-in replacement for diffusers' FluxAttnProcessor2_0 (joint and single-stream blocks alike) that
+    computes attention with the backend set by `use(...)` on the calling thread, else `default`.
+    """
+    def __init__(self, default: str = SDPA, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        if default not in BACKENDS:
+            raise ValueError(f"`default` must be one of {BACKENDS}, got {default!r}.")
+        self.default = default
+        self.chunk_size = chunk_size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.requests = Counter()
+
+    @contextmanager
+    def use(self, backend: str) -> Iterator[None]:
+        """Computes attention with `backend` for transformer calls made inside the block on this thread."""
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown attention backend {backend!r}; expected one of {BACKENDS}.")
+        previous = getattr(self._local, "backend", None)
+        self._local.backend = backend
+        try:
+            yield
+        finally:
+            self._local.backend = previous
+
+    def record(self, backend: str):
+        """Counts one request run with `backend`."""
+        with self._lock:
+            self.requests[backend] += 1
+
+    def __call__(
+        self,
+        attn,
+        hidden_states: torch.Tensor,
+        encoder_hidden_states: Optional[torch.Tensor] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        image_rotary_emb: Optional[torch.Tensor] = None,
+    ):
+        batch_size = hidden_states.shape[0]
+
+        def heads(projection):
+            return projection.view(batch_size, -1, attn.heads, projection.shape[-1] // attn.heads).transpose(1, 2)
+
+        query = heads(attn.to_q(hidden_states))
+        key = heads(attn.to_k(hidden_states))
+        value = heads(attn.to_v(hidden_states))
+        if attn.norm_q is not None:
+            query = attn.norm_q(query)
+        if attn.norm_k is not None:
+            key = attn.norm_k(key)
+
+        if encoder_hidden_states is not None:
+            # Joint blocks: text tokens first, then image tokens
+            context_query = heads(attn.add_q_proj(encoder_hidden_states))
+            context_key = heads(attn.add_k_proj(encoder_hidden_states))
+            context_value = heads(attn.add_v_proj(encoder_hidden_states))
+            if attn.norm_added_q is not None:
+                context_query = attn.norm_added_q(context_query)
+            if attn.norm_added_k is not None:
+                context_key = attn.norm_added_k(context_key)
+            query = torch.cat([context_query, query], dim=2)
+            key = torch.cat([context_key, key], dim=2)
+            value = torch.cat([context_value, value], dim=2)
+
+        if image_rotary_emb is not None:
+            query = apply_rotary_emb(query, image_rotary_emb)
+            key = apply_rotary_emb(key, image_rotary_emb)
+
+        backend = getattr(self._local, "backend", None) or self.default
+        hidden_states = attention(query, key, value, backend, attention_mask, self.chunk_size)
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * query.shape[-1]).to(query.dtype)
+
+        if encoder_hidden_states is None:
+            return hidden_states
+        context_len = encoder_hidden_states.shape[1]
+        encoder_hidden_states, hidden_states = hidden_states[:, :context_len], hidden_states[:, context_len:]
+        hidden_states = attn.to_out[1](attn.to_out[0](hidden_states))
+        encoder_hidden_states = attn.to_add_out(encoder_hidden_states)
+        return hidden_states, encoder_hidden_states
+
+    def stats(self) -> Dict[str, Any]:
+        """Requests per backend and whether xformers is importable."""
+        with self._lock:
+            result: Dict[str, Any] = {f"requests_{backend}": self.requests[backend] for backend in BACKENDS}
+        result["xformers_available"] = int(xformers_available())
+        return result
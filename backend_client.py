@@ -0,0 +1,248 @@
+import random
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from gradio_client import Client
+
+from profiling import NULL_TRACE, Trace
+
+# Job status (gradio_client.utils.Status names) -> phase recorded in a request trace
+JOB_PHASES = {
+    "STARTING": "upload",
+    "SENDING_DATA": "upload",
+    "JOINING_QUEUE": "queue",
+    "QUEUE_FULL": "queue",
+    "IN_QUEUE": "queue",
+    "PROCESSING": "compute",
+    "ITERATING": "compute",
+    "PROGRESS": "compute",
+    "FINISHED": "download",  # The client fetches the result files before the job counts as done
+}
+
+
+class RequestCancelled(Exception):
+    """Raised when a call is superseded by a newer request from the same session."""
+
+
+class BackendPool:
+    """
+    Lazily connected pool of `gradio_client.Client`s for one Space or URL.
+
+    Calls go through `Client.submit` so they can be streamed, cancelled when the same session sends a
+    newer request, bounded by a per-call timeout, retried a bounded number of times and optionally
+    hedged: if no result arrived after `hedge_after` seconds the call is duplicated on another client
+    and the first result wins.
+
+    Calls passed a `profiling.Trace` record connect and submit spans plus the upload, queue, compute and
+    download phases of the job, observed from its status while polling.
+    """
+    def __init__(
+        self,
+        src: str,
+        size: int = 2,
+        timeout: float = 60.0,
+        retries: int = 2,
+        retry_backoff: float = 0.5,
+        hedge_after: Optional[float] = None,
+        poll_interval: float = 0.01,
+        **client_kwargs,
+    ):
+        if size < 1:
+            raise ValueError("`size` must be at least 1.")
+        self.src = src
+        self.size = size
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.hedge_after = hedge_after
+        self.poll_interval = poll_interval
+        self.client_kwargs = {"verbose": False, **client_kwargs}
+        self._clients: List[Optional[Client]] = [None] * size
+        self._in_flight = [0] * size
+        self._lock = threading.Lock()
+        self._connect_locks = [threading.Lock() for _ in range(size)]
+        self._sessions: Dict[str, threading.Event] = {}
+
+    def _client(self, index: int, trace: Trace = NULL_TRACE) -> Client:
+        """Returns the client at `index`, connecting it on first use."""
+        client = self._clients[index]
+        if client is None:
+            with self._connect_locks[index], trace.span("connect", src=self.src):
+                client = self._clients[index]
+                if client is None:
+                    client = self._clients[index] = Client(self.src, **self.client_kwargs)
+        return client
+
+    @staticmethod
+    def _observe(job, trace: Trace):
+        """Moves `trace` to the phase matching the job's current status."""
+        if trace is not NULL_TRACE:
+            phase = JOB_PHASES.get(job.status().code.name)
+            if phase is not None:
+                trace.enter(phase)
+
+    def connect(self, count: Optional[int] = None):
+        """Eagerly connects the first `count` clients (all by default)."""
+        for index in range(count or self.size):
+            self._client(index)
+
+    def _acquire(self, exclude: Tuple[int, ...] = ()) -> int:
+        """Picks the least busy client, preferring ones that are already connected."""
+        with self._lock:
+            candidates = [i for i in range(self.size) if i not in exclude] or list(range(self.size))
+            index = min(candidates, key=lambda i: (self._in_flight[i], self._clients[i] is None, random.random()))
+            self._in_flight[index] += 1
+        return index
+
+    def _release(self, index: int):
+        with self._lock:
+            self._in_flight[index] -= 1
+
+    def _begin_session(self, session: Optional[str]) -> threading.Event:
+        """Cancels the previous call of `session` and returns the cancel flag of the new one."""
+        cancelled = threading.Event()
+        if session is not None:
+            with self._lock:
+                previous = self._sessions.get(session)
+                self._sessions[session] = cancelled
+            if previous is not None:
+                previous.set()
+        return cancelled
+
+    def _end_session(self, session: Optional[str], cancelled: threading.Event):
+        if session is not None:
+            with self._lock:
+                if self._sessions.get(session) is cancelled:
+                    del self._sessions[session]
+
+    def cancel(self, session: str):
+        """Cancels the running call of `session`, if any."""
+        with self._lock:
+            cancelled = self._sessions.pop(session, None)
+        if cancelled is not None:
+            cancelled.set()
+
+    def predict(self, *args, api_name: str, session: Optional[str] = None, trace: Trace = NULL_TRACE, **kwargs) -> Any:
+        """Blocking call with timeout, bounded retries and optional hedging. Returns the final output."""
+        cancelled = self._begin_session(session)
+        try:
+            error: Optional[BaseException] = None
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+                    trace.annotate(attempts=attempt + 1)
+                try:
+                    return self._predict_once(args, kwargs, api_name, cancelled, trace)
+                except RequestCancelled:
+                    raise
+                except Exception as e:
+                    error = e
+            raise error
+        finally:
+            self._end_session(session, cancelled)
+
+    def _submit(self, args, kwargs, api_name, exclude: Tuple[int, ...] = (), trace: Trace = NULL_TRACE):
+        """Submits the call on the least busy client and returns (index, job)."""
+        index = self._acquire(exclude)
+        try:
+            client = self._client(index, trace)
+            with trace.span("submit", api_name=api_name):
+                return index, client.submit(*args, api_name=api_name, **kwargs)
+        except Exception:
+            self._release(index)
+            raise
+
+    def _predict_once(self, args, kwargs, api_name, cancelled: threading.Event, trace: Trace = NULL_TRACE) -> Any:
+        start_time = time.time()
+        jobs = [self._submit(args, kwargs, api_name, trace=trace)]
+        hedged = False
+        try:
+            error: Optional[BaseException] = None
+            while True:
+                for index, job in list(jobs):
+                    if job.done():
+                        trace.enter(None)
+                        try:
+                            return job.result()
+                        except Exception as e:
+                            # Keep waiting while a hedged twin is still running
+                            error = e
+                            jobs.remove((index, job))
+                            self._release(index)
+                if not jobs:
+                    raise error
+                self._observe(jobs[0][1], trace)
+                elapsed = time.time() - start_time
+                if cancelled.is_set():
+                    raise RequestCancelled()
+                if elapsed > self.timeout:
+                    raise TimeoutError(f"{api_name} did not finish within {self.timeout:.1f} seconds")
+                if self.hedge_after is not None and not hedged and self.size > 1 and elapsed > self.hedge_after:
+                    hedged = True
+                    trace.annotate(hedged=True)
+                    try:
+                        jobs.append(self._submit(args, kwargs, api_name, exclude=(jobs[0][0],)))
+                    except Exception:
+                        pass  # The primary call is still running
+                time.sleep(self.poll_interval)
+        finally:
+            for index, job in jobs:
+                if not job.done():
+                    job.cancel()
+                self._release(index)
+
+    def stream(self, *args, api_name: str, session: Optional[str] = None, trace: Trace = NULL_TRACE, **kwargs) -> Iterator[Any]:
+        """Yields partial outputs of a generator endpoint as they arrive, then the final output."""
+        cancelled = self._begin_session(session)
+        index = self._acquire()
+        job = None
+        try:
+            client = self._client(index, trace)
+            with trace.span("submit", api_name=api_name):
+                job = client.submit(*args, api_name=api_name, **kwargs)
+            start_time = time.time()
+            seen = 0
+            while not job.done():
+                self._observe(job, trace)
+                outputs = job.outputs()
+                for output in outputs[seen:]:
+                    yield output
+                seen = len(outputs)
+                if cancelled.is_set():
+                    raise RequestCancelled()
+                if time.time() - start_time > self.timeout:
+                    raise TimeoutError(f"{api_name} did not finish within {self.timeout:.1f} seconds")
+                time.sleep(self.poll_interval)
+            trace.enter(None)
+            result = job.result()
+            outputs = job.outputs()
+            for output in outputs[seen:]:
+                yield output
+            if not outputs:
+                yield result
+        finally:
+            if job is not None and not job.done():
+                job.cancel()
+            self._release(index)
+            self._end_session(session, cancelled)
+
+    @property
+    def load(self) -> int:
+        """Calls currently in flight on this pool."""
+        return sum(self._in_flight)
+
+    def probe(self):
+        """Health check: opens a fresh client (fetching the app config) and keeps it. Raises when unreachable."""
+        client = Client(self.src, **self.client_kwargs)
+        with self._lock:
+            index = min(range(self.size), key=lambda i: self._in_flight[i])
+            if self._in_flight[index] == 0:
+                self._clients[index] = client
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns connection and in-flight counts per client."""
+        return {
+            "connected": sum(client is not None for client in self._clients),
+            "in_flight": list(self._in_flight),
+        }
@@ -0,0 +1,290 @@
+"""
+Headless batch generation from a JSONL job file, one job per line:
+
+    {"id": "cat-1", "prompt": "a cat on the moon", "seed": 1, "width": 1024, "height": 768, "steps": 2}
+
+Only `prompt` is required (`size` may replace width/height, e.g. "1024x768" or 1024). Jobs are read as a
+stream, grouped by (width, height, steps) and run as batches on the local pipeline or as concurrent calls
+to one or more remote Spaces:
+
+    python batch_generate.py jobs.jsonl --output-dir renders --batch-size 4
+    python batch_generate.py jobs.jsonl --output-dir renders --remote KingNish/Realtime-FLUX --concurrency 8
+
+Images and `manifest.jsonl` (one line per finished job) are written as jobs complete; the manifest doubles
+as the checkpoint, so running the same command again skips finished jobs. Malformed lines and failed
+batches are reported and counted as failed without stopping the run; the next run retries failed jobs.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+MAX_SEED = 2 ** 31 - 1
+DEFAULT_SIZE = 1024
+DEFAULT_STEPS = 4
+GROUP_WINDOW = 256  # Jobs read ahead to find batch-mates of the same shape
+REPORT_INTERVAL = 10.0  # Seconds between progress lines
+
+MANIFEST_NAME = "manifest.jsonl"
+
+
+def parse_job(line: str, line_number: int) -> Dict[str, Any]:
+    """Validates one JSONL line and fills in defaults (id = line number, random seed)."""
+    job = json.loads(line)
+    if not isinstance(job, dict) or not job.get("prompt"):
+        raise ValueError(f"Line {line_number}: a job needs a non-empty `prompt`.")
+    size = job.get("size")
+    if isinstance(size, str):
+        width, height = (int(v) for v in size.lower().split("x"))
+    elif size is not None:
+        width = height = int(size)
+    else:
+        width, height = int(job.get("width", DEFAULT_SIZE)), int(job.get("height", DEFAULT_SIZE))
+    seed = job.get("seed")
+    return {
+        "id": str(job.get("id", line_number)),
+        "prompt": job["prompt"],
+        "seed": int(seed) if seed is not None else random.randint(0, MAX_SEED),
+        "width": width,
+        "height": height,
+        "steps": int(job.get("steps", DEFAULT_STEPS)),
+    }
+
+
+def read_jobs(path: str, done: Set[str], progress: Optional["Progress"] = None) -> Iterator[Dict[str, Any]]:
+    """Streams the jobs of `path` that are not in `done`; malformed lines are reported, counted as failed and skipped."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if line.strip():
+                try:
+                    job = parse_job(line, line_number)
+                except (ValueError, TypeError) as e:
+                    print(f"Skipping line {line_number}: {e}", flush=True)
+                    if progress is not None:
+                        progress.add(images=0, failed=1)
+                    continue
+                if job["id"] not in done:
+                    yield job
+
+
+def group_jobs(jobs: Iterator[Dict[str, Any]], batch_size: int, window: int = GROUP_WINDOW) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Groups a stream of jobs into batches of the same (width, height, steps). Full batches are emitted as
+    soon as they fill up; once `window` jobs are pending, the oldest shape is flushed even if partial.
+    """
+    pending: "OrderedDict[Tuple[int, int, int], List[Dict[str, Any]]]" = OrderedDict()
+    count = 0
+    for job in jobs:
+        key = (job["width"], job["height"], job["steps"])
+        batch = pending.setdefault(key, [])
+        batch.append(job)
+        count += 1
+        if len(batch) >= batch_size:
+            count -= len(pending.pop(key))
+            yield batch
+        elif count >= window:
+            _, oldest = pending.popitem(last=False)
+            count -= len(oldest)
+            yield oldest
+    yield from pending.values()
+
+
+class Manifest:
+    """Append-only JSONL record of finished jobs; each line is flushed to disk before the job counts as done."""
+    def __init__(self, output_dir: str):
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self._lock = threading.Lock()
+
+    def done(self) -> Set[str]:
+        """Ids of the jobs finished by earlier runs (a torn last line is ignored)."""
+        if not os.path.exists(self.path):
+            return set()
+        done = set()
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)["id"])
+                except (ValueError, KeyError):
+                    pass
+        return done
+
+    def append(self, record: Dict[str, Any]):
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def _write_atomic(path: str, data: bytes):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _safe_name(job_id: str) -> str:
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in job_id)
+
+
+class Progress:
+    """Counts finished images and prints images/sec every `interval` seconds."""
+    def __init__(self, interval: float = REPORT_INTERVAL):
+        self.interval = interval
+        self.start_time = time.time()
+        self.last_report = self.start_time
+        self.images = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def add(self, images: int = 1, failed: int = 0):
+        with self._lock:
+            self.images += images
+            self.failed += failed
+            now = time.time()
+            if now - self.last_report >= self.interval:
+                self.last_report = now
+                print(f"{self.images} images ({self.failed} failed), {self.images_per_second():.2f} images/s", flush=True)
+
+    def images_per_second(self) -> float:
+        elapsed = time.time() - self.start_time
+        return self.images / elapsed if elapsed > 0 else 0.0
+
+
+def run_local(args, batches: Iterator[List[Dict[str, Any]]], manifest: Manifest, progress: Progress):
+    """Runs every batch through one local pipeline; encoding and writing overlap with the next batch."""
+    import torch
+
+    from custom_pipeline import FLUXPipelineWithIntermediateOutputs
+    from encoding import ImageEncoder
+
+    device = args.device or ("cuda" if torch.cuda.is_available() else "cpu")
+    dtype = getattr(torch, args.dtype or ("float16" if device == "cuda" else "bfloat16"))
+    pipe = FLUXPipelineWithIntermediateOutputs.from_pretrained(args.model, torch_dtype=dtype)
+    if device == "cpu":
+        pipe.enable_cpu_mode(dtype=dtype, quantize=args.quantize, num_threads=args.threads)
+    else:
+        pipe.to(device)
+    pipe.enable_prompt_cache()
+    encoder = ImageEncoder(format=args.format, quality=args.quality)
+    writers = ThreadPoolExecutor(max_workers=4, thread_name_prefix="batch-writer")
+
+    def finish(job, image, seconds):
+        try:
+            path = os.path.join(args.output_dir, f"{_safe_name(job['id'])}.{args.format}")
+            _write_atomic(path, encoder.encode(image))
+            manifest.append({**job, "path": os.path.basename(path), "seconds": seconds})
+            progress.add()
+        except Exception as e:
+            print(f"Job {job['id']} failed: {e}", flush=True)
+            progress.add(images=0, failed=1)
+
+    for batch in batches:
+        start_time = time.time()
+        try:
+            *_, images = pipe.generate_images(
+                prompt=[job["prompt"] for job in batch],
+                guidance_scale=0,
+                num_inference_steps=batch[0]["steps"],
+                width=batch[0]["width"],
+                height=batch[0]["height"],
+                generator=[torch.Generator().manual_seed(job["seed"]) for job in batch],
+                output_type="uint8",
+                batch_output=True,
+            )
+        except Exception as e:
+            # Not in the manifest, so the next run retries these jobs
+            print(f"Jobs {', '.join(job['id'] for job in batch)} failed: {e}", flush=True)
+            progress.add(images=0, failed=len(batch))
+            continue
+        seconds = (time.time() - start_time) / len(batch)
+        for job, image in zip(batch, images):
+            writers.submit(finish, job, image, seconds)
+    writers.shutdown(wait=True)
+
+
+def run_remote(args, batches: Iterator[List[Dict[str, Any]]], manifest: Manifest, progress: Progress):
+    """Sends the jobs as concurrent `/RealtimeFlux` calls; result files are copied byte for byte."""
+    from dispatcher import Dispatcher
+
+    backend = Dispatcher([src.strip() for src in args.remote.split(",")], pool_size=max(1, args.concurrency))
+    slots = threading.Semaphore(args.concurrency * 2)  # Bounded read-ahead over the job stream
+
+    def one_job(job):
+        start_time = time.time()
+        try:
+            result = backend.predict(
+                prompt=job["prompt"],
+                seed=job["seed"],
+                width=job["width"],
+                height=job["height"],
+                randomize_seed=False,
+                num_inference_steps=job["steps"],
+                api_name="/RealtimeFlux",
+                affinity=job["prompt"],
+            )
+            ext = os.path.splitext(result[0])[1] or ".png"
+            path = os.path.join(args.output_dir, _safe_name(job["id"]) + ext)
+            tmp_path = path + ".tmp"
+            shutil.copyfile(result[0], tmp_path)
+            os.replace(tmp_path, path)
+            manifest.append({**job, "path": os.path.basename(path), "seconds": time.time() - start_time})
+            progress.add()
+        except Exception as e:
+            print(f"Job {job['id']} failed: {e}", flush=True)
+            progress.add(images=0, failed=1)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="batch-remote") as executor:
+        for batch in batches:
+            for job in batch:
+                slots.acquire()
+                executor.submit(one_job, job)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("jobs", help="JSONL file with one job per line")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--batch-size", type=int, default=4, help="Jobs of the same shape denoised together (local)")
+    parser.add_argument("--remote", help="Comma-separated Spaces/URLs to call instead of the local pipeline")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent remote calls")
+    parser.add_argument("--model", default="black-forest-labs/FLUX.1-schnell")
+    parser.add_argument("--device", help="Default: cuda when available, else cpu")
+    parser.add_argument("--dtype", choices=["float16", "bfloat16", "float32"], help="Default: float16 on CUDA, bfloat16 on CPU")
+    parser.add_argument("--quantize", action="store_true", help="On CPU: int8 dynamic quantization of the transformer")
+    parser.add_argument("--threads", type=int, help="On CPU: torch intra-op threads")
+    parser.add_argument("--format", default="webp", choices=["webp", "jpeg", "png"])
+    parser.add_argument("--quality", type=int, default=90)
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest = Manifest(args.output_dir)
+    done = manifest.done()
+    if done:
+        print(f"Resuming: {len(done)} jobs already finished", flush=True)
+    progress = Progress()
+    batches = group_jobs(read_jobs(args.jobs, done, progress), args.batch_size)
+    if args.remote:
+        run_remote(args, batches, manifest, progress)
+    else:
+        run_local(args, batches, manifest, progress)
+    summary = {
+        "images": progress.images,
+        "failed": progress.failed,
+        "seconds": time.time() - progress.start_time,
+        "images_per_second": progress.images_per_second(),
+    }
+    print(json.dumps(summary), flush=True)
+
+
+if __name__ == "__main__":
+    main()
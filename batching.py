@@ -0,0 +1,165 @@
+import threading
+import time
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import torch
+
+from sessions import GenerationCancelled, GenerationToken
+
+
+class _PendingRequest:
+    """A single caller waiting for its image from a micro-batch."""
+    def __init__(self, prompt: str, seed: int, cancel_token: Optional[GenerationToken] = None):
+        self.prompt = prompt
+        self.seed = seed
+        self.cancel_token = cancel_token
+        self.start_time = time.time()
+        self.done = threading.Event()
+        self.image: Any = None
+        self.error: Optional[BaseException] = None
+        self.latency: float = 0.0
+        self.timings: Optional[Dict[str, float]] = None
+        self.store_key: Optional[Hashable] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_token is not None and self.cancel_token.cancelled
+
+
+class _BatchToken(GenerationToken):
+    """Cancels a batched loop only once every request in it was superseded."""
+    def __init__(self, requests: List[_PendingRequest]):
+        super().__init__()
+        self.requests = requests
+
+    @property
+    def cancelled(self) -> bool:
+        return all(r.cancelled for r in self.requests)
+
+
+class _Batch:
+    """Requests sharing one (height, width, steps, guidance) shape, collected by the first caller."""
+    def __init__(self):
+        self.requests: List[_PendingRequest] = []
+        self.full = threading.Event()
+
+
+class MicroBatcher:
+    """
+    Groups concurrent `generate_images` requests with the same shape into one batched denoising loop.
+
+    The first caller of a shape becomes the batch leader: it waits up to `max_wait` seconds (or until
+    `max_batch_size` requests joined), runs the batch on its own thread and hands every follower its
+    image. Each request keeps its own seed, so results match an unbatched run with the same generator.
+    """
+    def __init__(self, pipe, max_batch_size: int = 4, max_wait: float = 0.02, **generate_kwargs):
+        if max_batch_size < 1:
+            raise ValueError("`max_batch_size` must be at least 1.")
+        self.pipe = pipe
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.generate_kwargs = generate_kwargs
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()  # One batched loop on the device at a time
+        self._open: Dict[Tuple, _Batch] = {}
+        self.batches = 0
+        self.requests = 0
+
+    def submit(
+        self,
+        prompt: str,
+        seed: int,
+        width: int,
+        height: int,
+        num_inference_steps: int,
+        guidance_scale: float = 0.0,
+        cancel_token: Optional[GenerationToken] = None,
+        timings: Optional[Dict[str, float]] = None,
+        store_key: Optional[Hashable] = None,
+    ) -> Tuple[Any, float]:
+        """
+        Generates one image, possibly batched with concurrent requests. Returns (image, latency).
+        Raises `GenerationCancelled` if `cancel_token` was cancelled before the image was decoded.
+        Stage latencies of the batch the request ran in are added to `timings` when given, and the final
+        latents are kept under `store_key` when the pipeline's latent store is enabled.
+        """
+        request = _PendingRequest(prompt, int(float(seed)), cancel_token)
+        request.timings = timings
+        request.store_key = store_key
+        key = (int(height), int(width), int(num_inference_steps), float(guidance_scale))
+
+        with self._lock:
+            batch = self._open.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._open[key] = _Batch()
+            batch.requests.append(request)
+            if len(batch.requests) >= self.max_batch_size:
+                # Close the batch so later callers start a new one
+                del self._open[key]
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.max_wait)
+            with self._lock:
+                if self._open.get(key) is batch:
+                    del self._open[key]
+            self._run(batch, *key)
+        else:
+            request.done.wait()
+
+        if request.error is not None:
+            raise request.error
+        if request.image is None:
+            raise GenerationCancelled()
+        return request.image, request.latency
+
+    def _run(self, batch: _Batch, height: int, width: int, num_inference_steps: int, guidance_scale: float):
+        """Runs one batched generation and distributes the results."""
+        # Requests superseded while waiting never reach the model
+        requests = [r for r in batch.requests if not r.cancelled]
+        token = _BatchToken(requests)
+        timings: Dict[str, float] = {}
+        try:
+            if requests:
+                generators = [torch.Generator().manual_seed(r.seed) for r in requests]
+                with self._run_lock:
+                    outputs = list(self.pipe.generate_images(
+                        prompt=[r.prompt for r in requests],
+                        guidance_scale=guidance_scale,
+                        num_inference_steps=num_inference_steps,
+                        width=width,
+                        height=height,
+                        generator=generators,
+                        batch_output=True,
+                        cancel_token=token,
+                        timings=timings,
+                        store_key=[r.store_key for r in requests],
+                        **self.generate_kwargs,
+                    ))
+                if outputs:
+                    for request, image in zip(requests, outputs[-1]):
+                        if not request.cancelled:
+                            request.image = image
+        except Exception as e:
+            for request in requests:
+                request.error = e
+        finally:
+            with self._lock:
+                self.batches += 1 if requests else 0
+                self.requests += len(requests)
+            for request in batch.requests:
+                if request.cancel_token is not None and request in requests:
+                    request.cancel_token.steps_done = token.steps_done
+                if request.timings is not None:
+                    request.timings.update(timings)
+                request.latency = time.time() - request.start_time
+                request.done.set()
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns batch counters and the mean batch size."""
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+        }
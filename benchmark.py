@@ -0,0 +1,752 @@
+"""
+Offline CPU benchmarks for FLUXPipelineWithIntermediateOutputs and the app handlers.
+
+Pipelines are built from tiny random-weight configs, so nothing is downloaded:
+
+    python benchmark.py setup --iterations 2000
+    python benchmark.py pipeline --resolutions 256 512 1024 --steps 1 2 4 --batch-sizes 1 4
+    python benchmark.py batching --requests 4 --resolution 256 --steps 2
+    python benchmark.py app --concurrency 8 --requests 64 --backends 1
+    python benchmark.py app --concurrency 8 --requests 64 --backends 4
+    python benchmark.py compile --requests 32 --bucket-sides 256 512
+    python benchmark.py memory --resolutions 512 1024 2048 --batch-size 2
+    python benchmark.py encode --resolutions 1024 2048 --formats png webp jpeg
+    python benchmark.py admission --rate 40 --duration 10
+    python benchmark.py cpu --resolution 512 --num-layers 4 --head-dim 64 --threads 8
+    python benchmark.py attention --resolutions 256 512 1024 2048 --backends sdpa efficient chunked
+
+Results are printed (and optionally written with --output) as JSON so runs can be compared across changes.
+"""
+import argparse
+import copy
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from diffusers import AutoencoderKL, FlowMatchEulerDiscreteScheduler, FluxTransformer2DModel
+from tokenizers import Tokenizer, models, normalizers, pre_tokenizers
+from transformers import CLIPTextConfig, CLIPTextModel, PreTrainedTokenizerFast, T5Config, T5EncoderModel
+
+from admission import DEFAULT_LANES, AdmissionRejected, AdmissionScheduler, estimate_cost
+from attention import BACKENDS, SDPA
+from batching import MicroBatcher
+from custom_pipeline import FLUXPipelineWithIntermediateOutputs, calculate_timestep_shift, prepare_timesteps
+from encoding import ImageEncoder
+from memory_policy import FULL, SLICED, TILED, MemoryPolicy
+from metrics import Histogram, MetricsRegistry
+
+# Slider ranges of the apps
+MIN_IMAGE_SIZE = 256
+MAX_IMAGE_SIZE = 2048
+IMAGE_SIZE_STEP = 32
+MAX_INFERENCE_STEPS = 4
+
+TINY_VOCAB = ["<pad>", "<unk>", "</s>"] + "a an the of in on with and cat dog city moon sign egg house lion photo".split()
+
+
+def _tiny_tokenizer(model_max_length: int) -> PreTrainedTokenizerFast:
+    tokenizer = Tokenizer(models.WordLevel({token: i for i, token in enumerate(TINY_VOCAB)}, unk_token="<unk>"))
+    tokenizer.normalizer = normalizers.Lowercase()
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        pad_token="<pad>",
+        unk_token="<unk>",
+        eos_token="</s>",
+        model_max_length=model_max_length,
+    )
+
+
+def _rope_axes(attention_head_dim: int) -> tuple:
+    """Even rotary dims per position axis summing to the head dim, e.g. (4, 6, 6) for 16."""
+    side = (3 * attention_head_dim // 8) // 2 * 2
+    return (attention_head_dim - 2 * side, side, side)
+
+
+def build_tiny_pipeline(
+    seed: int = 0, dtype: torch.dtype = torch.float32, num_layers: int = 1, attention_head_dim: int = 16
+) -> FLUXPipelineWithIntermediateOutputs:
+    """Builds a FLUX pipeline with the real architecture but tiny random weights (CPU friendly, no downloads)."""
+    torch.manual_seed(seed)
+    transformer = FluxTransformer2DModel(
+        patch_size=1,
+        in_channels=64,
+        num_layers=num_layers,
+        num_single_layers=num_layers,
+        attention_head_dim=attention_head_dim,
+        num_attention_heads=2,
+        joint_attention_dim=32,
+        pooled_projection_dim=32,
+        guidance_embeds=False,
+        axes_dims_rope=_rope_axes(attention_head_dim),
+    )
+    vae = AutoencoderKL(
+        in_channels=3,
+        out_channels=3,
+        down_block_types=("DownEncoderBlock2D",) * 4,
+        up_block_types=("UpDecoderBlock2D",) * 4,
+        block_out_channels=(8, 8, 8, 8),
+        layers_per_block=1,
+        latent_channels=16,
+        norm_num_groups=4,
+        scaling_factor=0.3611,
+        shift_factor=0.1159,
+        use_quant_conv=False,
+        use_post_quant_conv=False,
+    )
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        vocab_size=len(TINY_VOCAB),
+        hidden_size=32,
+        intermediate_size=37,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        max_position_embeddings=77,
+        projection_dim=32,
+        pad_token_id=0,
+        bos_token_id=1,
+        eos_token_id=2,
+    ))
+    text_encoder_2 = T5EncoderModel(T5Config(
+        vocab_size=len(TINY_VOCAB),
+        d_model=32,
+        d_ff=37,
+        d_kv=8,
+        num_layers=2,
+        num_heads=4,
+    ))
+    scheduler = FlowMatchEulerDiscreteScheduler(num_train_timesteps=1000, shift=1.0, use_dynamic_shifting=False)
+    pipe = FLUXPipelineWithIntermediateOutputs(
+        scheduler=scheduler,
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=_tiny_tokenizer(77),
+        text_encoder_2=text_encoder_2,
+        tokenizer_2=_tiny_tokenizer(512),
+        transformer=transformer,
+    )
+    return pipe.to("cpu", dtype)
+
+
+def slider_shapes():
+    """All (height, width) pairs the width/height sliders can produce."""
+    sizes = range(MIN_IMAGE_SIZE, MAX_IMAGE_SIZE + 1, IMAGE_SIZE_STEP)
+    return [(h, w) for h in sizes for w in sizes]
+
+
+def bench_setup(args) -> dict:
+    """Per-request setup cost (latent ids, sigmas, mu, timesteps, guidance) with and without the precompute cache."""
+    pipe = build_tiny_pipeline()
+    device, dtype = pipe._execution_device, pipe.transformer.dtype
+    rng = random.Random(args.seed)
+    requests = [(*rng.choice(slider_shapes()), rng.randint(1, MAX_INFERENCE_STEPS)) for _ in range(args.iterations)]
+
+    def uncached(height, width, num_inference_steps):
+        latent_height = 2 * (height // (pipe.vae_scale_factor * 2))
+        latent_width = 2 * (width // (pipe.vae_scale_factor * 2))
+        pipe._prepare_latent_image_ids(1, latent_height // 2, latent_width // 2, device, dtype)
+        sigmas = np.linspace(1.0, 1 / num_inference_steps, num_inference_steps)
+        mu = calculate_timestep_shift((latent_height // 2) * (latent_width // 2))
+        prepare_timesteps(pipe.scheduler, num_inference_steps, device, None, sigmas, mu=mu)
+        torch.full([1], 0.0, device=device, dtype=torch.float32)
+
+    def cached(height, width, num_inference_steps):
+        precomputed = pipe._get_precomputed(height, width, num_inference_steps, device, dtype, 0.0)
+        copy.copy(precomputed.scheduler)
+
+    results = {}
+    for name, fn in (("uncached", uncached), ("cached", cached)):
+        for request in requests:  # Warm-up; fills the cache for the cached variant
+            fn(*request)
+        start_time = time.perf_counter()
+        for request in requests:
+            fn(*request)
+        results[f"{name}_us_per_request"] = (time.perf_counter() - start_time) / len(requests) * 1e6
+    results["speedup"] = results["uncached_us_per_request"] / results["cached_us_per_request"]
+    results["cache"] = pipe.precompute_cache.stats()
+    return results
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far, in MiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _current_rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def _forked_peak(fn, queue):
+    """Runs in a forked child: `fn()`'s result and the growth of the peak RSS over the RSS at fork."""
+    baseline = _current_rss_bytes()
+    result = fn()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    queue.put((result, max(peak - baseline, 0)))
+
+
+def run_forked(fn):
+    """Runs `fn` in a forked child; returns its (picklable) result and the peak RSS growth it caused, in bytes."""
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    child = context.Process(target=_forked_peak, args=(fn, queue))
+    child.start()
+    result, peak = queue.get()
+    child.join()
+    return result, peak
+
+
+def _decode_peak(pipe, latents, memory, queue):
+    """Runs in a forked child: the growth of the peak RSS over the RSS at fork is the decode's peak."""
+    baseline = _current_rss_bytes()
+    pipe._vae_decode(pipe.vae, latents, memory)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    queue.put({**memory, "measured_peak_bytes": max(peak - baseline, 0)})
+
+
+def bench_memory(args) -> list:
+    """Estimated vs measured (CPU RSS) decode peak for full, sliced and tiled decodes chosen through the memory policy."""
+    pipe = build_tiny_pipeline(args.seed)
+    vae = pipe.vae
+    vae.tile_sample_min_size = args.tile_size
+    vae.tile_latent_min_size = args.tile_size // pipe.vae_scale_factor
+    context = multiprocessing.get_context("fork")
+    results = []
+    for resolution in args.resolutions:
+        size = resolution // pipe.vae_scale_factor
+        latents = torch.randn(args.batch_size, vae.config.latent_channels, size, size, generator=torch.Generator().manual_seed(args.seed))
+        estimates = MemoryPolicy(1).estimates(vae, args.batch_size, resolution, resolution, latents.element_size())
+        for mode in (FULL, SLICED, TILED):
+            # A budget equal to this mode's estimate makes the policy pick it (or a cheaper-to-run mode that also fits)
+            pipe.memory_policy = MemoryPolicy(estimates[mode])
+            queue = context.Queue()
+            child = context.Process(target=_decode_peak, args=(pipe, latents, {}, queue))
+            child.start()
+            report = queue.get()
+            child.join()
+            results.append({"resolution": resolution, "batch_size": args.batch_size, "budget_mode": mode, **report})
+            print(f"{resolution}px {mode}: chose {report['decode_mode']}, estimated "
+                  f"{report['estimated_peak_bytes'] / 2 ** 20:.0f} MiB, measured {report['measured_peak_bytes'] / 2 ** 20:.0f} MiB", flush=True)
+    pipe.memory_policy = None
+    return results
+
+
+def bench_pipeline(args) -> list:
+    """Throughput, per-stage latency and peak RSS of generate_images over resolution x steps x batch size."""
+    pipe = build_tiny_pipeline(args.seed)
+    pipe.enable_prompt_cache()
+    results = []
+    for resolution in args.resolutions:
+        for num_inference_steps in args.steps:
+            for batch_size in args.batch_sizes:
+                def run():
+                    generators = [torch.Generator().manual_seed(args.seed + i) for i in range(batch_size)]
+                    *_, images = pipe.generate_images(
+                        prompt=["a cat on the moon"] * batch_size,
+                        guidance_scale=0,
+                        num_inference_steps=num_inference_steps,
+                        width=resolution,
+                        height=resolution,
+                        generator=generators,
+                        batch_output=True,
+                    )
+                    return images
+
+                def measure():
+                    for _ in range(args.warmup):
+                        run()
+                    registry = MetricsRegistry()
+                    pipe.enable_metrics(registry, synchronize=False)
+                    latencies = Histogram()
+                    for _ in range(args.repeats):
+                        start_time = time.perf_counter()
+                        run()
+                        latencies.observe(time.perf_counter() - start_time)
+                    return {
+                        "images_per_second": batch_size * latencies.count / latencies.sum,
+                        "latency": latencies.summary(),
+                        "stages": registry.summary()["stages"],
+                    }
+
+                # Each configuration in its own child: the process-wide peak would otherwise stick at the largest one so far
+                report, peak = run_forked(measure)
+                results.append({
+                    "resolution": resolution,
+                    "steps": num_inference_steps,
+                    "batch_size": batch_size,
+                    **report,
+                    "peak_rss_mb": peak / 2 ** 20,
+                })
+                print(f"{resolution}px steps={num_inference_steps} batch={batch_size}: "
+                      f"{results[-1]['images_per_second']:.2f} images/s", flush=True)
+    return results
+
+
+def bench_batching(args) -> list:
+    """Checks that batched outputs (generate_images and MicroBatcher) match one unbatched run per seed."""
+    pipe = build_tiny_pipeline(args.seed)
+    prompts = ["a cat on the moon", "a lion in the city", "a house with a dog", "photo of an egg"]
+    requests = [(prompts[i % len(prompts)], args.seed + i) for i in range(args.requests)]
+    options = dict(guidance_scale=0, num_inference_steps=args.steps, width=args.resolution, height=args.resolution, output_type="np")
+
+    start_time = time.perf_counter()
+    unbatched = []
+    for prompt, seed in requests:
+        *_, image = pipe.generate_images(prompt=prompt, generator=torch.Generator().manual_seed(seed), **options)
+        unbatched.append(np.asarray(image))
+    unbatched_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    *_, images = pipe.generate_images(
+        prompt=[prompt for prompt, _ in requests],
+        generator=[torch.Generator().manual_seed(seed) for _, seed in requests],
+        batch_output=True,
+        **options,
+    )
+    batched = [np.asarray(image) for image in images]
+    batched_seconds = time.perf_counter() - start_time
+
+    # Concurrent submissions with a generous wait so they land in one micro-batch
+    batcher = MicroBatcher(pipe, max_batch_size=len(requests), max_wait=1.0, output_type="np")
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(requests)) as executor:
+        futures = [
+            executor.submit(batcher.submit, prompt, seed, args.resolution, args.resolution, args.steps)
+            for prompt, seed in requests
+        ]
+        micro_batched = [np.asarray(future.result()[0]) for future in futures]
+    micro_batched_seconds = time.perf_counter() - start_time
+
+    results = []
+    mismatches = []
+    for (prompt, seed), reference, batch_image, micro_image in zip(requests, unbatched, batched, micro_batched):
+        row = {
+            "prompt": prompt,
+            "seed": seed,
+            "batched_max_abs_error": float(np.abs(batch_image - reference).max()),
+            "micro_batched_max_abs_error": float(np.abs(micro_image - reference).max()),
+        }
+        results.append(row)
+        if not (np.allclose(batch_image, reference, atol=args.atol) and np.allclose(micro_image, reference, atol=args.atol)):
+            mismatches.append(seed)
+    results.append({
+        "unbatched_seconds": unbatched_seconds,
+        "batched_seconds": batched_seconds,
+        "micro_batched_seconds": micro_batched_seconds,
+        **batcher.stats(),
+    })
+    print(f"{len(requests)} requests: unbatched {unbatched_seconds:.2f}s, batched {batched_seconds:.2f}s, "
+          f"micro-batched {micro_batched_seconds:.2f}s (mean batch {batcher.stats()['mean_batch_size']:.1f})", flush=True)
+    assert not mismatches, f"Batched outputs differ from unbatched runs (atol={args.atol}) for seeds {mismatches}"
+    return results
+
+
+def bench_compile(args) -> dict:
+    """Random slider shapes through compiled mode: compilations stay bounded by the buckets used; eager for reference."""
+    rng = random.Random(args.seed)
+    max_size = max(args.bucket_sides)
+    shapes = [(h, w) for h, w in slider_shapes() if h <= max_size and w <= max_size]
+    requests = [rng.choice(shapes) for _ in range(args.requests)]
+    buckets = [(h, w) for h in args.bucket_sides for w in args.bucket_sides]
+
+    results = {"distinct_shapes": len(set(requests))}
+    for name in ("eager", "compiled"):
+        pipe = build_tiny_pipeline(args.seed)
+        pipe.enable_prompt_cache()
+        if name == "compiled":
+            pipe.enable_compiled_mode(buckets=buckets, policy=args.policy)
+        latencies = Histogram()
+        start_time = time.perf_counter()
+        for height, width in requests:
+            request_start = time.perf_counter()
+            *_, image = pipe.generate_images(
+                prompt="a cat on the moon",
+                guidance_scale=0,
+                num_inference_steps=args.steps,
+                width=width,
+                height=height,
+                generator=torch.Generator().manual_seed(args.seed),
+                output_type="np",
+            )
+            latencies.observe(time.perf_counter() - request_start)
+            # Eager runs at the requested size; compiled with "snap" returns the closest bucket
+            expected = (height, width)
+            if name == "compiled" and args.policy != "pad":
+                expected = pipe.resolution_buckets.select(height, width)[2:]
+            assert image.shape[:2] == tuple(expected), (image.shape, height, width)
+        results[name] = {
+            "total_seconds": time.perf_counter() - start_time,
+            "latency": latencies.summary(),
+        }
+        if pipe.resolution_buckets is not None:
+            results[name]["compile"] = pipe.resolution_buckets.stats()
+        print(f"{name}: {results[name]['total_seconds']:.1f}s for {args.requests} requests", flush=True)
+    return results
+
+
+def bench_encode(args) -> list:
+    """Seconds and bytes per image for each output format of the encoder pool, from uint8 pipeline output."""
+    pipe = build_tiny_pipeline(args.seed)
+    results = []
+    for resolution in args.resolutions:
+        *_, image = pipe.generate_images(
+            prompt="a cat on the moon",
+            guidance_scale=0,
+            num_inference_steps=1,
+            width=resolution,
+            height=resolution,
+            generator=torch.Generator().manual_seed(args.seed),
+            output_type="uint8",
+        )
+        for format in args.formats:
+            encoder = ImageEncoder(format=format, quality=args.quality, output_dir=tempfile.mkdtemp(prefix="flux_bench_"))
+            start_time = time.perf_counter()
+            encoder.save_many([image] * args.repeats)
+            elapsed = time.perf_counter() - start_time
+            results.append({
+                "resolution": resolution,
+                "format": format,
+                "seconds_per_image": elapsed / args.repeats,
+                "bytes_per_image": encoder.stats()["encoded_bytes"] / args.repeats,
+            })
+            print(f"{resolution}px {format}: {results[-1]['seconds_per_image'] * 1000:.1f} ms/image", flush=True)
+    return results
+
+
+def bench_admission(args) -> dict:
+    """Open-loop load (realtime keystrokes, generate, enhance) on a simulated serial device, with and without admission control."""
+    lanes = [("realtime", 0.7, 1), ("generate", 0.25, 4), ("enhance", 0.05, 2)]  # Lane, share of traffic, steps
+    results = {}
+    for admission in (False, True):
+        rng = random.Random(args.seed)
+        registry = MetricsRegistry()
+        scheduler = AdmissionScheduler(DEFAULT_LANES, registry=registry) if admission else None
+        device = threading.Lock()  # One request on the device at a time
+        latencies = {name: Histogram() for name, _, _ in lanes}
+        outcomes = {}
+        outcomes_lock = threading.Lock()
+
+        def one_request(lane, session, width, height, steps):
+            start_time = time.perf_counter()
+            cost = estimate_cost(width, height, steps)
+            try:
+                if scheduler is None:
+                    with device:
+                        time.sleep(cost * args.seconds_per_cost)
+                else:
+                    with scheduler.admit(lane, session, cost):
+                        with device:
+                            time.sleep(cost * args.seconds_per_cost)
+                outcome = "completed"
+                latencies[lane].observe(time.perf_counter() - start_time)
+            except AdmissionRejected as rejected:
+                outcome = rejected.reason
+            with outcomes_lock:
+                outcomes[f"{lane}_{outcome}"] = outcomes.get(f"{lane}_{outcome}", 0) + 1
+
+        threads = []
+        start_time = time.perf_counter()
+        while time.perf_counter() - start_time < args.duration:
+            time.sleep(rng.expovariate(args.rate))
+            lane, steps = rng.choices([(name, steps) for name, _, steps in lanes], [share for _, share, _ in lanes])[0]
+            size = rng.choice([512, 768, 1024])
+            thread = threading.Thread(target=one_request, args=(lane, f"session-{rng.randrange(args.sessions)}", size, size, steps))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        name = "admission" if admission else "unbounded"
+        results[name] = {
+            "seconds": time.perf_counter() - start_time,
+            "latency": {lane: histogram.summary() for lane, histogram in latencies.items()},
+            "outcomes": outcomes,
+            "queue_wait": registry.summary()["stages"],
+        }
+        print(f"{name}: " + ", ".join(f"{lane} p95 {h.quantile(0.95):.2f}s" for lane, h in latencies.items()), flush=True)
+    return results
+
+
+def _start_stub_backends(args) -> list:
+    """Starts `args.backends` stub Spaces as separate processes on consecutive ports and waits until they answer."""
+    processes, urls = [], []
+    for port in range(args.port, args.port + args.backends):
+        processes.append(subprocess.Popen([
+            sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_space.py"),
+            "--port", str(port),
+            "--seconds-per-megapixel-step", str(args.seconds_per_megapixel_step),
+            "--base-seconds", str(args.base_seconds),
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        urls.append(f"http://127.0.0.1:{port}/")
+    for url in urls:
+        deadline = time.time() + 60
+        while True:
+            try:
+                urllib.request.urlopen(url + "config", timeout=1)
+                break
+            except Exception:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.2)
+    os.environ["url_api"] = ",".join(urls)
+    return processes
+
+
+def bench_cpu(args) -> list:
+    """CPU mode variants (fp32, bf16, int8 dynamic) on a tiny model: throughput and error against the fp32 output."""
+    variants = [
+        ("fp32", dict(dtype=torch.float32)),
+        ("bf16", dict(dtype=torch.bfloat16)),
+        ("int8", dict(dtype=torch.float32, quantize=True)),
+        ("fp32_contiguous_vae", dict(dtype=torch.float32, channels_last=False)),
+    ]
+    prompts = ["a cat on the moon", "a lion in the city", "a house with a dog", "photo of an egg"]
+    reference = None
+    results = []
+    for name, options in variants:
+        pipe = build_tiny_pipeline(args.seed, num_layers=args.num_layers, attention_head_dim=args.head_dim)
+        pipe.enable_cpu_mode(num_threads=args.threads, **options)
+
+        def run():
+            *_, images = pipe.generate_images(
+                prompt=prompts,
+                guidance_scale=0,
+                num_inference_steps=args.steps,
+                width=args.resolution,
+                height=args.resolution,
+                generator=[torch.Generator().manual_seed(args.seed + i) for i in range(len(prompts))],
+                output_type="np",
+                batch_output=True,
+            )
+            return np.asarray(images, dtype=np.float32)
+
+        def measure():
+            images = run()  # Warm-up, and the output compared against fp32
+            start_time = time.perf_counter()
+            for _ in range(args.repeats):
+                run()
+            return images, time.perf_counter() - start_time
+
+        (images, elapsed), peak = run_forked(measure)
+        if reference is None:
+            reference = images
+        error = np.abs(images - reference)
+        mse = float((error ** 2).mean())
+        results.append({
+            "variant": name,
+            "images_per_second": len(prompts) * args.repeats / elapsed,
+            "max_abs_error": float(error.max()),
+            "mean_abs_error": float(error.mean()),
+            "psnr_db": float(10 * np.log10(1.0 / mse)) if mse > 0 else float("inf"),
+            "peak_rss_mb": peak / 2 ** 20,
+        })
+        print(f"{name}: {results[-1]['images_per_second']:.2f} images/s, psnr {results[-1]['psnr_db']:.1f} dB", flush=True)
+    return results
+
+
+def bench_app(args) -> dict:
+    """Drives app.py's handlers against `--backends` local stub Spaces (one process each) at a given concurrency."""
+    processes = _start_stub_backends(args)
+
+    import app
+    from result_cache import ResultCache
+
+    app.result_cache = ResultCache(cache_dir=tempfile.mkdtemp(prefix="flux_bench_"))
+    rng = random.Random(args.seed)
+    prompts = ["a cat on the moon", "a lion in the city", "a house with a dog"]
+
+    def one_request(i):
+        # A fixed seed pool makes part of the traffic hit the result cache
+        seed = rng.randrange(args.distinct_seeds) if args.distinct_seeds else i
+        start_time = time.perf_counter()
+        if rng.random() < args.enhance_fraction:
+            app.enhance_image(rng.choice(prompts), seed, args.resolution, args.resolution)
+        else:
+            for _ in app.generate_image(rng.choice(prompts), seed, args.resolution, args.resolution, False, args.steps):
+                pass
+        return time.perf_counter() - start_time
+
+    latencies = Histogram()
+    start_time = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            for latency in executor.map(one_request, range(args.requests)):
+                latencies.observe(latency)
+    finally:
+        for process in processes:
+            process.terminate()
+    elapsed = time.perf_counter() - start_time
+    return {
+        "backends": args.backends,
+        "dispatcher": app.backend.stats(),
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "requests_per_second": args.requests / elapsed,
+        "latency": latencies.summary(),
+        "result_cache": app.result_cache.stats(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def _attention_run(pipe, inputs, backend, repeats, queue):
+    """Runs in a forked child: times `repeats` transformer passes with `backend` and measures their peak RSS."""
+    baseline = _current_rss_bytes()
+    with pipe.attention_processor.use(backend):
+        output = pipe.transformer(**inputs, return_dict=False)[0]  # Warm-up
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            pipe.transformer(**inputs, return_dict=False)
+        elapsed = time.perf_counter() - start_time
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    queue.put({"seconds_per_pass": elapsed / repeats, "peak_bytes": max(peak - baseline, 0), "output": output.float().numpy()})
+
+
+def bench_attention(args) -> list:
+    """Transformer pass latency, peak RSS and error against sdpa per attention backend and resolution (CPU)."""
+    pipe = build_tiny_pipeline(args.seed, num_layers=args.num_layers, attention_head_dim=args.head_dim)
+    pipe.enable_attention_backend(SDPA, chunk_size=args.chunk_size)
+    generator = torch.Generator().manual_seed(args.seed)
+    context = multiprocessing.get_context("fork")
+    results = []
+    for resolution in args.resolutions:
+        latent_side = resolution // pipe.vae_scale_factor // 2
+        inputs = dict(
+            hidden_states=torch.randn(1, latent_side * latent_side, pipe.transformer.config.in_channels, generator=generator),
+            timestep=torch.tensor([1.0]),
+            guidance=None,
+            pooled_projections=torch.randn(1, pipe.transformer.config.pooled_projection_dim, generator=generator),
+            encoder_hidden_states=torch.randn(1, args.text_len, pipe.transformer.config.joint_attention_dim, generator=generator),
+            txt_ids=torch.zeros(args.text_len, 3),
+            img_ids=pipe._prepare_latent_image_ids(1, latent_side, latent_side, "cpu", torch.float32),
+        )
+        reference = None
+        for backend in [SDPA] + [b for b in args.backends if b != SDPA]:
+            queue = context.Queue()
+            child = context.Process(target=_attention_run, args=(pipe, inputs, backend, args.repeats, queue))
+            child.start()
+            report = queue.get()
+            child.join()
+            output = report.pop("output")
+            if reference is None:
+                reference = output
+            results.append({
+                "resolution": resolution,
+                "image_seq_len": latent_side * latent_side,
+                "backend": backend,
+                **report,
+                "max_abs_error": float(np.abs(output - reference).max()),
+            })
+            print(f"{resolution}px {backend}: {report['seconds_per_pass'] * 1000:.1f} ms/pass, "
+                  f"peak {report['peak_bytes'] / 2 ** 20:.0f} MiB", flush=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON results to this file as well as stdout")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+
+    setup = subparsers.add_parser("setup", help=bench_setup.__doc__)
+    setup.add_argument("--iterations", type=int, default=2000)
+    setup.set_defaults(fn=bench_setup)
+
+    pipeline = subparsers.add_parser("pipeline", help=bench_pipeline.__doc__)
+    pipeline.add_argument("--resolutions", type=int, nargs="+", default=[256, 512, 1024, 2048])
+    pipeline.add_argument("--steps", type=int, nargs="+", default=[1, 2, 4])
+    pipeline.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4])
+    pipeline.add_argument("--repeats", type=int, default=3)
+    pipeline.add_argument("--warmup", type=int, default=1)
+    pipeline.add_argument("--threads", type=int, help="torch intra-op threads (default: torch's choice)")
+    pipeline.set_defaults(fn=bench_pipeline)
+
+    batching = subparsers.add_parser("batching", help=bench_batching.__doc__)
+    batching.add_argument("--requests", type=int, default=4)
+    batching.add_argument("--resolution", type=int, default=256)
+    batching.add_argument("--steps", type=int, default=2)
+    batching.add_argument("--atol", type=float, default=1e-3, help="Allowed absolute difference per pixel (images in [0, 1])")
+    batching.set_defaults(fn=bench_batching)
+
+    compiled = subparsers.add_parser("compile", help=bench_compile.__doc__)
+    compiled.add_argument("--requests", type=int, default=32)
+    compiled.add_argument("--bucket-sides", type=int, nargs="+", default=[256, 512])
+    compiled.add_argument("--policy", choices=["pad", "snap"], default="pad")
+    compiled.add_argument("--steps", type=int, default=1)
+    compiled.set_defaults(fn=bench_compile)
+
+    memory = subparsers.add_parser("memory", help=bench_memory.__doc__)
+    memory.add_argument("--resolutions", type=int, nargs="+", default=[512, 1024, 2048])
+    memory.add_argument("--batch-size", type=int, default=2)
+    memory.add_argument("--tile-size", type=int, default=256)
+    memory.set_defaults(fn=bench_memory)
+
+    encode = subparsers.add_parser("encode", help=bench_encode.__doc__)
+    encode.add_argument("--resolutions", type=int, nargs="+", default=[1024, 2048])
+    encode.add_argument("--formats", nargs="+", default=["png", "webp", "jpeg"])
+    encode.add_argument("--quality", type=int, default=90)
+    encode.add_argument("--repeats", type=int, default=8)
+    encode.set_defaults(fn=bench_encode)
+
+    admission = subparsers.add_parser("admission", help=bench_admission.__doc__)
+    admission.add_argument("--rate", type=float, default=40.0, help="Requests per second")
+    admission.add_argument("--duration", type=float, default=10.0, help="Seconds of traffic")
+    admission.add_argument("--sessions", type=int, default=8)
+    admission.add_argument("--seconds-per-cost", type=float, default=0.05, help="Simulated device seconds per megapixel-step")
+    admission.set_defaults(fn=bench_admission)
+
+    cpu = subparsers.add_parser("cpu", help=bench_cpu.__doc__)
+    cpu.add_argument("--resolution", type=int, default=512)
+    cpu.add_argument("--steps", type=int, default=2)
+    cpu.add_argument("--repeats", type=int, default=3)
+    cpu.add_argument("--num-layers", type=int, default=4, help="Double and single stream blocks of the tiny transformer")
+    cpu.add_argument("--head-dim", type=int, default=64, help="Attention head dim of the tiny transformer (2 heads)")
+    cpu.add_argument("--threads", type=int, help="torch intra-op threads (default: torch's choice)")
+    cpu.set_defaults(fn=bench_cpu)
+
+    attention = subparsers.add_parser("attention", help=bench_attention.__doc__)
+    attention.add_argument("--resolutions", type=int, nargs="+", default=[256, 512, 1024, 2048])
+    attention.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    attention.add_argument("--repeats", type=int, default=3)
+    attention.add_argument("--text-len", type=int, default=300, help="Text tokens joined to the image tokens")
+    attention.add_argument("--chunk-size", type=int, default=1024, help="Queries per chunk for the chunked backend")
+    attention.add_argument("--num-layers", type=int, default=1, help="Double and single stream blocks of the tiny transformer")
+    attention.add_argument("--head-dim", type=int, default=64, help="Attention head dim of the tiny transformer (2 heads)")
+    attention.add_argument("--threads", type=int, help="torch intra-op threads (default: torch's choice)")
+    attention.set_defaults(fn=bench_attention)
+
+    app = subparsers.add_parser("app", help=bench_app.__doc__)
+    app.add_argument("--concurrency", type=int, default=8)
+    app.add_argument("--requests", type=int, default=64)
+    app.add_argument("--resolution", type=int, default=1024)
+    app.add_argument("--steps", type=int, default=1)
+    app.add_argument("--enhance-fraction", type=float, default=0.1)
+    app.add_argument("--distinct-seeds", type=int, default=0, help="Draw seeds from this many values (0: all unique)")
+    app.add_argument("--port", type=int, default=7861, help="Port of the first stub backend")
+    app.add_argument("--backends", type=int, default=1, help="Stub backends started on consecutive ports")
+    app.add_argument("--seconds-per-megapixel-step", type=float, default=0.2)
+    app.add_argument("--base-seconds", type=float, default=0.05)
+    app.set_defaults(fn=bench_app)
+
+    args = parser.parse_args()
+    torch.set_grad_enabled(False)
+    if getattr(args, "threads", None):
+        torch.set_num_threads(args.threads)
+    results = {"mode": args.mode, "torch": torch.__version__, "results": args.fn(args)}
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import threading
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple
+
+# Default buckets: every pair of 256-px multiples between 256 and 2048 (64 shapes instead of 3,249)
+BUCKET_SIDES = tuple(range(256, 2049, 256))
+DEFAULT_RESOLUTION_BUCKETS = [(h, w) for h in BUCKET_SIDES for w in BUCKET_SIDES]
+
+PAD = "pad"  # Run at the smallest bucket that covers the request, then crop to the requested size
+SNAP = "snap"  # Run and return at the closest bucket
+
+
+class ResolutionBuckets:
+    """
+    Maps requested (height, width) to a bounded set of run shapes so shape-specialized compiled kernels
+    are reused, and counts compilations (first use of a shape) versus hits.
+    """
+    def __init__(self, buckets: Optional[Sequence[Tuple[int, int]]] = None, policy: str = PAD):
+        if policy not in (PAD, SNAP):
+            raise ValueError(f"`policy` must be {PAD!r} or {SNAP!r}, got {policy!r}.")
+        self.buckets: List[Tuple[int, int]] = sorted(set(buckets or DEFAULT_RESOLUTION_BUCKETS))
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._seen = set()
+        self.compiles = 0
+        self.compile_seconds = 0.0
+        self.hits = 0
+        self.unbucketed = 0
+
+    def select(self, height: int, width: int) -> Tuple[int, int, int, int]:
+        """Returns (run_height, run_width, output_height, output_width) for a request."""
+        if self.policy == PAD:
+            covering = [b for b in self.buckets if b[0] >= height and b[1] >= width]
+            if not covering:
+                with self._lock:
+                    self.unbucketed += 1
+                return height, width, height, width
+            run_height, run_width = min(covering, key=lambda b: (b[0] * b[1], b))
+            return run_height, run_width, height, width
+        run_height, run_width = min(self.buckets, key=lambda b: (abs(b[0] - height) + abs(b[1] - width), b))
+        return run_height, run_width, run_height, run_width
+
+    def first_use(self, key: Hashable) -> bool:
+        """Records a use of a compiled shape; returns True the first time (i.e. when it compiles)."""
+        with self._lock:
+            if key in self._seen:
+                self.hits += 1
+                return False
+            self._seen.add(key)
+            self.compiles += 1
+            return True
+
+    def add_compile_time(self, seconds: float):
+        with self._lock:
+            self.compile_seconds += seconds
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns compile count/time, hit rate and the number of requests outside every bucket."""
+        uses = self.compiles + self.hits
+        return {
+            "buckets": len(self.buckets),
+            "compiles": self.compiles,
+            "compile_seconds": self.compile_seconds,
+            "hits": self.hits,
+            "hit_rate": self.hits / uses if uses else 0.0,
+            "unbucketed": self.unbucketed,
+        }
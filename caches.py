@@ -0,0 +1,131 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+def tensor_nbytes(value: Any) -> int:
+    """Returns the number of bytes held by a tensor or a (nested) tuple/list of tensors."""
+    if hasattr(value, "numel") and hasattr(value, "element_size"):
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(tensor_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(tensor_nbytes(v) for v in value.values())
+    return 0
+
+
+class SizedLRUCache:
+    """
+    Thread-safe LRU cache bounded both by number of entries and by total byte size, with an optional
+    time-to-live per entry. Keeps hit/miss/eviction counters so callers can report cache effectiveness.
+    """
+    def __init__(
+        self,
+        max_entries: int = 128,
+        max_bytes: Optional[int] = None,
+        sizeof: Callable[[Any], int] = tensor_nbytes,
+        ttl: Optional[float] = None,
+    ):
+        if max_entries < 1:
+            raise ValueError("`max_entries` must be at least 1.")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._sizeof = sizeof
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Returns the cached value for `key`, marking it as most recently used."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Stores `value` under `key`, evicting least recently used entries to fit the limits."""
+        nbytes = self._sizeof(value)
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            # Larger than the whole budget: never cacheable.
+            return
+        now = time.monotonic()
+        expires_at = now + self.ttl if self.ttl is not None else float("inf")
+        with self._lock:
+            if self.ttl is not None:
+                for expired in [k for k, entry in self._entries.items() if entry[2] < now]:
+                    self._remove(expired)
+                    self.expirations += 1
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, nbytes, expires_at)
+            self.total_bytes += nbytes
+            while len(self._entries) > self.max_entries or (
+                self.max_bytes is not None and self.total_bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key: Hashable) -> Any:
+        value, nbytes, _ = self._entries.pop(key)
+        self.total_bytes -= nbytes
+        return value
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Removes `key` from the cache and returns its value."""
+        with self._lock:
+            if key not in self._entries:
+                return default
+            return self._remove(key)
+
+    def clear(self) -> None:
+        """Drops every entry; counters are kept."""
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns a snapshot of size and hit/miss counters."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class PromptEmbeddingCache(SizedLRUCache):
+    """Caches `(prompt_embeds, pooled_prompt_embeds, text_ids)` produced by `FluxPipeline.encode_prompt`."""
+    def __init__(self, max_entries: int = 64, max_bytes: Optional[int] = 512 * 1024 ** 2):
+        super().__init__(max_entries=max_entries, max_bytes=max_bytes)
+
+    @staticmethod
+    def make_key(prompt, prompt_2, max_sequence_length, dtype, lora_scale, device) -> Tuple:
+        """Builds the cache key; `prompt_2` falls back to `prompt` exactly like `encode_prompt` does."""
+        prompt = (prompt,) if isinstance(prompt, str) else tuple(prompt)
+        prompt_2 = prompt_2 or prompt
+        prompt_2 = (prompt_2,) if isinstance(prompt_2, str) else tuple(prompt_2)
+        return (prompt, prompt_2, max_sequence_length, str(dtype), lora_scale, str(device))
@@ -1,15 +1,93 @@
+import contextlib
+import copy
+import functools
+import time
 import torch
+import torch.nn.functional as F
 import numpy as np
 from diffusers import FluxPipeline, FlowMatchEulerDiscreteScheduler
-from typing import Any, Dict, List, Optional, Union
+from diffusers.utils.torch_utils import randn_tensor
+from typing import Any, Dict, Hashable, Iterable, List, NamedTuple, Optional, Tuple, Union
 from PIL import Image
 
+from attention import AUTO, AUTO_SDPA_MAX_SEQ_LEN, BACKENDS, DEFAULT_CHUNK_SIZE, SDPA, SelectableFluxAttnProcessor, select_backend
+from buckets import PAD, ResolutionBuckets
+from caches import PromptEmbeddingCache, SizedLRUCache
+from memory_policy import FULL, TILED, MemoryPolicy, estimate_decode_bytes, estimate_denoise_bytes
+from metrics import REGISTRY, MetricsRegistry, StageTimer, format_resolution
+from profiling import MAX_TRACES, NULL_TRACE, SAMPLE_RATE, RequestProfiler, Trace
+
 # Constants for shift calculation
 BASE_SEQ_LEN = 256
 MAX_SEQ_LEN = 4096
 BASE_SHIFT = 0.5
 MAX_SHIFT = 1.2
 
+# Linear approximation of the FLUX VAE decoder (latent channel -> RGB), used for cheap previews
+FLUX_LATENT_RGB_FACTORS = [
+    [-0.0346, 0.0244, 0.0681],
+    [0.0034, 0.0210, 0.0687],
+    [0.0275, -0.0668, -0.0433],
+    [-0.0174, 0.0160, 0.0617],
+    [0.0859, 0.0721, 0.0329],
+    [0.0004, 0.0383, 0.0115],
+    [0.0405, 0.0861, 0.0915],
+    [-0.0236, -0.0185, -0.0259],
+    [-0.0245, 0.0250, 0.1180],
+    [0.1008, 0.0755, -0.0421],
+    [-0.0515, 0.0201, 0.0011],
+    [0.0428, -0.0012, -0.0036],
+    [0.0817, 0.0765, 0.0749],
+    [-0.1264, -0.0522, -0.1103],
+    [-0.0280, -0.0881, -0.0499],
+    [-0.1262, -0.0982, -0.0778],
+]
+FLUX_LATENT_RGB_BIAS = [-0.0329, -0.0718, -0.0851]
+
+# Bounds for the per-resolution precompute cache (57 x 57 slider shapes x 4 step counts at most)
+PRECOMPUTE_CACHE_ENTRIES = 1024
+PRECOMPUTE_CACHE_BYTES = 256 * 1024 ** 2
+
+
+class PrecomputedShape(NamedTuple):
+    """Request-independent state for one (height, width, steps, device, dtype, guidance) combination."""
+    latent_image_ids: torch.Tensor
+    scheduler: FlowMatchEulerDiscreteScheduler  # Template with timesteps set; copied per request
+    timesteps: torch.Tensor
+    guidance: Optional[torch.Tensor]
+
+# Share of the free device memory a VAE decode may use when no explicit budget is given
+DECODE_BUDGET_FRACTION = 0.5
+
+# Upper bound on the seeds of one variation batch, whatever the memory estimate allows
+MAX_VARIATIONS = 16
+
+# Latent shapes of a tiled decode at one resolution: interior tiles, right and bottom edges, corner
+TILE_SHAPES = 4
+
+# Final latents kept per session so Enhance can refine instead of regenerating. Entries live in host memory
+# (about 2.5-4.5 MB each, mostly the 300-token T5 embeddings), so none of it pins device memory
+LATENT_STORE_ENTRIES = 256
+LATENT_STORE_BYTES = 1024 ** 3
+LATENT_STORE_TTL = 15 * 60
+
+
+# Arguments of generate_images stored with a profiling trace (seeds are read from the generators)
+PROFILE_PARAMS = (
+    "prompt", "height", "width", "num_inference_steps", "guidance_scale", "num_images_per_prompt",
+    "max_sequence_length", "output_type", "attention_backend", "store_key",
+)
+
+
+class StoredLatents(NamedTuple):
+    """Final (packed) latents of one generation together with the prompt embeddings that produced them."""
+    latents: torch.Tensor
+    prompt_embeds: torch.Tensor
+    pooled_prompt_embeds: torch.Tensor
+    prompt: Optional[str]
+    height: int
+    width: int
+
 # Helper functions
 def calculate_timestep_shift(image_seq_len: int) -> float:
     """Calculates the timestep shift (mu) based on the image sequence length."""
@@ -41,13 +119,450 @@ def prepare_timesteps(
     num_inference_steps = len(timesteps)
     return timesteps, num_inference_steps
 
+def _profiled(generate):
+    """Opens a profiler trace around a generation (unless the caller passed `trace`) and hands it in."""
+    @functools.wraps(generate)
+    def wrapper(self, *args, trace: Optional[Trace] = None, **kwargs):
+        if trace is not None or self.profiler is None:
+            yield from generate(self, *args, trace=trace, **kwargs)
+            return
+        params = {name: kwargs[name] for name in PROFILE_PARAMS if name in kwargs}
+        generator = kwargs.get("generator")
+        if generator is not None:
+            params["seeds"] = [g.initial_seed() for g in (generator if isinstance(generator, list) else [generator])]
+        with self.profiler.trace(generate.__name__, **params) as trace:
+            yield from generate(self, *args, trace=trace, **kwargs)
+    return wrapper
+
+
+def _center_crop(image: torch.Tensor, size: Optional[Tuple[int, int]]) -> torch.Tensor:
+    """Center-crops a (B, C, H, W) image to `size` (height, width); a no-op when it already fits."""
+    if size is None or tuple(image.shape[-2:]) == tuple(size):
+        return image
+    height, width = int(size[0]), int(size[1])
+    top = (image.shape[-2] - height) // 2
+    left = (image.shape[-1] - width) // 2
+    return image[..., top:top + height, left:left + width]
+
 # FLUX pipeline function
 class FLUXPipelineWithIntermediateOutputs(FluxPipeline):
     """
     Extends the FluxPipeline to yield intermediate images during the denoising process 
     with progressively increasing resolution for faster generation.
     """
+    prompt_cache: Optional[PromptEmbeddingCache] = None
+    precompute_cache: Optional[SizedLRUCache] = None
+    latent_store: Optional[SizedLRUCache] = None
+    metrics: Optional[MetricsRegistry] = None
+    synchronize_timings: bool = True
+    resolution_buckets: Optional[ResolutionBuckets] = None
+    vae_compiled: bool = False
+    memory_policy: Optional[MemoryPolicy] = None
+    vae_channels_last: bool = False
+    attention_processor: Optional[SelectableFluxAttnProcessor] = None
+    attention_backend: str = AUTO
+    attention_max_sdpa_seq_len: int = AUTO_SDPA_MAX_SEQ_LEN
+    profiler: Optional[RequestProfiler] = None
+
+    def enable_metrics(self, registry: Optional[MetricsRegistry] = None, synchronize: bool = True):
+        """Records per-stage latencies of every request into `registry` (the shared one by default)."""
+        self.metrics = registry or REGISTRY
+        self.synchronize_timings = synchronize
+        self.metrics.register_gauge("precompute_cache", lambda: self.precompute_cache.stats() if self.precompute_cache else {})
+        self.metrics.register_gauge("prompt_cache", lambda: self.prompt_cache.stats() if self.prompt_cache else {})
+        self.metrics.register_gauge("compile", lambda: self.resolution_buckets.stats() if self.resolution_buckets else {})
+        self.metrics.register_gauge("memory", lambda: self.memory_policy.stats() if self.memory_policy else {})
+        self.metrics.register_gauge("attention", lambda: self.attention_processor.stats() if self.attention_processor else {})
+        self.metrics.register_gauge("profiling", lambda: self.profiler.stats() if self.profiler else {})
+
+    def disable_metrics(self):
+        self.metrics = None
+
+    def variation_limit(self, height: int, width: int, max_sequence_length: int = 300, max_variations: int = MAX_VARIATIONS) -> int:
+        """
+        How many images of this size one batched denoising loop may hold: bounded by `max_variations` and,
+        with a memory policy, by its budget over the estimated per-image transformer activations.
+        """
+        if self.memory_policy is None:
+            return max_variations
+        element_size = torch.finfo(self.transformer.dtype).bits // 8
+        per_image = estimate_denoise_bytes(self.transformer.config, 1, height, width, max_sequence_length, element_size)
+        return max(1, min(max_variations, self.memory_policy.budget_bytes // per_image))
+
+    def generate_variations(
+        self,
+        prompt: str,
+        seeds: List[int],
+        height: Optional[int] = None,
+        width: Optional[int] = None,
+        max_sequence_length: int = 300,
+        **kwargs,
+    ):
+        """
+        Generates one image per seed with a single prompt encoding and one batched denoising loop; tile i
+        matches a single generation with `seeds[i]`. Seeds beyond `variation_limit` are dropped, so pair the
+        yielded lists with `seeds[:len(images)]`. Accepts the other options of `generate_images`.
+        """
+        height = height or self.default_sample_size * self.vae_scale_factor
+        width = width or self.default_sample_size * self.vae_scale_factor
+        seeds = list(seeds)[:self.variation_limit(height, width, max_sequence_length)]
+        yield from self.generate_images(
+            prompt=prompt,
+            height=height,
+            width=width,
+            num_images_per_prompt=len(seeds),
+            generator=[torch.Generator().manual_seed(int(seed)) for seed in seeds],
+            max_sequence_length=max_sequence_length,
+            batch_output=True,
+            **kwargs,
+        )
+
+    def enable_compiled_mode(
+        self,
+        buckets: Optional[List[Tuple[int, int]]] = None,
+        policy: str = PAD,
+        compile_vae: bool = True,
+        mode: Optional[str] = None,
+        backend: str = "inductor",
+        batch_sizes: Optional[Iterable[int]] = None,
+    ):
+        """
+        Compiles the transformer (and the VAE decoder) for static shapes and routes every request through a
+        bounded set of resolution `buckets`, so each bucket compiles once and is reused afterwards. With the
+        "pad" policy requests run at the smallest covering bucket and are center-cropped back to the requested
+        size; with "snap" they run and return at the closest bucket. `batch_sizes` are the batch sizes requests
+        may run at (default 1 to `MAX_VARIATIONS`); dynamo's recompile limit is sized to hold all of them.
+        """
+        self.resolution_buckets = ResolutionBuckets(buckets, policy)
+        # One graph per bucket and batch size, plus batch-1 graphs of sliced and tiled decodes; dynamo's
+        # default limit (8) would fall back to recompiling over and over
+        batch_sizes = set(batch_sizes or range(1, MAX_VARIATIONS + 1)) | {1}
+        limit = len(self.resolution_buckets.buckets) * (len(batch_sizes) + TILE_SHAPES)
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, limit)
+        self.transformer.compile(dynamic=False, mode=mode, backend=backend)
+        if compile_vae:
+            self.vae.decoder.compile(dynamic=False, mode=mode, backend=backend)
+        self.vae_compiled = compile_vae
+
+    def enable_cpu_mode(
+        self,
+        dtype: torch.dtype = torch.bfloat16,
+        quantize: bool = False,
+        num_threads: Optional[int] = None,
+        channels_last: bool = True,
+    ):
+        """
+        Moves the pipeline to the CPU in `dtype` (bfloat16 or float32). With `quantize` the transformer's linear
+        layers are dynamically quantized to int8; those take float32 activations, so the pipeline then runs in
+        float32. `num_threads` sets torch's intra-op threads and `channels_last` the VAE memory format.
+        """
+        if dtype not in (torch.bfloat16, torch.float32):
+            raise ValueError(f"CPU mode supports torch.bfloat16 and torch.float32, got {dtype}.")
+        if quantize:
+            dtype = torch.float32
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.to("cpu", dtype)
+        if quantize:
+            torch.ao.quantization.quantize_dynamic(self.transformer, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        if channels_last:
+            self.vae.to(memory_format=torch.channels_last)
+        self.vae_channels_last = channels_last
+
+    def enable_memory_policy(self, budget_bytes: Optional[int] = None, release_above_bytes: Optional[int] = 1024 ** 3):
+        """
+        Decodes sliced or tiled whenever the estimated peak of a full decode exceeds `budget_bytes` (by default
+        half the device memory free right now), and returns cached memory to the driver between requests only
+        once more than `release_above_bytes` sits unused in the allocator.
+        """
+        if budget_bytes is None:
+            device = self._execution_device
+            if device.type != "cuda":
+                raise ValueError("`budget_bytes` is required when not running on CUDA.")
+            free_bytes, _ = torch.cuda.mem_get_info(device)
+            budget_bytes = int(free_bytes * DECODE_BUDGET_FRACTION)
+        self.memory_policy = MemoryPolicy(budget_bytes, release_above_bytes)
+
+    def enable_attention_backend(
+        self,
+        default: str = AUTO,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        max_sdpa_seq_len: int = AUTO_SDPA_MAX_SEQ_LEN,
+    ):
+        """
+        Installs an attention processor whose kernel is chosen per request: "sdpa", "efficient", "chunked",
+        "xformers" or "auto" (`attention.select_backend` on the image sequence length, with plain sdpa up to
+        `max_sdpa_seq_len` tokens). `default` applies to requests that don't pass `attention_backend`.
+        """
+        if default != AUTO and default not in BACKENDS:
+            raise ValueError(f"`default` must be {AUTO!r} or one of {BACKENDS}, got {default!r}.")
+        self.attention_processor = SelectableFluxAttnProcessor(SDPA, chunk_size)
+        self.attention_backend = default
+        self.attention_max_sdpa_seq_len = max_sdpa_seq_len
+        self.transformer.set_attn_processor(self.attention_processor)
+
+    def _resolve_attention_backend(self, requested: Optional[str], image_seq_len: int, device) -> Optional[str]:
+        """The backend a request runs with, or None when the stock attention processors are installed."""
+        if self.attention_processor is None:
+            if requested is not None:
+                raise ValueError("`attention_backend` requires `enable_attention_backend()` first.")
+            return None
+        backend = requested or self.attention_backend
+        if backend == AUTO:
+            backend = select_backend(image_seq_len, device.type, self.attention_max_sdpa_seq_len)
+        self.attention_processor.record(backend)
+        return backend
+
+    def enable_profiling(
+        self,
+        output_dir: str,
+        sample_rate: float = SAMPLE_RATE,
+        slow_threshold: Optional[float] = None,
+        max_traces: int = MAX_TRACES,
+        torch_profiler: bool = True,
+    ):
+        """
+        Traces a `sample_rate` fraction of generations, plus those taking at least `slow_threshold` seconds,
+        into a ring of `max_traces` files in `output_dir` (see `profiling.RequestProfiler`): stage and per-step
+        transformer spans, and for sampled requests a torch profile with allocator activity.
+        """
+        self.profiler = RequestProfiler(output_dir, sample_rate, slow_threshold, max_traces, torch_profiler)
+
+    def _vae_decode(self, vae, latents, memory: Optional[Dict[str, Any]] = None):
+        """Runs the VAE decode in the mode picked by the memory policy (a full decode without one)."""
+        if self.vae_channels_last and vae is self.vae:
+            latents = latents.to(memory_format=torch.channels_last)
+        mode = FULL
+        if vae is self.vae and hasattr(vae.config, "block_out_channels"):
+            batch_size = latents.shape[0]
+            height, width = latents.shape[-2] * self.vae_scale_factor, latents.shape[-1] * self.vae_scale_factor
+            if self.memory_policy is not None:
+                mode, estimated = self.memory_policy.choose(vae, batch_size, height, width, latents.element_size())
+            else:
+                estimated = estimate_decode_bytes(vae.config, batch_size, height, width, latents.element_size())
+            if memory is not None:
+                memory.update(decode_mode=mode, estimated_peak_bytes=estimated)
+        if mode == FULL:
+            return vae.decode(latents, return_dict=False)[0]
+        decode = vae.tiled_decode if mode == TILED else vae.decode
+        return torch.cat([decode(latents[i:i + 1], return_dict=False)[0] for i in range(latents.shape[0])])
+
+    def _finish_memory(self, device, measure_peak: bool, memory: Optional[Dict[str, Any]] = None):
+        """Records the request's measured peak and releases cached device memory between requests."""
+        if device.type != "cuda":
+            return
+        if measure_peak:
+            peak = torch.cuda.max_memory_allocated(device)
+            if memory is not None:
+                memory["measured_peak_bytes"] = peak
+            if self.memory_policy is not None:
+                self.memory_policy.record_peak(peak)
+        reserved, allocated = torch.cuda.memory_reserved(device), torch.cuda.memory_allocated(device)
+        if self.memory_policy is None or self.memory_policy.should_release(reserved, allocated):
+            torch.cuda.empty_cache()
+
+    def _run_size(self, height, width) -> Tuple[int, int, int, int]:
+        """Returns (run_height, run_width, output_height, output_width); the identity unless compiled mode is on."""
+        if self.resolution_buckets is None:
+            return height, width, height, width
+        return self.resolution_buckets.select(int(height), int(width))
+
+    def _first_compiled_use(self, *key) -> bool:
+        """True when a compiled module sees this (module, shape) key for the first time, i.e. compiles."""
+        return self.resolution_buckets is not None and self.resolution_buckets.first_use(key)
+
+    def enable_latent_store(self, max_entries: int = LATENT_STORE_ENTRIES, max_bytes: int = LATENT_STORE_BYTES, ttl: float = LATENT_STORE_TTL):
+        """Keeps the final latents of generations passed a `store_key` (on the CPU), for `refine_images`."""
+        self.latent_store = SizedLRUCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+
+    def get_stored_latents(self, store_key: Hashable) -> Optional[StoredLatents]:
+        """Returns the latents stored under `store_key`, or None if missing or expired."""
+        return self.latent_store.get(store_key) if self.latent_store is not None else None
+
+    def _store_latents(self, store_key, latents, prompt_embeds, pooled_prompt_embeds, prompt, height, width):
+        """Stores one entry per batch element when `store_key` is a list, else the whole batch; copies go to the CPU."""
+        if self.latent_store is None or store_key is None:
+            return
+        keys = store_key if isinstance(store_key, list) else [store_key]
+        prompts = prompt if isinstance(prompt, list) else [prompt] * len(keys)
+        per_key = latents.shape[0] // len(keys)
+        for i, key in enumerate(keys):
+            if key is None:
+                continue
+            rows = slice(i * per_key, (i + 1) * per_key) if isinstance(store_key, list) else slice(None)
+            key_prompt = prompts[i]
+            if key_prompt is None:
+                # Refinements run from embeddings only; keep the prompt of the entry they replace
+                previous = self.latent_store.pop(key)
+                key_prompt = previous.prompt if previous is not None else None
+            self.latent_store.put(key, StoredLatents(
+                latents[rows].to("cpu", copy=True),
+                prompt_embeds[rows].to("cpu", copy=True),
+                pooled_prompt_embeds[rows].to("cpu", copy=True),
+                key_prompt,
+                height,
+                width,
+            ))
+
+    def refine_images(
+        self,
+        store_key: Hashable,
+        num_inference_steps: int = 2,
+        strength: float = 0.35,
+        height: Optional[int] = None,
+        width: Optional[int] = None,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+        prompt: Optional[Union[str, List[str]]] = None,
+        **kwargs,
+    ):
+        """
+        Refines the image generated under `store_key` instead of regenerating it: the stored latents are
+        (optionally) resized to `height` x `width`, re-noised to sigma=`strength` and denoised again over
+        `num_inference_steps` low-sigma steps, reusing the stored prompt embeddings, or conditioned on `prompt`
+        instead (e.g. a slightly edited prompt). Accepts the output options of `generate_images`. Raises
+        `KeyError` when nothing is stored for `store_key`.
+        """
+        stored = self.get_stored_latents(store_key)
+        if stored is None:
+            raise KeyError(f"No stored latents for {store_key!r}")
+        height = height or stored.height
+        width = width or stored.width
+        # Stored latents are at the run size; resize them to the run size of the target
+        run_height, run_width, _, _ = self._run_size(height, width)
+
+        device = self._execution_device
+        latents = stored.latents.to(device)
+        if (run_height, run_width) != (stored.height, stored.width):
+            num_channels_latents = self.transformer.config.in_channels // 4
+            latents = self._unpack_latents(latents, stored.height, stored.width, self.vae_scale_factor)
+            latent_height = 2 * (int(run_height) // (self.vae_scale_factor * 2))
+            latent_width = 2 * (int(run_width) // (self.vae_scale_factor * 2))
+            latents = F.interpolate(latents, size=(latent_height, latent_width), mode="bicubic", align_corners=False)
+            latents = self._pack_latents(latents, latents.shape[0], num_channels_latents, latent_height, latent_width)
+
+        # Re-noise along the flow-matching path: x_sigma = (1 - sigma) * x_0 + sigma * noise
+        noise = randn_tensor(latents.shape, generator=generator, device=latents.device, dtype=latents.dtype)
+        latents = (1.0 - strength) * latents + strength * noise
+        sigmas = np.linspace(strength, strength / num_inference_steps, num_inference_steps)
+        if prompt is not None:
+            conditioning = dict(prompt=prompt)
+        else:
+            conditioning = dict(prompt_embeds=stored.prompt_embeds.to(device), pooled_prompt_embeds=stored.pooled_prompt_embeds.to(device))
+
+        yield from self.generate_images(
+            height=height,
+            width=width,
+            num_inference_steps=num_inference_steps,
+            sigmas=sigmas,
+            latents=latents,
+            store_key=store_key,
+            **conditioning,
+            **kwargs,
+        )
+
+    def _stage_timer(self, timings, width, height, num_inference_steps, trace: Trace = NULL_TRACE) -> StageTimer:
+        synchronize = None
+        if self.synchronize_timings and self._execution_device.type == "cuda":
+            synchronize = torch.cuda.synchronize
+        return StageTimer(
+            self.metrics,
+            timings,
+            synchronize,
+            on_lap=trace.add_span if trace is not NULL_TRACE else None,
+            resolution=format_resolution(width, height),
+            steps=num_inference_steps,
+        )
+
+    def enable_prompt_cache(self, max_entries: int = 64, max_bytes: Optional[int] = 512 * 1024 ** 2):
+        """Enables an LRU cache of text-encoder outputs so unchanged prompts skip CLIP + T5."""
+        self.prompt_cache = PromptEmbeddingCache(max_entries=max_entries, max_bytes=max_bytes)
+
+    def disable_prompt_cache(self):
+        """Disables and drops the prompt embedding cache."""
+        self.prompt_cache = None
+
+    def warm_prompt_cache(self, prompts: List[str], max_sequence_length: int = 300, lora_scale: Optional[float] = None):
+        """Pre-encodes `prompts` (e.g. the gallery examples) into the prompt embedding cache."""
+        if self.prompt_cache is None:
+            self.enable_prompt_cache()
+        with torch.inference_mode():
+            for prompt in prompts:
+                self._encode_prompt_cached(prompt, None, self._execution_device, 1, max_sequence_length, lora_scale)
+
+    def _encode_prompt_cached(self, prompt, prompt_2, device, num_images_per_prompt, max_sequence_length, lora_scale):
+        """Runs `encode_prompt` through the prompt cache, repeating cached embeddings per image."""
+        if not isinstance(prompt, str):
+            # Cache per prompt so batched requests share entries with single ones
+            prompt_2 = prompt_2 or prompt
+            prompt_2 = [prompt_2] * len(prompt) if isinstance(prompt_2, str) else prompt_2
+            encoded = [
+                self._encode_prompt_cached(p, p_2, device, num_images_per_prompt, max_sequence_length, lora_scale)
+                for p, p_2 in zip(prompt, prompt_2)
+            ]
+            return torch.cat([e[0] for e in encoded]), torch.cat([e[1] for e in encoded]), encoded[0][2]
+
+        dtype = self.text_encoder.dtype if self.text_encoder is not None else self.transformer.dtype
+        key = self.prompt_cache.make_key(prompt, prompt_2, max_sequence_length, dtype, lora_scale, device)
+        cached = self.prompt_cache.get(key)
+        if cached is None:
+            cached = self.encode_prompt(
+                prompt=prompt,
+                prompt_2=prompt_2,
+                device=device,
+                num_images_per_prompt=1,
+                max_sequence_length=max_sequence_length,
+                lora_scale=lora_scale,
+            )
+            self.prompt_cache.put(key, cached)
+
+        prompt_embeds, pooled_prompt_embeds, text_ids = cached
+        if num_images_per_prompt > 1:
+            batch_size, seq_len, _ = prompt_embeds.shape
+            prompt_embeds = prompt_embeds.repeat(1, num_images_per_prompt, 1).view(batch_size * num_images_per_prompt, seq_len, -1)
+            pooled_prompt_embeds = pooled_prompt_embeds.repeat(1, num_images_per_prompt).view(batch_size * num_images_per_prompt, -1)
+        return prompt_embeds, pooled_prompt_embeds, text_ids
+
+    def _get_precomputed(self, height, width, num_inference_steps, device, dtype, guidance_scale) -> PrecomputedShape:
+        """Returns latent ids, scheduler timesteps and guidance for a request shape, computing them once."""
+        if self.precompute_cache is None:
+            self.precompute_cache = SizedLRUCache(max_entries=PRECOMPUTE_CACHE_ENTRIES, max_bytes=PRECOMPUTE_CACHE_BYTES)
+        key = (height, width, num_inference_steps, str(device), str(dtype), guidance_scale)
+        entry = self.precompute_cache.get(key)
+        if entry is not None:
+            return entry
+
+        latent_height = 2 * (int(height) // (self.vae_scale_factor * 2))
+        latent_width = 2 * (int(width) // (self.vae_scale_factor * 2))
+        latent_image_ids = self._prepare_latent_image_ids(1, latent_height // 2, latent_width // 2, device, dtype)
+
+        scheduler = FlowMatchEulerDiscreteScheduler.from_config(self.scheduler.config)
+        sigmas = np.linspace(1.0, 1 / num_inference_steps, num_inference_steps)
+        mu = calculate_timestep_shift((latent_height // 2) * (latent_width // 2))
+        timesteps, _ = prepare_timesteps(scheduler, num_inference_steps, device, None, sigmas, mu=mu)
+
+        # float32 like upstream FluxPipeline: the guidance embedder casts it to the model dtype itself
+        guidance = torch.full([1], guidance_scale, device=device, dtype=torch.float32) if self.transformer.config.guidance_embeds else None
+        entry = PrecomputedShape(latent_image_ids, scheduler, timesteps, guidance)
+        self.precompute_cache.put(key, entry)
+        return entry
+
+    def _prepare_packed_latents(self, batch_size, num_channels_latents, height, width, dtype, device, generator, latents=None):
+        """Like `prepare_latents` but without rebuilding the latent image ids."""
+        if latents is not None:
+            return latents.to(device=device, dtype=dtype)
+        if isinstance(generator, list) and len(generator) != batch_size:
+            raise ValueError(
+                f"You have passed a list of generators of length {len(generator)}, but requested an effective batch"
+                f" size of {batch_size}. Make sure the batch size matches the length of the generators."
+            )
+        latent_height = 2 * (int(height) // (self.vae_scale_factor * 2))
+        latent_width = 2 * (int(width) // (self.vae_scale_factor * 2))
+        shape = (batch_size, num_channels_latents, latent_height, latent_width)
+        latents = randn_tensor(shape, generator=generator, device=device, dtype=dtype)
+        return self._pack_latents(latents, batch_size, num_channels_latents, latent_height, latent_width)
+
     @torch.inference_mode()
+    @_profiled
     def generate_images(
         self,
         prompt: Union[str, List[str]] = None,
@@ -56,6 +571,7 @@ class FLUXPipelineWithIntermediateOutputs(FluxPipeline):
         width: Optional[int] = None,
         num_inference_steps: int = 4,
         timesteps: List[int] = None,
+        sigmas: Optional[List[float]] = None,
         guidance_scale: float = 3.5,
         num_images_per_prompt: Optional[int] = 1,
         generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
@@ -66,8 +582,50 @@ class FLUXPipelineWithIntermediateOutputs(FluxPipeline):
         return_dict: bool = True,
         joint_attention_kwargs: Optional[Dict[str, Any]] = None,
         max_sequence_length: int = 300,
+        stream_previews: bool = False,
+        preview_vae: Optional[torch.nn.Module] = None,
+        batch_output: bool = False,
+        cancel_token: Optional[Any] = None,
+        timings: Optional[Dict[str, float]] = None,
+        store_key: Optional[Union[Hashable, List[Hashable]]] = None,
+        memory: Optional[Dict[str, Any]] = None,
+        attention_backend: Optional[str] = None,
+        trace: Optional[Trace] = None,
     ):
-        """Generates images and yields intermediate results during the denoising process."""
+        """
+        Generates images and yields intermediate results during the denoising process.
+
+        With `stream_previews=True` a cheap preview of the predicted clean image is yielded after every
+        scheduler step but the last, decoded through `preview_vae` (e.g. a tiny autoencoder) or a linear
+        latent-to-RGB projection. The full VAE only runs for the final image.
+
+        By default only the first image of the batch is yielded; `batch_output=True` yields the whole batch as a list.
+        `output_type="uint8"` skips the float numpy / PIL round trip and yields uint8 (H, W, 3) arrays, ready for
+        `encoding.ImageEncoder`.
+
+        `cancel_token` (see `sessions.GenerationToken`) is checked between scheduler steps; once it is cancelled
+        the loop stops and the VAE decode is skipped, so nothing more is yielded.
+
+        Stage latencies (encode, prepare, denoise_step, preview, vae_decode, postprocess) are recorded into
+        `self.metrics` when enabled and summed into `timings` when a dict is passed.
+
+        With the latent store enabled, the final latents and prompt embeddings are kept under `store_key`
+        (one key per batch element when it is a list) so `refine_images` can resume from them.
+
+        In compiled mode (`enable_compiled_mode`) the request runs at its resolution bucket and the images are
+        cropped back to `height` x `width` (or returned at the bucket size with the "snap" policy).
+
+        When `memory` is a dict it receives the decode mode, the estimated decode peak and, on CUDA, the measured
+        peak allocation of the request (approximate while other requests run concurrently).
+
+        `attention_backend` overrides the default set by `enable_attention_backend` for this request ("auto"
+        picks from the image sequence length).
+
+        With profiling enabled (`enable_profiling`) sampled or slow requests leave a trace of their stages and
+        transformer steps; pass `trace` to record into a caller's trace instead.
+        """
+        if trace is None:
+            trace = NULL_TRACE
         height = height or self.default_sample_size * self.vae_scale_factor
         width = width or self.default_sample_size * self.vae_scale_factor
 
@@ -87,82 +645,170 @@ class FLUXPipelineWithIntermediateOutputs(FluxPipeline):
         self._interrupt = False
 
         # 2. Define call parameters
-        batch_size = 1 if isinstance(prompt, str) else len(prompt)
+        if prompt is not None:
+            batch_size = 1 if isinstance(prompt, str) else len(prompt)
+        else:
+            batch_size = prompt_embeds.shape[0]
         device = self._execution_device
+        run_height, run_width, height, width = self._run_size(height, width)
+        measure_peak = device.type == "cuda" and (self.memory_policy is not None or memory is not None)
+        if measure_peak:
+            torch.cuda.reset_peak_memory_stats(device)
+
+        timer = self._stage_timer(timings, width, height, num_inference_steps, trace)
 
         # 3. Encode prompt
         lora_scale = joint_attention_kwargs.get("scale", None) if joint_attention_kwargs is not None else None
-        prompt_embeds, pooled_prompt_embeds, text_ids = self.encode_prompt(
-            prompt=prompt,
-            prompt_2=prompt_2,
-            prompt_embeds=prompt_embeds,
-            pooled_prompt_embeds=pooled_prompt_embeds,
-            device=device,
-            num_images_per_prompt=num_images_per_prompt,
-            max_sequence_length=max_sequence_length,
-            lora_scale=lora_scale,
-        )
+        if self.prompt_cache is not None and prompt_embeds is None:
+            prompt_embeds, pooled_prompt_embeds, text_ids = self._encode_prompt_cached(
+                prompt, prompt_2, device, num_images_per_prompt, max_sequence_length, lora_scale
+            )
+        else:
+            prompt_embeds, pooled_prompt_embeds, text_ids = self.encode_prompt(
+                prompt=prompt,
+                prompt_2=prompt_2,
+                prompt_embeds=prompt_embeds,
+                pooled_prompt_embeds=pooled_prompt_embeds,
+                device=device,
+                num_images_per_prompt=num_images_per_prompt,
+                max_sequence_length=max_sequence_length,
+                lora_scale=lora_scale,
+            )
+        timer.lap("encode")
+
         # 4. Prepare latent variables
         num_channels_latents = self.transformer.config.in_channels // 4
-        latents, latent_image_ids = self.prepare_latents(
+        latents = self._prepare_packed_latents(
             batch_size * num_images_per_prompt,
             num_channels_latents,
-            height,
-            width,
+            run_height,
+            run_width,
             prompt_embeds.dtype,
             device,
             generator,
             latents,
         )
-        # 5. Prepare timesteps
-        sigmas = np.linspace(1.0, 1 / num_inference_steps, num_inference_steps)
-        image_seq_len = latents.shape[1]
-        mu = calculate_timestep_shift(image_seq_len)
-        timesteps, num_inference_steps = prepare_timesteps(
-            self.scheduler,
-            num_inference_steps,
-            device,
-            timesteps,
-            sigmas,
-            mu=mu,
-        )
+        # 5. Prepare timesteps (cached per shape; the scheduler is a per-request copy so concurrent requests don't share state)
+        precomputed = self._get_precomputed(run_height, run_width, num_inference_steps, device, prompt_embeds.dtype, guidance_scale)
+        latent_image_ids = precomputed.latent_image_ids
+        scheduler = copy.copy(precomputed.scheduler)
+        if timesteps is not None or sigmas is not None:
+            mu = calculate_timestep_shift(latents.shape[1])
+            timesteps, num_inference_steps = prepare_timesteps(scheduler, num_inference_steps, device, timesteps, sigmas, mu=mu)
+        else:
+            timesteps = precomputed.timesteps
         self._num_timesteps = len(timesteps)
 
         # Handle guidance
-        guidance = torch.full([1], guidance_scale, device=device, dtype=torch.float16).expand(latents.shape[0]) if self.transformer.config.guidance_embeds else None
+        guidance = precomputed.guidance.expand(latents.shape[0]) if precomputed.guidance is not None else None
+        attention_backend = self._resolve_attention_backend(attention_backend, latents.shape[1], device)
+        trace.annotate(run_height=run_height, run_width=run_width, batch_size=latents.shape[0], attention_backend=attention_backend)
+        timer.lap("prepare")
 
         # 6. Denoising loop
         for i, t in enumerate(timesteps):
-            if self.interrupt:
-                continue
+            if self.interrupt or (cancel_token is not None and cancel_token.cancelled):
+                break
 
             timestep = t.expand(latents.shape[0]).to(latents.dtype)
 
-            noise_pred = self.transformer(
-                hidden_states=latents,
-                timestep=timestep / 1000,
-                guidance=guidance,
-                pooled_projections=pooled_prompt_embeds,
-                encoder_hidden_states=prompt_embeds,
-                txt_ids=text_ids,
-                img_ids=latent_image_ids,
-                joint_attention_kwargs=self.joint_attention_kwargs,
-                return_dict=False,
-            )[0]
-
-             # Yield intermediate result
-            latents = self.scheduler.step(noise_pred, t, latents, return_dict=False)[0]
-            torch.cuda.empty_cache()
+            compiling = i == 0 and self._first_compiled_use("transformer", run_height, run_width, latents.shape[0])
+            start_time = time.perf_counter()
+            # Scoped to the call: the generator may be resumed on another thread between steps
+            attention_scope = self.attention_processor.use(attention_backend) if attention_backend else contextlib.nullcontext()
+            with trace.span("transformer", step=i), attention_scope:
+                noise_pred = self.transformer(
+                    hidden_states=latents,
+                    timestep=timestep / 1000,
+                    guidance=guidance,
+                    pooled_projections=pooled_prompt_embeds,
+                    encoder_hidden_states=prompt_embeds,
+                    txt_ids=text_ids,
+                    img_ids=latent_image_ids,
+                    joint_attention_kwargs=self.joint_attention_kwargs,
+                    return_dict=False,
+                )[0]
+            if compiling:
+                self.resolution_buckets.add_compile_time(time.perf_counter() - start_time)
+
+            prev_latents = latents
+            latents = scheduler.step(noise_pred, t, latents, return_dict=False)[0]
+            if cancel_token is not None:
+                cancel_token.steps_done += 1
+            timer.lap("denoise_step")
+
+            # Yield intermediate result
+            if stream_previews and i < len(timesteps) - 1:
+                sigma = float(scheduler.sigmas[i])
+                pred_original = prev_latents - sigma * noise_pred
+                previews = self._decode_latents_to_previews(
+                    pred_original, run_height, run_width, output_type, preview_vae, crop_to=(height, width)
+                )
+                timer.lap("preview")
+                yield previews if batch_output else previews[0]
+                timer.reset()
+
+        # Superseded requests skip the final decode
+        if self.interrupt or (cancel_token is not None and cancel_token.cancelled):
+            trace.annotate(cancelled=True)
+            self.maybe_free_model_hooks()
+            self._finish_memory(device, measure_peak, memory)
+            return
+
+        self._store_latents(store_key, latents, prompt_embeds, pooled_prompt_embeds, prompt, run_height, run_width)
 
         # Final image
-        yield self._decode_latents_to_image(latents, height, width, output_type)
+        images = self._decode_latents_to_images(
+            latents, run_height, run_width, output_type, timer=timer, crop_to=(height, width), memory=memory
+        )
+        yield images if batch_output else images[0]
         self.maybe_free_model_hooks()
-        torch.cuda.empty_cache()
+        self._finish_memory(device, measure_peak, memory)
 
     def _decode_latents_to_image(self, latents, height, width, output_type, vae=None):
         """Decodes the given latents into an image."""
+        return self._decode_latents_to_images(latents, height, width, output_type, vae=vae)[0]
+
+    def _decode_latents_to_images(
+        self, latents, height, width, output_type, vae=None, timer: Optional[StageTimer] = None, crop_to=None, memory=None
+    ):
+        """Decodes the given latents into one image per batch entry, center-cropped to `crop_to` (height, width) if given."""
         vae = vae or self.vae
+        compiling = vae is self.vae and self.vae_compiled and self._first_compiled_use("vae", height, width, latents.shape[0])
+        start_time = time.perf_counter()
         latents = self._unpack_latents(latents, height, width, self.vae_scale_factor)
         latents = (latents / vae.config.scaling_factor) + vae.config.shift_factor
-        image = vae.decode(latents, return_dict=False)[0]
-        return self.image_processor.postprocess(image, output_type=output_type)[0]
+        image = self._vae_decode(vae, latents, memory)
+        if compiling:
+            self.resolution_buckets.add_compile_time(time.perf_counter() - start_time)
+        image = _center_crop(image, crop_to)
+        if timer is not None:
+            timer.lap("vae_decode")
+        images = self._postprocess(image, output_type)
+        if timer is not None:
+            timer.lap("postprocess")
+        return images
+
+    def _decode_latents_to_previews(self, latents, height, width, output_type, preview_vae=None, crop_to=None):
+        """Decodes the given latents into cheap preview images."""
+        if preview_vae is not None:
+            return self._decode_latents_to_images(latents, height, width, output_type, vae=preview_vae, crop_to=crop_to)
+
+        latents = self._unpack_latents(latents, height, width, self.vae_scale_factor)
+        if latents.shape[1] == len(FLUX_LATENT_RGB_FACTORS):
+            factors = torch.tensor(FLUX_LATENT_RGB_FACTORS, device=latents.device, dtype=latents.dtype)
+            bias = torch.tensor(FLUX_LATENT_RGB_BIAS, device=latents.device, dtype=latents.dtype)
+            image = torch.einsum("bchw,cr->brhw", latents, factors) + bias[None, :, None, None]
+        else:
+            # Unknown latent layout (e.g. a test model): show the first three channels
+            image = latents[:, :3]
+        image = F.interpolate(image, size=(height, width), mode="bilinear", align_corners=False)
+        image = _center_crop(image, crop_to)
+        return self._postprocess(image, output_type)
+
+    def _postprocess(self, image, output_type):
+        """`image_processor.postprocess`, plus "uint8": a (B, H, W, 3) uint8 array straight from the tensor."""
+        if output_type != "uint8":
+            return self.image_processor.postprocess(image, output_type=output_type)
+        image = (image / 2 + 0.5).clamp(0, 1).mul(255).round().to(torch.uint8)
+        return image.permute(0, 2, 3, 1).cpu().numpy()
@@ -0,0 +1,242 @@
+"""
+Spreads requests over several backends (Spaces, or local Gradio workers such as
+`GRADIO_SERVER_PORT=7871 METRICS_PORT=9101 python app_backup.py` or `python stub_space.py --port 7871`):
+
+    backend = Dispatcher(["KingNish/Realtime-FLUX", "http://127.0.0.1:7871/"])
+    backend.predict(..., api_name="/Enhance", affinity=prompt)
+
+Each call goes to the least-loaded healthy backend; with an `affinity` key (e.g. the prompt) it prefers the
+backend that key hashes to, so that backend's prompt cache stays warm, unless it is noticeably busier.
+Backends that keep failing or answer much slower than the others are ejected for a while and re-admitted
+once a health probe succeeds.
+"""
+import hashlib
+import statistics
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+from backend_client import BackendPool, RequestCancelled
+from profiling import NULL_TRACE, Trace
+
+HEALTHY = "healthy"
+EJECTED = "ejected"
+
+
+class _Backend:
+    """One endpoint with its pool and health bookkeeping."""
+    def __init__(self, src: str, pool: BackendPool):
+        self.src = src
+        self.pool = pool
+        self.state = HEALTHY
+        self.ejected_until = 0.0
+        self.consecutive_failures = 0
+        self.latency_ewma: Optional[float] = None  # Seconds per unit of cost
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+        self.affinity_hits = 0
+
+
+class Dispatcher:
+    """
+    Routes calls over `endpoints`, each served by a `BackendPool` of `pool_size` clients (extra keyword
+    arguments go to the pools). A backend is ejected for `eject_seconds` after `max_failures` consecutive
+    failures, or when its smoothed latency per unit of cost exceeds `slow_factor` times the median of the
+    others; ejected backends are probed every `health_interval` seconds. The last healthy backend is never
+    ejected. A failed call is retried once on another backend if nothing was streamed yet.
+    """
+    def __init__(
+        self,
+        endpoints: List[str],
+        pool_size: int = 2,
+        health_interval: float = 5.0,
+        max_failures: int = 3,
+        eject_seconds: float = 30.0,
+        slow_factor: float = 3.0,
+        affinity_slack: int = 2,
+        ewma_alpha: float = 0.2,
+        **pool_kwargs,
+    ):
+        if not endpoints:
+            raise ValueError("At least one endpoint is required.")
+        self.backends = [_Backend(src, BackendPool(src, size=pool_size, **pool_kwargs)) for src in endpoints]
+        self.health_interval = health_interval
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.slow_factor = slow_factor
+        self.affinity_slack = affinity_slack
+        self.ewma_alpha = ewma_alpha
+        self._lock = threading.Lock()
+        self._health_thread: Optional[threading.Thread] = None
+
+    def start_health_checks(self) -> "Dispatcher":
+        """Starts the daemon thread probing ejected backends."""
+        if self._health_thread is None:
+            self._health_thread = threading.Thread(target=self._health_loop, name="backend-health", daemon=True)
+            self._health_thread.start()
+        return self
+
+    def connect(self, count: Optional[int] = None):
+        """Eagerly connects `count` clients on every backend that answers."""
+        errors = []
+        for backend in self.backends:
+            try:
+                backend.pool.connect(count)
+            except Exception as e:
+                errors.append(e)
+                self._record(backend, None, failed=True)
+        if len(errors) == len(self.backends):
+            raise errors[0]
+
+    def _health_loop(self):
+        while True:
+            time.sleep(self.health_interval)
+            for backend in self.backends:
+                if backend.state == EJECTED and time.time() >= backend.ejected_until:
+                    try:
+                        backend.pool.probe()
+                    except Exception:
+                        with self._lock:
+                            backend.ejected_until = time.time() + self.eject_seconds
+                        continue
+                    with self._lock:
+                        backend.state = HEALTHY
+                        backend.consecutive_failures = 0
+                        backend.latency_ewma = None  # Start afresh rather than be ejected again as slow
+
+    def _choose(self, affinity: Optional[str], exclude: List[_Backend]) -> _Backend:
+        with self._lock:
+            candidates = [b for b in self.backends if b.state == HEALTHY and b not in exclude]
+            if not candidates:
+                # Everything is ejected: fall back to the backend that comes back soonest
+                candidates = sorted((b for b in self.backends if b not in exclude), key=lambda b: b.ejected_until)[:1]
+                if not candidates:
+                    candidates = self.backends[:1]
+            least = min(candidates, key=lambda b: b.pool.load)
+            if affinity is not None:
+                # Rendezvous hashing: the preferred backend only changes for keys of a backend that left
+                preferred = max(candidates, key=lambda b: hashlib.sha256(f"{b.src}|{affinity}".encode("utf-8")).digest())
+                if preferred.pool.load <= least.pool.load + self.affinity_slack:
+                    preferred.affinity_hits += 1
+                    least = preferred
+            least.requests += 1
+            return least
+
+    def _record(self, backend: _Backend, seconds: Optional[float], failed: bool = False, cost: float = 1.0):
+        with self._lock:
+            if failed:
+                backend.failures += 1
+                backend.consecutive_failures += 1
+                if backend.consecutive_failures >= self.max_failures:
+                    self._eject(backend)
+                return
+            backend.consecutive_failures = 0
+            sample = seconds / max(cost, 1e-6)
+            if backend.latency_ewma is None:
+                backend.latency_ewma = sample
+            else:
+                backend.latency_ewma += self.ewma_alpha * (sample - backend.latency_ewma)
+            others = [b.latency_ewma for b in self.backends if b is not backend and b.state == HEALTHY and b.latency_ewma is not None]
+            if others and backend.latency_ewma > self.slow_factor * statistics.median(others):
+                self._eject(backend)
+
+    def _eject(self, backend: _Backend):
+        """Ejects `backend` unless it is the last healthy one (caller holds the lock)."""
+        if backend.state == EJECTED or sum(b.state == HEALTHY for b in self.backends) <= 1:
+            return
+        backend.state = EJECTED
+        backend.ejected_until = time.time() + self.eject_seconds
+        backend.ejections += 1
+
+    def _cancel_elsewhere(self, session: Optional[str], chosen: _Backend):
+        # A newer call of the session may land on another backend than the one still running its old call
+        if session is not None:
+            for backend in self.backends:
+                if backend is not chosen:
+                    backend.pool.cancel(session)
+
+    def cancel(self, session: str):
+        """Cancels the running call of `session` on every backend."""
+        for backend in self.backends:
+            backend.pool.cancel(session)
+
+    def predict(
+        self,
+        *args,
+        api_name: str,
+        session: Optional[str] = None,
+        affinity: Optional[str] = None,
+        cost: float = 1.0,
+        trace: Trace = NULL_TRACE,
+        **kwargs,
+    ) -> Any:
+        """Like `BackendPool.predict`, on the chosen backend; `cost` normalizes the latency used for slow-backend ejection."""
+        tried: List[_Backend] = []
+        while True:
+            backend = self._choose(affinity, tried)
+            tried.append(backend)
+            trace.annotate(backend=backend.src, backends_tried=len(tried))
+            self._cancel_elsewhere(session, backend)
+            start_time = time.time()
+            try:
+                result = backend.pool.predict(*args, api_name=api_name, session=session, trace=trace, **kwargs)
+            except RequestCancelled:
+                raise
+            except Exception:
+                self._record(backend, None, failed=True)
+                if len(tried) >= min(2, len(self.backends)):
+                    raise
+                continue
+            self._record(backend, time.time() - start_time, cost=cost)
+            return result
+
+    def stream(
+        self,
+        *args,
+        api_name: str,
+        session: Optional[str] = None,
+        affinity: Optional[str] = None,
+        cost: float = 1.0,
+        trace: Trace = NULL_TRACE,
+        **kwargs,
+    ) -> Iterator[Any]:
+        """Like `BackendPool.stream`, on the chosen backend; fails over once if the call fails before its first output."""
+        tried: List[_Backend] = []
+        while True:
+            backend = self._choose(affinity, tried)
+            tried.append(backend)
+            trace.annotate(backend=backend.src, backends_tried=len(tried))
+            self._cancel_elsewhere(session, backend)
+            start_time = time.time()
+            streamed = False
+            try:
+                for output in backend.pool.stream(*args, api_name=api_name, session=session, trace=trace, **kwargs):
+                    streamed = True
+                    yield output
+            except RequestCancelled:
+                raise
+            except Exception:
+                self._record(backend, None, failed=True)
+                if streamed or len(tried) >= min(2, len(self.backends)):
+                    raise
+                continue
+            self._record(backend, time.time() - start_time, cost=cost)
+            return
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns healthy/ejected counts plus per-backend load, latency and counters (flattened for the gauge)."""
+        with self._lock:
+            result: Dict[str, Any] = {
+                "healthy": sum(b.state == HEALTHY for b in self.backends),
+                "ejected": sum(b.state == EJECTED for b in self.backends),
+            }
+            for i, backend in enumerate(self.backends):
+                result[f"backend{i}_in_flight"] = backend.pool.load
+                result[f"backend{i}_healthy"] = int(backend.state == HEALTHY)
+                result[f"backend{i}_latency_per_cost"] = backend.latency_ewma or 0.0
+                result[f"backend{i}_requests"] = backend.requests
+                result[f"backend{i}_failures"] = backend.failures
+                result[f"backend{i}_ejections"] = backend.ejections
+                result[f"backend{i}_affinity_hits"] = backend.affinity_hits
+            return result
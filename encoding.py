@@ -0,0 +1,102 @@
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+
+FORMATS = {"webp": "WEBP", "jpeg": "JPEG", "png": "PNG"}
+
+
+class ImageEncoder:
+    """
+    Encodes result images to WebP/JPEG on a thread pool (Pillow releases the GIL while encoding) and writes
+    them to files Gradio can serve as-is, so nothing is re-encoded to PNG on the request thread. Preview
+    frames use `preview_quality`, final frames `quality`. Only the `max_files` newest files are kept.
+    """
+    def __init__(
+        self,
+        format: str = "webp",
+        quality: int = 90,
+        preview_quality: int = 60,
+        max_workers: int = 4,
+        output_dir: Optional[str] = None,
+        max_files: int = 256,
+        webp_method: int = 1,  # 0 (fastest) .. 6 (smallest files)
+    ):
+        if format not in FORMATS:
+            raise ValueError(f"`format` must be one of {sorted(FORMATS)}, got {format!r}.")
+        self.format = format
+        self.quality = quality
+        self.preview_quality = preview_quality
+        self.webp_method = webp_method
+        self.output_dir = output_dir or os.path.join(tempfile.gettempdir(), "realtime_flux_images")
+        self.max_files = max_files
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-encoder")
+        self._lock = threading.Lock()
+        self._files = deque()
+        self.encoded = 0
+        self.encoded_bytes = 0
+        self.encode_seconds = 0.0
+
+    def encode(self, image: Any, preview: bool = False) -> bytes:
+        """Encodes a PIL image or an (H, W, 3) array (uint8, or float in [0, 1]) on the calling thread."""
+        start_time = time.perf_counter()
+        if isinstance(image, np.ndarray):
+            if image.dtype != np.uint8:
+                image = (image * 255).round().clip(0, 255).astype(np.uint8)
+            image = Image.fromarray(image)
+        options = {"quality": self.preview_quality if preview else self.quality}
+        if self.format == "webp":
+            options["method"] = self.webp_method
+        elif self.format == "png":
+            options = {"compress_level": 1}
+        buffer = BytesIO()
+        image.save(buffer, format=FORMATS[self.format], **options)
+        data = buffer.getvalue()
+        with self._lock:
+            self.encoded += 1
+            self.encoded_bytes += len(data)
+            self.encode_seconds += time.perf_counter() - start_time
+        return data
+
+    def _encode_to_file(self, image: Any, preview: bool) -> str:
+        data = self.encode(image, preview)
+        fd, path = tempfile.mkstemp(dir=self.output_dir, suffix=f".{self.format}")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        with self._lock:
+            self._files.append(path)
+            expired = [self._files.popleft() for _ in range(len(self._files) - self.max_files)]
+        for old_path in expired:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+        return path
+
+    def submit(self, image: Any, preview: bool = False) -> "Future[str]":
+        """Encodes on the pool; the future resolves to the path of the encoded file."""
+        return self._executor.submit(self._encode_to_file, image, preview)
+
+    def save(self, image: Any, preview: bool = False) -> str:
+        """Encodes on the pool and waits for the file path."""
+        return self.submit(image, preview).result()
+
+    def save_many(self, images: List[Any], preview: bool = False) -> List[str]:
+        """Encodes several images in parallel; returns their paths in order."""
+        return [future.result() for future in [self.submit(image, preview) for image in images]]
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns counts, total bytes and mean encode time."""
+        return {
+            "encoded": self.encoded,
+            "encoded_bytes": self.encoded_bytes,
+            "mean_encode_seconds": self.encode_seconds / self.encoded if self.encoded else 0.0,
+        }
@@ -0,0 +1,108 @@
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+FULL = "full"  # Whole batch in one decoder pass
+SLICED = "sliced"  # One batch element at a time
+TILED = "tiled"  # One batch element at a time, in overlapping spatial tiles
+
+ACTIVATION_FACTOR = 3  # Full-resolution feature maps alive at once in a decoder resnet (input, hidden, output)
+DENOISE_ACTIVATION_FACTOR = 8  # Token-width tensors alive at once in a transformer block (4x feed-forward + residuals)
+
+
+def estimate_decode_bytes(vae_config, batch_size: int, height: int, width: int, element_size: int) -> int:
+    """
+    Estimates the peak activation memory of decoding a `batch_size` x `height` x `width` image with an
+    AutoencoderKL-style decoder. The widest feature map at full resolution dominates: the last up block
+    receives the upsampled output of the previous (wider) block.
+    """
+    channels = list(reversed(vae_config.block_out_channels))
+    full_resolution_channels = max(channels[-2:])
+    activations = ACTIVATION_FACTOR * full_resolution_channels * height * width
+    output = vae_config.out_channels * height * width
+    return batch_size * (activations + output) * element_size
+
+
+def estimate_denoise_bytes(transformer_config, batch_size: int, height: int, width: int, text_seq_len: int, element_size: int) -> int:
+    """
+    Estimates the activation memory of one transformer forward pass: image plus text tokens times the
+    model width, times the widest intermediate (the 4x feed-forward) and the live residual copies.
+    """
+    image_seq_len = (height // 16) * (width // 16)
+    inner_dim = transformer_config.num_attention_heads * transformer_config.attention_head_dim
+    return batch_size * (image_seq_len + text_seq_len) * inner_dim * DENOISE_ACTIVATION_FACTOR * element_size
+
+
+class MemoryPolicy:
+    """
+    Chooses how to run the VAE decode so its estimated peak stays under `budget_bytes` (full, then sliced,
+    then tiled), and decides when cached device memory is worth returning to the driver: only between
+    requests, once more than `release_above_bytes` is reserved but unused.
+    """
+    def __init__(self, budget_bytes: int, release_above_bytes: Optional[int] = 1024 ** 3):
+        if budget_bytes <= 0:
+            raise ValueError("`budget_bytes` must be positive.")
+        self.budget_bytes = budget_bytes
+        self.release_above_bytes = release_above_bytes
+        self._lock = threading.Lock()
+        self.decodes = {FULL: 0, SLICED: 0, TILED: 0}
+        self.releases = 0
+        self.over_budget = 0
+        self.last_estimated_bytes = 0
+        self.last_measured_bytes: Optional[int] = None
+        self.max_measured_bytes = 0
+
+    def estimates(self, vae, batch_size: int, height: int, width: int, element_size: int) -> Dict[str, int]:
+        """Estimated peak bytes of every decode mode the VAE supports."""
+        result = {
+            FULL: estimate_decode_bytes(vae.config, batch_size, height, width, element_size),
+            SLICED: estimate_decode_bytes(vae.config, 1, height, width, element_size)
+            + (batch_size - 1) * vae.config.out_channels * height * width * element_size,
+        }
+        tile_size = getattr(vae, "tile_sample_min_size", None)
+        if tile_size and hasattr(vae, "tiled_decode"):
+            tile_height, tile_width = min(tile_size, height), min(tile_size, width)
+            # Tiles of one element plus the blended output of the whole batch
+            result[TILED] = estimate_decode_bytes(vae.config, 1, tile_height, tile_width, element_size) \
+                + batch_size * vae.config.out_channels * height * width * element_size
+        return result
+
+    def choose(self, vae, batch_size: int, height: int, width: int, element_size: int) -> Tuple[str, int]:
+        """Returns the cheapest-to-run decode mode that fits the budget, with its estimated peak bytes."""
+        estimates = self.estimates(vae, batch_size, height, width, element_size)
+        for mode in (FULL, SLICED, TILED):
+            if mode in estimates and estimates[mode] <= self.budget_bytes:
+                break
+        else:
+            # Nothing fits: take the smallest and let the allocator try
+            mode = min(estimates, key=estimates.get)
+            with self._lock:
+                self.over_budget += 1
+        with self._lock:
+            self.decodes[mode] += 1
+            self.last_estimated_bytes = estimates[mode]
+        return mode, estimates[mode]
+
+    def should_release(self, reserved_bytes: int, allocated_bytes: int) -> bool:
+        """True when enough memory sits unused in the allocator cache to be worth releasing."""
+        if self.release_above_bytes is None or reserved_bytes - allocated_bytes <= self.release_above_bytes:
+            return False
+        with self._lock:
+            self.releases += 1
+        return True
+
+    def record_peak(self, measured_bytes: int):
+        with self._lock:
+            self.last_measured_bytes = measured_bytes
+            self.max_measured_bytes = max(self.max_measured_bytes, measured_bytes)
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the budget, decode counts per mode, releases and the last estimated/measured peaks."""
+        return {
+            "budget_bytes": self.budget_bytes,
+            **{f"decodes_{mode}": count for mode, count in self.decodes.items()},
+            "over_budget": self.over_budget,
+            "releases": self.releases,
+            "last_estimated_bytes": self.last_estimated_bytes,
+            "last_measured_bytes": self.last_measured_bytes,
+            "max_measured_bytes": self.max_measured_bytes,
+        }
@@ -0,0 +1,220 @@
+"""
+Latency histograms per stage, labelled by resolution and step count, plus a Prometheus-style scrape endpoint:
+
+    registry = MetricsRegistry()
+    with registry.time("vae_decode", resolution="1024x1024", steps=1):
+        ...
+    start_http_server(registry, port=9100)  # GET /metrics
+"""
+import json
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+QUANTILES = (0.5, 0.95, 0.99)
+WINDOW_SIZE = 2048  # Recent samples kept per series for the quantiles
+
+
+def format_resolution(width, height) -> str:
+    """Resolution label used for every series, e.g. `1024x768` (width first)."""
+    return f"{int(width)}x{int(height)}"
+
+
+class Histogram:
+    """Count and sum over all samples, quantiles over a sliding window of recent samples."""
+    def __init__(self, window_size: int = WINDOW_SIZE):
+        self.samples = deque(maxlen=window_size)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.samples.append(value)
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    def summary(self) -> Dict[str, float]:
+        result = {"count": self.count, "sum": self.sum}
+        result.update({f"p{int(q * 100)}": self.quantile(q) for q in QUANTILES})
+        return result
+
+
+class MetricsRegistry:
+    """Thread-safe collection of stage latency histograms and gauge callbacks."""
+    def __init__(self, prefix: str = "flux", window_size: int = WINDOW_SIZE):
+        self.prefix = prefix
+        self.window_size = window_size
+        self._lock = threading.Lock()
+        self._histograms: Dict[Tuple, Histogram] = {}
+        self._gauges: Dict[str, Callable[[], Any]] = {}
+
+    def observe(self, stage: str, seconds: float, **labels):
+        """Records one duration for `stage` under the given labels (e.g. resolution, steps); None labels are dropped."""
+        key = (stage, tuple(sorted((name, str(value)) for name, value in labels.items() if value is not None)))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.window_size)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, stage: str, **labels) -> Iterator[None]:
+        """Times the enclosed block as one sample of `stage`."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start_time, **labels)
+
+    def register_gauge(self, name: str, fn: Callable[[], Any]):
+        """Registers a callback returning a number or a flat dict of numbers, read at scrape time."""
+        self._gauges[name] = fn
+
+    def summary(self) -> Dict[str, Any]:
+        """Returns quantiles per stage and labels, plus the current gauge values."""
+        with self._lock:
+            items = list(self._histograms.items())
+        stages = {}
+        for (stage, labels), histogram in sorted(items):
+            name = stage + "".join(f"|{k}={v}" for k, v in labels)
+            stages[name] = histogram.summary()
+        return {"stages": stages, "gauges": {name: fn() for name, fn in self._gauges.items()}}
+
+    def render_prometheus(self) -> str:
+        """Renders all series in the Prometheus text exposition format."""
+        metric = f"{self.prefix}_stage_seconds"
+        lines = [f"# TYPE {metric} summary"]
+        with self._lock:
+            items = [(key, histogram.summary()) for key, histogram in sorted(self._histograms.items())]
+        for (stage, labels), summary in items:
+            label_text = ",".join([f'stage="{stage}"'] + [f'{k}="{v}"' for k, v in labels])
+            for q in QUANTILES:
+                lines.append(f'{metric}{{{label_text},quantile="{q}"}} {summary[f"p{int(q * 100)}"]:.6f}')
+            lines.append(f"{metric}_sum{{{label_text}}} {summary['sum']:.6f}")
+            lines.append(f"{metric}_count{{{label_text}}} {summary['count']}")
+        for name, fn in sorted(self._gauges.items()):
+            value = fn()
+            values = value.items() if isinstance(value, dict) else [("", value)]
+            for field, number in values:
+                if isinstance(number, (int, float)):
+                    gauge = f"{self.prefix}_{name}" + (f"_{field}" if field else "")
+                    lines.append(f"# TYPE {gauge} gauge")
+                    lines.append(f"{gauge} {number}")
+        return "\n".join(lines) + "\n"
+
+
+# Shared registry used by the apps and the pipeline
+REGISTRY = MetricsRegistry()
+
+
+def start_http_server(
+    registry: MetricsRegistry = REGISTRY,
+    port: int = 9100,
+    addr: str = "0.0.0.0",
+    readiness: Optional[Callable[[], Dict[str, Any]]] = None,
+) -> Optional[ThreadingHTTPServer]:
+    """
+    Serves `registry` at http://addr:port/metrics from a daemon thread. With `readiness` (a callback returning
+    a dict with a boolean "ready"), GET /ready answers 200 when ready and 503 otherwise, with the dict as JSON.
+    Metrics are optional: when the port can't be bound (e.g. another worker on this host has it) the error
+    is logged and None is returned instead of failing the app's startup.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path == "/metrics":
+                self._send(200, registry.render_prometheus(), "text/plain; version=0.0.4")
+            elif path == "/ready" and readiness is not None:
+                status = readiness()
+                self._send(200 if status.get("ready") else 503, json.dumps(status), "application/json")
+            else:
+                self.send_error(404)
+
+        def _send(self, code, text, content_type):
+            body = text.encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer((addr, port), Handler)
+    except OSError as e:
+        print(f"Metrics endpoint disabled: cannot bind {addr}:{port} ({e})")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class StageTimer:
+    """
+    Splits one request into consecutive stages: each `lap(stage)` records the time since the previous lap.
+    Durations go to `registry` (labelled), are summed per stage into `timings` and passed to `on_lap(stage, start,
+    end)` as perf_counter values. Does nothing when all three are None. `synchronize` (e.g. `torch.cuda.synchronize`)
+    is called before reading the clock so asynchronous device work is attributed to the right stage.
+    """
+    def __init__(
+        self,
+        registry: Optional[MetricsRegistry] = None,
+        timings: Optional[Dict[str, float]] = None,
+        synchronize: Optional[Callable[[], None]] = None,
+        on_lap: Optional[Callable[[str, float, float], None]] = None,
+        **labels,
+    ):
+        self.registry = registry
+        self.timings = timings
+        self.synchronize = synchronize
+        self.on_lap = on_lap
+        self.labels = labels
+        self.enabled = registry is not None or timings is not None or on_lap is not None
+        self._last = time.perf_counter()
+        self.reset()
+
+    def reset(self):
+        """Restarts the clock without recording, e.g. after handing a frame to the caller."""
+        if self.enabled:
+            if self.synchronize is not None:
+                self.synchronize()
+            self._last = time.perf_counter()
+
+    def lap(self, stage: str):
+        """Records the time since the previous lap (or reset) as one sample of `stage`."""
+        if not self.enabled:
+            return
+        if self.synchronize is not None:
+            self.synchronize()
+        now = time.perf_counter()
+        start, self._last = self._last, now
+        elapsed = now - start
+        if self.on_lap is not None:
+            self.on_lap(stage, start, now)
+        if self.timings is not None:
+            self.timings[stage] = self.timings.get(stage, 0.0) + elapsed
+        if self.registry is not None:
+            self.registry.observe(stage, elapsed, **self.labels)
+
+
+def parse_latency(text: str) -> Optional[float]:
+    """Extracts the seconds from a `Latency: X seconds` string returned by the Space."""
+    match = re.search(r"([0-9]+(?:\.[0-9]+)?) seconds", text or "")
+    return float(match.group(1)) if match else None
+
+
+def format_breakdown(timings: Optional[Dict[str, float]]) -> str:
+    """Compact per-stage breakdown for the latency box, e.g. `encode 0.02 · denoise_step 0.61 · vae_decode 0.20`."""
+    if not timings:
+        return ""
+    return " · ".join(f"{stage} {seconds:.2f}" for stage, seconds in timings.items())
@@ -0,0 +1,283 @@
+"""
+Sampled request profiling. A fraction of requests (and, with a latency threshold, every request that turns
+out slow) leaves a trace on disk, in a ring of the most recent `max_traces`:
+
+    profiler = RequestProfiler("traces", sample_rate=0.01, slow_threshold=5.0, torch_profiler=True)
+    with profiler.trace("generate_images", prompt=prompt, width=width, height=height) as trace:
+        with trace.span("transformer", step=i):
+            ...
+        trace.enter("queue")  # Consecutive phases observed by polling, e.g. of a remote job
+
+Each kept request writes `<time>-<kind>-<request id>.json`, a Chrome trace (open in Perfetto or
+chrome://tracing) of its spans with the request parameters under "otherData". Sampled requests can also
+run the torch profiler (operators and allocator activity, spans show up as ranges) and then write
+`<same name>.torch.json` next to it; only one torch profile runs at a time, and requests kept only for being
+slow have spans but no torch profile, since the decision is made once they finish.
+"""
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, Iterator, List, Optional
+
+SAMPLE_RATE = 0.01  # Fraction of requests traced (with the torch profiler, when enabled)
+MAX_TRACES = 64  # Traces kept on disk; the oldest are deleted first
+
+TRACE_SUFFIX = ".json"
+TORCH_TRACE_SUFFIX = ".torch.json"
+
+
+class Trace:
+    """Spans of one request, relative to its start; `kept` tells after the request whether it was written."""
+    def __init__(self, kind: str, params: Dict[str, Any], sampled: bool, torch_profile=None):
+        self.request_id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.params = params
+        self.sampled = sampled
+        self.torch_profile = torch_profile
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.kept = False
+        self.annotations: Dict[str, Any] = {}
+        self.spans: List[Dict[str, Any]] = []
+        self._phase: Optional[Dict[str, Any]] = None
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, start: float, end: float, **args):
+        """Records a span from perf_counter values `start` to `end`."""
+        with self._lock:
+            self.spans.append({"name": name, "start": start - self.start, "duration": end - start, "args": args})
+
+    @contextmanager
+    def span(self, name: str, **args) -> Iterator[None]:
+        """Records the enclosed block as a span (and as a range in the torch profile, if one runs)."""
+        if self.torch_profile is not None:
+            import torch
+            label = name + "".join(f" {key}={value}" for key, value in args.items())
+            scope = torch.profiler.record_function(label)
+        else:
+            scope = nullcontext()
+        start = time.perf_counter()
+        try:
+            with scope:
+                yield
+        finally:
+            self.add_span(name, start, time.perf_counter(), **args)
+
+    def enter(self, phase: Optional[str], **args):
+        """Ends the current phase and starts `phase` (None only ends it); re-entering the current phase is a no-op."""
+        now = time.perf_counter()
+        with self._lock:
+            current = self._phase
+            if current is not None and current["name"] == phase:
+                return
+            self._phase = {"name": phase, "start": now, "args": args} if phase is not None else None
+        if current is not None:
+            self.add_span(current["name"], current["start"], now, **current["args"])
+
+    def annotate(self, **values):
+        """Adds request details learned along the way (e.g. the backend that served it)."""
+        with self._lock:
+            self.annotations.update(values)
+
+    def to_chrome(self) -> Dict[str, Any]:
+        with self._lock:
+            spans = list(self.spans)
+        events = [
+            {"name": s["name"], "ph": "X", "ts": s["start"] * 1e6, "dur": s["duration"] * 1e6, "pid": 0, "tid": 0, "args": s["args"]}
+            for s in spans
+        ]
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "request_id": self.request_id,
+                "kind": self.kind,
+                "params": self.params,
+                "started_at": self.started_at,
+                "duration": self.duration,
+                "sampled": self.sampled,
+                "annotations": self.annotations,
+            },
+        }
+
+
+class _NullTrace(Trace):
+    """Stand-in for requests that are not traced: every method is a no-op."""
+    def __init__(self):
+        super().__init__("", {}, sampled=False)
+        self.request_id = None
+
+    def add_span(self, name, start, end, **args):
+        pass
+
+    @contextmanager
+    def span(self, name, **args):
+        yield
+
+    def enter(self, phase, **args):
+        pass
+
+    def annotate(self, **values):
+        pass
+
+
+NULL_TRACE = _NullTrace()
+
+
+class TraceRing:
+    """Directory holding the `max_traces` most recent traces (each with its optional torch profile)."""
+    def __init__(self, directory: str, max_traces: int = MAX_TRACES):
+        if max_traces < 1:
+            raise ValueError("`max_traces` must be at least 1.")
+        self.directory = directory
+        self.max_traces = max_traces
+        self._lock = threading.Lock()
+        self._names: Optional[List[str]] = None
+
+    def _existing(self) -> List[str]:
+        # Names sort by start time, so a restart continues the ring where it left off
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            name[:-len(TRACE_SUFFIX)] for name in os.listdir(self.directory)
+            if name.endswith(TRACE_SUFFIX) and not name.endswith(TORCH_TRACE_SUFFIX)
+        )
+
+    def path(self, name: str, suffix: str = TRACE_SUFFIX) -> str:
+        return os.path.join(self.directory, name + suffix)
+
+    def add(self, trace: Trace, torch_profile=None) -> str:
+        """Writes `trace` (and the stopped `torch_profile`) and deletes the oldest traces beyond the limit."""
+        name = f"{int(trace.started_at * 1000):013d}-{trace.kind.strip('/').replace('/', '_')}-{trace.request_id}"
+        os.makedirs(self.directory, exist_ok=True)
+        if torch_profile is not None:
+            torch_profile.export_chrome_trace(self.path(name, TORCH_TRACE_SUFFIX))
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(trace.to_chrome(), f, default=str)
+        os.replace(tmp_path, self.path(name))
+        with self._lock:
+            if self._names is None:
+                self._names = self._existing()
+            else:
+                self._names.append(name)
+            stale, self._names = self._names[:-self.max_traces], self._names[-self.max_traces:]
+        for old in stale:
+            for suffix in (TRACE_SUFFIX, TORCH_TRACE_SUFFIX):
+                try:
+                    os.remove(self.path(old, suffix))
+                except FileNotFoundError:
+                    pass
+        return self.path(name)
+
+
+class RequestProfiler:
+    """
+    Decides per request whether to trace it: with probability `sample_rate`, or afterwards when it took at
+    least `slow_threshold` seconds (None disables that). With `torch_profiler` sampled requests also run
+    `torch.profiler` with memory profiling (CUDA activity included when available); it sees every thread,
+    so concurrent requests show up in it too. Kept traces go to a `TraceRing` in `output_dir`.
+    """
+    def __init__(
+        self,
+        output_dir: str,
+        sample_rate: float = SAMPLE_RATE,
+        slow_threshold: Optional[float] = None,
+        max_traces: int = MAX_TRACES,
+        torch_profiler: bool = False,
+    ):
+        self.ring = TraceRing(output_dir, max_traces)
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.torch_profiler = torch_profiler
+        self._torch_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.sampled = 0
+        self.slow = 0
+        self.written = 0
+        self.torch_busy = 0
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 or self.slow_threshold is not None
+
+    def _start_torch_profile(self):
+        import torch
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        profile = torch.profiler.profile(activities=activities, profile_memory=True, record_shapes=True)
+        profile.start()
+        return profile
+
+    @contextmanager
+    def trace(self, kind: str, **params) -> Iterator[Trace]:
+        """Traces the enclosed request (or yields `NULL_TRACE` when it can't be kept); `params` are stored with it."""
+        if not self.enabled:
+            yield NULL_TRACE
+            return
+        sampled = random.random() < self.sample_rate
+        if not sampled and self.slow_threshold is None:
+            with self._lock:
+                self.requests += 1
+            yield NULL_TRACE
+            return
+        torch_profile = None
+        if sampled and self.torch_profiler:
+            if self._torch_lock.acquire(blocking=False):
+                try:
+                    torch_profile = self._start_torch_profile()
+                except Exception:
+                    self._torch_lock.release()
+                    raise
+            else:
+                with self._lock:
+                    self.torch_busy += 1
+        trace = Trace(kind, params, sampled, torch_profile)
+        try:
+            yield trace
+        finally:
+            trace.enter(None)
+            trace.duration = time.perf_counter() - trace.start
+            if torch_profile is not None:
+                torch_profile.stop()
+                self._torch_lock.release()
+            slow = self.slow_threshold is not None and trace.duration >= self.slow_threshold
+            with self._lock:
+                self.requests += 1
+                self.sampled += sampled
+                self.slow += slow
+            if sampled or slow:
+                self._write(trace, torch_profile)
+
+    def _write(self, trace: Trace, torch_profile):
+        # Profiling must never fail the request it observed
+        try:
+            self.ring.add(trace, torch_profile)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            return
+        trace.kept = True
+        with self._lock:
+            self.written += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns requests seen, sampled, slow, written and write errors, plus sampled requests without a torch profile."""
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "sampled": self.sampled,
+                "slow": self.slow,
+                "written": self.written,
+                "torch_busy": self.torch_busy,
+                "errors": self.errors,
+            }
@@ -0,0 +1,139 @@
+"""
+Realtime typing sends a request per keystroke. Per session, this decides whether a new prompt needs work:
+
+    decision = reuse.decide(session, prompt, seed, width, height, num_inference_steps)
+    if decision.action == SKIP:  # Same prompt once normalized: keep the image on screen
+        ...
+    elif decision.action == REUSE:  # Small edit: refine the last latents from sigma=decision.strength
+        ...
+    reuse.completed(session, decision)  # Once the image was actually shown
+"""
+import difflib
+import string
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+from result_cache import normalize_prompt
+
+SKIP = "skip"
+REUSE = "reuse"
+FULL = "full"
+
+TRAILING_PUNCTUATION = string.punctuation + " "
+
+
+def normalize_realtime_prompt(prompt: str) -> str:
+    """`normalize_prompt` plus trailing punctuation dropped: "a cat," and "a cat" render the same while typing."""
+    return normalize_prompt(prompt or "").rstrip(TRAILING_PUNCTUATION)
+
+
+def edit_size(a: str, b: str) -> int:
+    """Characters inserted, deleted or replaced to turn `a` into `b` (a cheap upper bound on the edit distance)."""
+    opcodes = difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes()
+    return sum(max(i2 - i1, j2 - j1) for tag, i1, i2, j1, j2 in opcodes if tag != "equal")
+
+
+class Decision(NamedTuple):
+    action: str
+    key: Tuple  # (normalized prompt, seed, width, height, steps) of the request
+    strength: Optional[float] = None  # Sigma the previous latents are re-noised to (REUSE only)
+    edit: int = 0
+
+
+class _Shown(NamedTuple):
+    key: Tuple
+    chain: int  # Consecutive REUSE results leading to this image
+
+
+class PromptReuse:
+    """
+    Tracks the last image shown per session (up to `max_sessions`). A request whose normalized prompt, seed
+    and shape match it is skipped, unless a run for another key was dispatched since (it would otherwise
+    finish later and overwrite the screen with a stale image); one whose prompt differs by at most `max_edit_chars` characters (and
+    `max_edit_fraction` of its length) reuses its latents, re-noised to a sigma between `min_strength` and
+    `max_strength` growing with the edit. After `max_chain` reuses in a row a full generation resets the drift.
+    `min_strength=None` disables reuse, leaving only skips.
+    """
+    def __init__(
+        self,
+        max_edit_chars: int = 12,
+        max_edit_fraction: float = 0.3,
+        min_strength: Optional[float] = 0.6,
+        max_strength: float = 0.85,
+        max_chain: int = 8,
+        max_sessions: int = 4096,
+    ):
+        if min_strength is not None and not 0.0 < min_strength <= max_strength <= 1.0:
+            raise ValueError("Strengths must satisfy 0 < min_strength <= max_strength <= 1.")
+        self.max_edit_chars = max_edit_chars
+        self.max_edit_fraction = max_edit_fraction
+        self.min_strength = min_strength
+        self.max_strength = max_strength
+        self.max_chain = max_chain
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._shown: "OrderedDict[str, _Shown]" = OrderedDict()
+        self._dispatched: "OrderedDict[str, Tuple]" = OrderedDict()  # Key of the last request that was not skipped
+        self.counts = {SKIP: 0, REUSE: 0, FULL: 0}
+        self.reuses_completed = 0
+        self.edit_chars = 0
+
+    def decide(self, session: Optional[str], prompt: str, seed, width, height, num_inference_steps, randomize_seed: bool = False) -> Decision:
+        """Classifies a realtime request against the last image shown to `session`."""
+        normalized = normalize_realtime_prompt(prompt)
+        key = (normalized, None if randomize_seed else int(float(seed)), int(width), int(height), int(num_inference_steps))
+        with self._lock:
+            shown = self._shown.get(session) if session is not None else None
+            dispatched = self._dispatched.get(session, key) if session is not None else key
+            decision = Decision(FULL, key)
+            if shown is not None:
+                if shown.key == key and dispatched == key:
+                    decision = Decision(SKIP, key)
+                elif self.min_strength is not None and shown.key[1:] == key[1:] and shown.chain < self.max_chain:
+                    edit = edit_size(shown.key[0], normalized)
+                    if edit <= self.max_edit_chars and edit <= self.max_edit_fraction * max(len(normalized), 1):
+                        strength = self.min_strength + (self.max_strength - self.min_strength) * edit / max(self.max_edit_chars, 1)
+                        decision = Decision(REUSE, key, strength, edit)
+            self.counts[decision.action] += 1
+            if session is not None and decision.action != SKIP:
+                self._dispatched.pop(session, None)
+                self._dispatched[session] = key
+                while len(self._dispatched) > self.max_sessions:
+                    self._dispatched.popitem(last=False)
+        return decision
+
+    def completed(self, session: Optional[str], decision: Decision):
+        """Records that the image for `decision` is now on screen for `session`."""
+        if session is None or decision.action == SKIP:
+            return
+        with self._lock:
+            previous = self._shown.pop(session, None)
+            chain = previous.chain + 1 if decision.action == REUSE and previous is not None else 0
+            self._shown[session] = _Shown(decision.key, chain)
+            while len(self._shown) > self.max_sessions:
+                self._shown.popitem(last=False)
+            if decision.action == REUSE:
+                self.reuses_completed += 1
+                self.edit_chars += decision.edit
+
+    def forget(self, session: str):
+        """Drops the session's state, e.g. when its stored latents are gone."""
+        with self._lock:
+            self._shown.pop(session, None)
+            self._dispatched.pop(session, None)
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns skip/reuse/full counts, the fraction of requests that skipped or reused, and the mean reused edit."""
+        with self._lock:
+            total = sum(self.counts.values())
+            return {
+                "sessions": len(self._shown),
+                "skipped": self.counts[SKIP],
+                "reused": self.counts[REUSE],
+                "full": self.counts[FULL],
+                "reuses_completed": self.reuses_completed,
+                "skip_rate": self.counts[SKIP] / total if total else 0.0,
+                "reuse_rate": self.counts[REUSE] / total if total else 0.0,
+                "mean_reused_edit_chars": self.edit_chars / self.reuses_completed if self.reuses_completed else 0.0,
+            }
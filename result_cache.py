@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "realtime_flux_results")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Collapses whitespace the same way the CLIP and T5 tokenizers do."""
+    return " ".join(prompt.split())
+
+
+class ResultCache:
+    """
+    Cache of encoded result images in a size-capped directory on disk, least recently used evicted first.
+    Only deterministic requests (fixed seed) should be cached. There is no in-memory tier: callers need a
+    file path, so a hit has to be served from disk anyway (and the page cache keeps hot files in memory).
+    """
+    def __init__(
+        self,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        max_disk_bytes: int = 1024 ** 3,
+    ):
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._lock = threading.Lock()
+        self._disk: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (path, size), oldest first
+        self._disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def make_key(api_identity: str, api_name: str, prompt: str, **params) -> str:
+        """Hashes the normalized request parameters together with the model/API identity."""
+        payload = {
+            "api": api_identity,
+            "endpoint": api_name,
+            "prompt": normalize_prompt(prompt),
+            **{name: int(float(value)) for name, value in params.items()},
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _load_index(self):
+        """Indexes files left by a previous run, oldest first."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if os.path.isfile(path) and not name.endswith(".tmp"):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, os.path.splitext(name)[0], path, stat.st_size))
+        for _, key, path, size in sorted(entries):
+            self._disk[key] = (path, size)
+            self._disk_bytes += size
+        self._evict()
+
+    def _evict(self):
+        while self._disk and self._disk_bytes > self.max_disk_bytes:
+            _, (path, size) = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the path of the cached image for `key`, or None on a miss."""
+        with self._lock:
+            entry = self._disk.get(key)
+            if entry is not None and not os.path.exists(entry[0]):
+                # Deleted behind our back: forget it so its size stops counting against the cap
+                del self._disk[key]
+                self._disk_bytes -= entry[1]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._disk.move_to_end(key)
+            self.hits += 1
+            path = entry[0]
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def put(self, key: str, path: str) -> str:
+        """Copies the result image at `path` into the cache and returns the cached path."""
+        with open(path, "rb") as f:
+            data = f.read()
+        ext = os.path.splitext(path)[1] or ".png"
+        with self._lock:
+            return self._store(key, data, ext)
+
+    def _store(self, key: str, data: bytes, ext: str) -> str:
+        target = os.path.join(self.cache_dir, key + ext)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, target)
+        if key in self._disk:
+            self._disk_bytes -= self._disk.pop(key)[1]
+        self._disk[key] = (target, len(data))
+        self._disk_bytes += len(data)
+        self._evict()
+        return target
+
+    def clear(self):
+        """Removes every cached result."""
+        with self._lock:
+            self._disk.clear()
+            self._disk_bytes = 0
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns hit/miss counters and the disk usage."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "disk_entries": len(self._disk),
+            "disk_bytes": self._disk_bytes,
+        }
@@ -0,0 +1,79 @@
+import threading
+from typing import Any, Dict, Optional
+
+
+class GenerationCancelled(Exception):
+    """Raised when a generation was superseded by a newer request from the same session."""
+
+
+class GenerationToken:
+    """
+    Cancellation flag for one generation. `generate_images` checks `cancelled` between scheduler steps
+    and counts finished steps in `steps_done`.
+    """
+    def __init__(self, steps_total: int = 0):
+        self.steps_total = steps_total
+        self.steps_done = 0
+        self._event = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self):
+        self._event.set()
+
+
+class SessionTokens:
+    """
+    Hands out one `GenerationToken` per session; starting a new generation cancels the previous one,
+    so typing in realtime mode never finishes images nobody will see. Keeps work-saved counters.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active: Dict[str, GenerationToken] = {}
+        self.runs_started = 0
+        self.runs_completed = 0
+        self.runs_superseded = 0
+        self.steps_run = 0
+        self.steps_saved = 0
+        self.decodes_skipped = 0
+
+    def begin(self, session: Optional[str], steps_total: int) -> GenerationToken:
+        """Returns a fresh token for `session`, cancelling the one still running."""
+        token = GenerationToken(int(steps_total))
+        with self._lock:
+            self.runs_started += 1
+            if session is not None:
+                previous = self._active.get(session)
+                self._active[session] = token
+                if previous is not None:
+                    previous.cancel()
+        return token
+
+    def finish(self, session: Optional[str], token: GenerationToken, completed: bool):
+        """Records the outcome of `token`'s generation; `completed` is False when its decode was skipped."""
+        with self._lock:
+            if session is not None and self._active.get(session) is token:
+                del self._active[session]
+            self.steps_run += token.steps_done
+            if completed:
+                self.runs_completed += 1
+            else:
+                self.runs_superseded += 1
+                self.decodes_skipped += 1
+                self.steps_saved += max(token.steps_total - token.steps_done, 0)
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns run/step counters and the fraction of denoising steps avoided."""
+        steps = self.steps_run + self.steps_saved
+        return {
+            "active_sessions": len(self._active),
+            "runs_started": self.runs_started,
+            "runs_completed": self.runs_completed,
+            "runs_superseded": self.runs_superseded,
+            "steps_run": self.steps_run,
+            "steps_saved": self.steps_saved,
+            "decodes_skipped": self.decodes_skipped,
+            "work_saved": self.steps_saved / steps if steps else 0.0,
+        }
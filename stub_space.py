@@ -0,0 +1,90 @@
+"""
+Local stand-in for the `KingNish/Realtime-FLUX` Space.
+
+Exposes `/RealtimeFlux` and `/Enhance` with the same inputs and outputs as app_backup.py but returns a
+flat-colored image after a simulated compute delay, so app.py can be exercised without a GPU:
+
+    python stub_space.py --port 7861
+    url_api=http://127.0.0.1:7861 python app.py
+"""
+import argparse
+import hashlib
+import random
+import time
+
+import gradio as gr
+import numpy as np
+
+MAX_SEED = np.iinfo(np.int32).max
+MAX_IMAGE_SIZE = 2048
+DEFAULT_WIDTH = 1024
+DEFAULT_HEIGHT = 1024
+
+# Simulated compute time: seconds per megapixel per step, plus a fixed overhead
+SECONDS_PER_MEGAPIXEL_STEP = 0.2
+BASE_SECONDS = 0.05
+
+
+def _fake_image(prompt, seed, width, height):
+    digest = hashlib.sha256(f"{prompt}|{int(float(seed))}".encode("utf-8")).digest()
+    return np.full((int(height), int(width), 3), list(digest[:3]), dtype=np.uint8)
+
+
+def _step_time(width, height):
+    return SECONDS_PER_MEGAPIXEL_STEP * int(width) * int(height) / 1e6
+
+
+def generate_image(prompt, seed=42, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, randomize_seed=False, num_inference_steps=2):
+    if randomize_seed:
+        seed = random.randint(0, MAX_SEED)
+    start_time = time.time()
+    time.sleep(BASE_SECONDS)
+    for _ in range(int(num_inference_steps)):
+        time.sleep(_step_time(width, height))
+        latency = f"Latency: {(time.time()-start_time):.2f} seconds"
+        yield _fake_image(prompt, seed, width, height), seed, latency
+
+
+def enhance_image(*args):
+    return list(generate_image(*args))[-1]
+
+
+def build_demo():
+    with gr.Blocks() as demo:
+        prompt = gr.Text(label="Prompt")
+        seed = gr.Number(label="Seed", value=42)
+        randomize_seed = gr.Checkbox(label="Randomize Seed", value=False)
+        width = gr.Slider(label="Width", minimum=256, maximum=MAX_IMAGE_SIZE, step=32, value=DEFAULT_WIDTH)
+        height = gr.Slider(label="Height", minimum=256, maximum=MAX_IMAGE_SIZE, step=32, value=DEFAULT_HEIGHT)
+        num_inference_steps = gr.Slider(label="Inference Steps", minimum=1, maximum=4, step=1, value=1)
+        result = gr.Image(label="Generated Image")
+        latency = gr.Text(label="Latency")
+        generateBtn = gr.Button("Generate")
+        enhanceBtn = gr.Button("Enhance")
+
+        enhanceBtn.click(
+            fn=enhance_image,
+            inputs=[prompt, seed, width, height],
+            outputs=[result, seed, latency],
+            api_name="Enhance",
+            concurrency_limit=None,
+        )
+        generateBtn.click(
+            fn=generate_image,
+            inputs=[prompt, seed, width, height, randomize_seed, num_inference_steps],
+            outputs=[result, seed, latency],
+            api_name="RealtimeFlux",
+            concurrency_limit=None,
+        )
+    return demo
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=7861)
+    parser.add_argument("--seconds-per-megapixel-step", type=float, default=SECONDS_PER_MEGAPIXEL_STEP)
+    parser.add_argument("--base-seconds", type=float, default=BASE_SECONDS)
+    args = parser.parse_args()
+    SECONDS_PER_MEGAPIXEL_STEP = args.seconds_per_megapixel_step
+    BASE_SECONDS = args.base_seconds
+    build_demo().queue(default_concurrency_limit=None).launch(server_port=args.port)
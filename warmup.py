@@ -0,0 +1,79 @@
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, Optional
+
+LOADING = "loading"
+WARMING = "warming"
+READY = "ready"
+FAILED = "failed"
+
+
+class BackgroundLoader:
+    """
+    Runs `load` and then `warm_up` on a daemon thread so the web server can bind immediately.
+    Handlers check `ready` (or `status()`) and report "warming" instead of blocking on the model.
+    """
+    def __init__(self, load: Callable[[], Any], warm_up: Optional[Callable[[], Any]] = None, name: str = "model"):
+        self.load = load
+        self.warm_up = warm_up
+        self.name = name
+        self.state = LOADING
+        self.error: Optional[str] = None
+        self.load_seconds: Optional[float] = None
+        self.warmup_seconds: Optional[float] = None
+        self._start_time: Optional[float] = None
+        self._ready = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "BackgroundLoader":
+        """Starts loading in the background; returns immediately."""
+        self._start_time = time.time()
+        self._thread = threading.Thread(target=self._run, name=f"{self.name}-loader", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            self.load()
+            self.load_seconds = time.time() - self._start_time
+            self.state = WARMING
+            if self.warm_up is not None:
+                self.warm_up()
+            self.warmup_seconds = time.time() - self._start_time - self.load_seconds
+            self.state = READY
+        except Exception:
+            self.error = traceback.format_exc()
+            self.state = FAILED
+            print(f"Loading {self.name} failed:\n{self.error}")
+        finally:
+            self._ready.set()
+
+    @property
+    def ready(self) -> bool:
+        return self.state == READY
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until loading finished (or `timeout` seconds passed); returns True when ready."""
+        self._ready.wait(timeout)
+        return self.ready
+
+    def message(self) -> str:
+        """Short human-readable state for the UI."""
+        if self.state == FAILED:
+            return f"{self.name} failed to load; see the server logs"
+        if self.state == READY:
+            return f"{self.name} ready"
+        elapsed = time.time() - self._start_time if self._start_time else 0.0
+        return f"{self.name} is {self.state}, please retry in a moment ({elapsed:.0f}s since start)"
+
+    def status(self) -> Dict[str, Any]:
+        """Readiness payload: state, timings and error if any."""
+        return {
+            "name": self.name,
+            "state": self.state,
+            "ready": self.ready,
+            "load_seconds": self.load_seconds,
+            "warmup_seconds": self.warmup_seconds,
+            "error": self.error,
+        }